@@ -28,7 +28,15 @@ def includeme(config):
     config.add_request_method(get_resource_map, 'resource_map', reify=True)
 
     config.add_tween('nefertari.tweens.cache_control')
+    config.add_view_predicate(
+        'json_items', 'nefertari.view.JsonItemsPredicate')
 
     config.add_route('options', '/*path', request_method='OPTIONS')
     config.add_view(view='nefertari.utility_views.OptionsView',
                     route_name='options')
+
+    metrics_path = config.registry.settings.get('nefertari.metrics_path')
+    if metrics_path:
+        config.add_route('metrics', metrics_path, request_method='GET')
+        config.add_view(view='nefertari.utility_views.MetricsView',
+                        route_name='metrics')
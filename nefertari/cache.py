@@ -0,0 +1,130 @@
+import time
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class MemoryCache(object):
+    """ In-process LRU cache with per-entry TTL.
+
+    Backends of `ResponseCache` implement the same interface:
+      * from_settings(settings): Create backend from `response_cache.*`
+        settings.
+      * get(key): Get value of :key: or None if it is missing or expired.
+      * set(key, value, ttl=None): Set value of :key: for :ttl: seconds.
+    Use a backend shared by processes (e.g. memcached or redis) to get
+    invalidation across processes.
+    """
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(max_size=settings.asint('max_size', 1000))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                return None
+            self._data[key] = entry
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class ResponseCache(object):
+    """ Cache of responses which is invalidated by document type.
+
+    Each entry is stored along with generations of document types the
+    response was built from. Generation of a document type is a random
+    token which is replaced by `invalidate` when documents of that type
+    change. That makes entries built from older generations stale. If a
+    generation is evicted from the backend, a new one is created, so
+    entries are never served from a forgotten generation.
+
+    Generations must be taken with `generations` before documents are
+    read, so that documents changed while a response is being built make
+    it stale. As changes become searchable in ES only after its refresh
+    interval, responses are not stored for `refresh_interval` seconds
+    after documents they were built from change.
+    """
+    def __init__(self, backend, ttl=60, refresh_interval=1):
+        self.backend = backend
+        self.ttl = ttl
+        self.refresh_interval = refresh_interval
+
+    def _generation_key(self, doc_type):
+        return 'doc_type:{}'.format(doc_type)
+
+    def _new_generation(self, doc_type):
+        # Time of the change is kept to tell if ES has refreshed since
+        generation = '{}:{!r}'.format(uuid.uuid4().hex, time.time())
+        self.backend.set(self._generation_key(doc_type), generation)
+        return generation
+
+    def _generation(self, doc_type):
+        generation = self.backend.get(self._generation_key(doc_type))
+        return generation or self._new_generation(doc_type)
+
+    def get(self, key):
+        """ Get cached response for :key: or None if there is no valid
+        entry.
+        """
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        response, generations = entry
+        for doc_type, generation in generations.items():
+            if self._generation(doc_type) != generation:
+                return None
+        return response
+
+    def generations(self, doc_types):
+        """ Get current generations of :doc_types:. """
+        return dict(
+            (doc_type, self._generation(doc_type)) for doc_type in doc_types)
+
+    def _settled(self, generation):
+        changed = float(generation.rsplit(':', 1)[-1])
+        return time.time() - changed >= self.refresh_interval
+
+    def set(self, key, response, generations):
+        """ Store :response: built from documents of :generations: taken
+        before the documents were read.
+
+        Returns False if the response was not stored because documents
+        changed too recently.
+        """
+        if not all(self._settled(gen) for gen in generations.values()):
+            return False
+        self.backend.set(key, (response, generations), ttl=self.ttl)
+        return True
+
+    def invalidate(self, doc_type):
+        """ Invalidate entries built from documents of :doc_type:.
+
+        Entries built from documents of all types ('_all') are
+        invalidated too.
+        """
+        log.debug('Invalidating cached responses of `%s`', doc_type)
+        self._new_generation(doc_type)
+        self._new_generation('_all')
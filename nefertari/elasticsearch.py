@@ -1,11 +1,25 @@
 from __future__ import absolute_import
+import re
+import json
+import time
 import logging
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from hashlib import md5
+from itertools import chain, islice
+from multiprocessing.pool import ThreadPool
 
 import elasticsearch
+from blinker import signal
+from pyramid.threadlocal import get_current_request
 
 from nefertari.utils import (
     dictset, dict2obj, process_limit, split_strip)
 from nefertari.json_httpexceptions import JHTTPBadRequest, JHTTPNotFound, exception_response
+from nefertari.cache import MemoryCache, ResponseCache
+from nefertari.tweens import timed
+from nefertari import metrics
 from nefertari import engine
 
 log = logging.getLogger(__name__)
@@ -19,23 +33,50 @@ RESERVED = [
     '_sort',
     '_raw_terms',
     '_search_fields',
+    '_scroll',
+    '_scroll_id',
 ]
 
+# Default time to keep scroll context alive between requests
+DEFAULT_SCROLL = '1m'
+# Default of the longest time clients may keep scroll context alive for
+DEFAULT_MAX_SCROLL = '5m'
+
+# ES time value, e.g. '30s'. Numbers without a unit are milliseconds.
+TIME_VALUE = re.compile(r'^(\d+(?:\.\d+)?)(ms|s|m|h|d|w)?$')
+TIME_UNITS = {
+    'ms': 0.001, 's': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60}
+
+# Characters with a special meaning in query_string syntax
+QS_SPECIAL_CHARS = re.compile(r'[\s+\-=&|><!(){}\[\]^"~*?:\\/]')
+QS_LEADING_OPERATOR = re.compile(r'^\s*(AND|OR)\s+')
+
+# Sent with a document type as sender after documents of that type are
+# indexed or deleted
+documents_changed = signal('nefertari.es.documents_changed')
+
 
 class IndexNotFoundException(Exception):
     pass
 
 
 class ESHttpConnection(elasticsearch.Urllib3HttpConnection):
-    def perform_request(self, *args, **kw):
+    def perform_request(self, method, *args, **kw):
+        status_code = None
+        start = time.time()
         try:
             if log.level == logging.DEBUG:
-                msg = str(args)
+                msg = str((method,) + args)
                 if len(msg) > 512:
                     msg = msg[:300] + '...TRUNCATED...' + msg[-212:]
                 log.debug(msg)
 
-            return super(ESHttpConnection, self).perform_request(*args, **kw)
+            with timed(get_current_request(), 'es'):
+                response = super(ESHttpConnection, self).perform_request(
+                    method, *args, **kw)
+            status_code = response[0]
+            return response
         except Exception as e:
             status_code = e.status_code
             if status_code == 404:
@@ -46,6 +87,10 @@ class ESHttpConnection(elasticsearch.Urllib3HttpConnection):
                 status_code,
                 detail='elasticsearch error.',
                 extra=dict(data=e))
+        finally:
+            metrics.ES_REQUESTS.inc(method=method, status=status_code)
+            metrics.ES_REQUEST_DURATION.observe(
+                time.time() - start, method=method)
 
 
 def includeme(config):
@@ -53,10 +98,91 @@ def includeme(config):
     ES.setup(Settings)
 
 
+def _request_cache():
+    """ Return dict that caches ES documents for the current request.
+
+    Returns None when called outside of a request.
+    """
+    request = get_current_request()
+    if request is None:
+        return None
+    return request.environ.setdefault('nefertari.es_documents', {})
+
+
+def _id_key(_id):
+    """ Get key of document ID :_id: in the request cache of documents.
+
+    IDs are compared as text, so that e.g. 1 and '1' share a key.
+    """
+    if isinstance(_id, str):
+        return _id.decode('utf-8')
+    return unicode(_id)
+
+
+def _track_doc_types(*doc_types):
+    """ Record document types read during the current request.
+
+    Recorded types are stored in `nefertari.es_doc_types` key of request
+    environ and are used to invalidate cached responses. Searches across
+    all document types are recorded as '_all'.
+
+    When the response cache is enabled, generation of each type is taken
+    in `nefertari.es_generations` the first time the type is read, so
+    that changes made while the request is handled make its response
+    stale.
+    """
+    request = get_current_request()
+    if request is None:
+        return
+    environ = request.environ
+    doc_types = set(doc_type or '_all' for doc_type in doc_types)
+    environ.setdefault('nefertari.es_doc_types', set()).update(doc_types)
+
+    cache = environ.get('nefertari.response_cache')
+    if cache is not None:
+        generations = environ.setdefault('nefertari.es_generations', {})
+        new_types = doc_types.difference(generations)
+        if new_types:
+            generations.update(cache.generations(new_types))
+
+
+def parse_time_value(value):
+    """ Get number of seconds in ES time :value: (e.g. '1m').
+
+    Raises ValueError if :value: is not a valid time value.
+    """
+    match = TIME_VALUE.match(str(value).strip())
+    if match is None:
+        raise ValueError('Invalid time value: {}'.format(value))
+    number, unit = match.groups()
+    return float(number) * TIME_UNITS[unit or 'ms']
+
+
 def _bulk_body(body):
     return ES.api.bulk(body=body)
 
 
+def _bulk_meta(line):
+    """ Get (action, metadata) from bulk action :line:. """
+    for key, value in line.items():
+        if not key.startswith('_'):
+            return key, value
+
+
+def _bulk_failures(body):
+    """ Send bulk `body` and return a list of items that failed. """
+    response = _bulk_body(body)
+    if not response.get('errors'):
+        return []
+
+    failures = []
+    for item in response['items']:
+        result = item.values()[0]
+        if 'error' in result:
+            failures.append(result)
+    return failures
+
+
 def apply_sort(_sort):
     _sort_param = []
 
@@ -95,16 +221,132 @@ def build_qs(params, _raw_terms='', operator='AND'):
     return _terms
 
 
+def is_exact_value(value):
+    """ Return True if `value` has no query_string syntax in it and can
+    be matched with a `term` filter.
+    """
+    if isinstance(value, bool) or isinstance(value, (int, long, float)):
+        return True
+    if not isinstance(value, basestring) or not value:
+        return False
+    return not QS_SPECIAL_CHARS.search(value)
+
+
+def build_query(params, _raw_terms='', _search_fields=None,
+                use_filters=False):
+    """ Build ES query from request `params`.
+
+    If `use_filters` is True, params with exact values are turned into
+    `term`/`terms` filters which are not scored and are cached by ES.
+    The rest of params, `_raw_terms` and `_search_fields` make up a scored
+    `query_string` query. Without filters this is the same query as built
+    with `build_qs`.
+    """
+    params.pop_by_values('_all')
+
+    filters = []
+    qs_params = dictset()
+    for key, value in params.items():
+        if key.startswith('__'):
+            continue
+        values = value if isinstance(value, list) else [value]
+        # `q` is a full-text search and is always scored
+        exact = key != 'q' and values and all(map(is_exact_value, values))
+        if use_filters and exact:
+            kind = 'terms' if isinstance(value, list) else 'term'
+            filters.append({kind: {key: value}})
+        else:
+            qs_params[key] = value
+
+    query_string = build_qs(qs_params, _raw_terms)
+    if not qs_params:
+        query_string = QS_LEADING_OPERATOR.sub('', query_string)
+
+    if query_string:
+        query = {'query_string': {'query': query_string}}
+        if _search_fields:
+            search_fields = _search_fields.split(',')
+            search_fields.reverse()
+            query['query_string']['fields'] = [
+                s + '^' + str(i) for i, s in enumerate(search_fields, 1)]
+    else:
+        query = {'match_all': {}}
+
+    if filters:
+        query = {
+            'filtered': {
+                'query': query,
+                'filter': {'bool': {'must': filters}},
+            }
+        }
+    return query
+
+
+class SingleFlight(object):
+    """ Run identical concurrent calls once and share their result.
+
+    While a call with some key is in flight, callers of `do` with the
+    same key wait for it and get its result (or exception) instead of
+    making the call themselves.
+    """
+    class _Call(object):
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
 class _ESDocs(list):
     def __init__(self, *args, **kw):
         self._total = 0
         self._start = 0
+        self._etag = None
         super(_ESDocs, self).__init__(*args, **kw)
 
 
 class ES(object):
     api = None
     settings = None
+    bulk_workers = 1
+    chunk_bytes = 10 * 1024 * 1024
+    use_filters = False
+    coalesce_searches = False
+    _searches = SingleFlight()
+    count_cache = None
+    max_scroll = DEFAULT_MAX_SCROLL
+    # Bulk actions collected by `defer_bulk` in the current thread
+    _deferred = threading.local()
+    # Thread pools of bulk workers by number of workers
+    _pools = {}
+    _pools_lock = threading.Lock()
 
     @classmethod
     def src2type(cls, source):
@@ -131,34 +373,176 @@ class ES(object):
             ES.api = elasticsearch.Elasticsearch(
                 hosts=hosts, serializer=engine.ESJSONSerializer(),
                 connection_class=ESHttpConnection, **params)
+            ES.bulk_workers = ES.settings.asint('bulk_workers', 1)
+            ES.chunk_bytes = ES.settings.asint('chunk_bytes', ES.chunk_bytes)
+            ES.use_filters = ES.settings.asbool('use_filters')
+            ES.coalesce_searches = ES.settings.asbool('coalesce_searches')
+            ES.max_scroll = ES.settings.get('max_scroll', DEFAULT_MAX_SCROLL)
+            parse_time_value(ES.max_scroll)
+            count_cache_ttl = ES.settings.asfloat('count_cache_ttl', 0)
+            ES.count_cache = None
+            if count_cache_ttl > 0:
+                ES.count_cache = ResponseCache(
+                    MemoryCache(), ttl=count_cache_ttl)
             log.info('Including ElasticSearch. %s' % ES.settings)
 
-        except KeyError as e:
+        except (KeyError, ValueError) as e:
             raise Exception(
                 'Bad or missing settings for elasticsearch. %s' % e)
 
-    def __init__(self, source='', index_name=None, chunk_size=100):
+    @classmethod
+    def get_aliased_indices(cls, alias):
+        """ Return names of indices `alias` points to. """
+        try:
+            return ES.api.indices.get_alias(name=alias).keys()
+        except IndexNotFoundException:
+            return []
+
+    @classmethod
+    def index_exists(cls, index_name):
+        try:
+            return ES.api.indices.exists(index=index_name)
+        except IndexNotFoundException:
+            return False
+
+    @classmethod
+    def create_bulk_index(cls, alias, models=()):
+        """ Create a new empty index to be served under `alias`.
+
+        The index is named `<alias>_<timestamp>`. Mappings of document
+        types are taken from `models` which define `get_es_mapping`, and
+        are copied from the indices `alias` currently points to for the
+        rest. Refresh and replicas are disabled so documents can be bulk
+        loaded fast; they are enabled back by `swap_alias`.
+
+        Returns the name of the created index.
+        """
+        aliased = cls.get_aliased_indices(alias)
+        if not aliased and cls.index_exists(alias):
+            raise Exception(
+                'Index `{}` exists and is not an alias. Delete it or use '
+                'another name to build versioned indices.'.format(alias))
+
+        mappings = {}
+        for old_index in aliased:
+            data = ES.api.indices.get_mapping(index=old_index)
+            mappings.update(data[old_index]['mappings'])
+        for model in models:
+            doc_type = cls.src2type(model.__name__)
+            if hasattr(model, 'get_es_mapping'):
+                mapping = model.get_es_mapping()
+                mappings.update(
+                    (cls.src2type(name), value)
+                    for name, value in mapping.items())
+            if doc_type not in mappings:
+                log.warning(
+                    'No mapping of `{}` found. Its documents will be '
+                    'mapped dynamically.'.format(doc_type))
+
+        index_name = '{}_{}'.format(
+            alias, datetime.utcnow().strftime('%Y%m%d%H%M%S'))
+        body = {
+            'settings': {
+                'index': {
+                    'refresh_interval': '-1',
+                    'number_of_replicas': 0,
+                }
+            },
+            'mappings': mappings,
+        }
+        ES.api.indices.create(index=index_name, body=body)
+        log.info('Created index `{}` for alias `{}`'.format(
+            index_name, alias))
+        return index_name
+
+    @classmethod
+    def swap_alias(cls, alias, index_name):
+        """ Atomically point `alias` to `index_name`.
+
+        Refresh interval and number of replicas of `index_name` are restored
+        from the index `alias` pointed to before (or ES defaults), and the
+        index is refreshed before it starts serving reads.
+
+        Returns names of indices `alias` pointed to before. These indices
+        are not deleted.
+        """
+        old_indices = [name for name in cls.get_aliased_indices(alias)
+                       if name != index_name]
+
+        index_settings = {'refresh_interval': '1s', 'number_of_replicas': 1}
+        if old_indices:
+            data = ES.api.indices.get_settings(index=old_indices[0])
+            old_settings = data[old_indices[0]]['settings'].get('index', {})
+            for key in index_settings:
+                if key in old_settings:
+                    index_settings[key] = old_settings[key]
+
+        ES.api.indices.put_settings(
+            index=index_name, body={'index': index_settings})
+        ES.api.indices.refresh(index=index_name)
+
+        actions = [{'remove': {'index': name, 'alias': alias}}
+                   for name in old_indices]
+        actions.append({'add': {'index': index_name, 'alias': alias}})
+        ES.api.indices.update_aliases(body={'actions': actions})
+        log.info('Alias `{}` now points to `{}`. Previous indices: {}'.format(
+            alias, index_name, ', '.join(old_indices) or 'none'))
+        return old_indices
+
+    def __init__(self, source='', index_name=None, chunk_size=100,
+                 bulk_workers=None, chunk_bytes=None):
         self.doc_type = self.src2type(source)
         self.index_name = index_name or ES.settings.index_name
         self.chunk_size = chunk_size
+        self.bulk_workers = bulk_workers or ES.bulk_workers
+        self.chunk_bytes = chunk_bytes or ES.chunk_bytes
 
-    def process_chunks(self, documents, operation, chunk_size):
+    def process_chunks(self, documents, operation, chunk_size, workers=1):
         """ Apply `operation` to chunks of `documents` of size `chunk_size`.
 
         """
-        start = end = 0
-        count = len(documents)
+        chunks = (documents[start:start + chunk_size]
+                  for start in xrange(0, len(documents), chunk_size))
+        return self.apply_to_chunks(chunks, operation, workers)
 
-        while count:
-            if count < chunk_size:
-                chunk_size = count
-            end += chunk_size
+    @classmethod
+    def get_pool(cls, workers):
+        """ Get thread pool of :workers: threads shared by all the
+        instances, so that pools are not created per bulk request.
+        """
+        with cls._pools_lock:
+            pool = cls._pools.get(workers)
+            if pool is None:
+                pool = cls._pools[workers] = ThreadPool(workers)
+            return pool
+
+    def apply_to_chunks(self, chunks, operation, workers=1):
+        """ Apply `operation` to each chunk from `chunks` iterable.
+
+        When `workers` is greater than 1 and there is more than one
+        chunk, chunks are processed in a shared thread pool with at most
+        `workers` chunks in flight at a time.
+        Returns a list of `operation` results in the order of chunks.
+        """
+        chunks = iter(chunks)
+        first = list(islice(chunks, 2))
+        if workers <= 1 or len(first) < 2:
+            return [operation(chunk) for chunk in chain(first, chunks)]
+
+        in_flight = threading.BoundedSemaphore(workers)
 
-            bulk = documents[start:end]
-            operation(bulk)
+        def run(chunk):
+            try:
+                return operation(chunk)
+            finally:
+                in_flight.release()
 
-            start += chunk_size
-            count -= chunk_size
+        pool = self.get_pool(workers)
+        pending = []
+        for chunk in chain(first, chunks):
+            in_flight.acquire()
+            pending.append(pool.apply_async(run, (chunk,)))
+        return [result.get() for result in pending]
 
     def prep_bulk_documents(self, action, documents):
         if not isinstance(documents, list):
@@ -189,6 +573,7 @@ class ES(object):
 
         return _docs
 
+    @metrics.instrument('bulk')
     def _bulk(self, action, documents, chunk_size=None):
         if chunk_size is None:
             chunk_size = self.chunk_size
@@ -197,31 +582,119 @@ class ES(object):
             log.debug('empty documents: %s' % self.doc_type)
             return
 
+        # Documents cached for this request may be changed by this call
+        cache = _request_cache()
+        if cache:
+            cache.clear()
+
         documents = self.prep_bulk_documents(action, documents)
 
+        # Each item of `body` is a sequence of lines of one bulk action:
+        # [meta] or [meta, document]
         body = []
         for meta, doc in documents:
             action = meta.keys()[0]
             if action == 'delete':
-                body += [meta]
+                body.append([meta])
             elif action == 'index':
                 if 'timestamp' in doc:
                     meta['_timestamp'] = doc['timestamp']
-                body += [meta, doc]
+                body.append([meta, doc])
 
-        if body:
-            # Use chunk_size*2, because `body` is a sequence of
-            # meta, document, meta, ...
-            self.process_chunks(
-                documents=body,
-                operation=_bulk_body,
-                chunk_size=chunk_size*2)
-        else:
+        if not body:
             log.warning('Empty body')
+            return
+
+        deferred = getattr(ES._deferred, 'body', None)
+        if deferred is not None:
+            deferred.extend(body)
+            return []
+
+        return self._send_bulk(body, chunk_size)
+
+    def _send_bulk(self, body, chunk_size):
+        """ Send bulk `body` in chunks and return items that failed. """
+        results = self.apply_to_chunks(
+            chunks=self.split_bulk_body(body, chunk_size, self.chunk_bytes),
+            operation=_bulk_failures,
+            workers=self.bulk_workers)
+
+        metas = [_bulk_meta(lines[0]) for lines in body]
+        doc_types = set(
+            meta.get('_type', self.doc_type) for _, meta in metas)
+        for doc_type in doc_types:
+            if ES.count_cache is not None:
+                ES.count_cache.invalidate(doc_type)
+            documents_changed.send(doc_type)
+
+        failures = [item for chunk in results for item in chunk]
+        action = '/'.join(sorted(set(action for action, _ in metas)))
+        for item in failures:
+            log.error('Failed to %s %s(%s): %s' % (
+                action, item.get('_type'), item.get('_id'),
+                item['error']))
+        return failures
+
+    @classmethod
+    @contextmanager
+    def defer_bulk(cls):
+        """ Collect bulk actions of the block and send them in one bulk
+        request when the block exits.
+
+        Used to index documents saved in a batch with a single request.
+        Collected actions are dropped if the block raises. Nested blocks
+        are sent along with the outermost one.
+        """
+        if getattr(cls._deferred, 'body', None) is not None:
+            yield
+            return
+
+        body = cls._deferred.body = []
+        try:
+            yield
+        finally:
+            cls._deferred.body = None
+        if body:
+            cls()._send_bulk(body, chunk_size=len(body))
+
+    def split_bulk_body(self, body, chunk_size, chunk_bytes):
+        """ Serialize bulk `body` and split it into chunks.
+
+        `body` is a sequence of bulk actions, each being a list of lines.
+        A chunk is flushed when it holds `chunk_size` actions or when adding
+        the next action would make it bigger than `chunk_bytes` bytes.
+        An action bigger than `chunk_bytes` is sent in a chunk of its own.
+        Chunks are yielded as serialized bulk request bodies.
+        """
+        serializer = ES.api.transport.serializer
+        chunk = []
+        count = size = 0
+
+        for lines in body:
+            data = ''.join(serializer.dumps(line) + '\n' for line in lines)
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+
+            full = count >= chunk_size or size + len(data) > chunk_bytes
+            if chunk and full:
+                yield ''.join(chunk)
+                chunk = []
+                count = size = 0
+
+            chunk.append(data)
+            count += 1
+            size += len(data)
+
+        if chunk:
+            yield ''.join(chunk)
 
     def index(self, documents, chunk_size=None):
-        """ Reindex all `document`s. """
-        self._bulk('index', documents, chunk_size)
+        """ Reindex all `document`s.
+
+        Returns a list of bulk items that failed to be indexed or None if
+        there was nothing to index.
+        """
+        return self._bulk('index', documents, chunk_size)
 
     def index_missing_documents(self, documents, chunk_size=None):
         """ Index documents that are missing from ES index.
@@ -255,15 +728,16 @@ class ES(object):
                      'index `{}`'.format(self.doc_type, self.index_name))
             return
 
-        self._bulk('index', documents, chunk_size)
+        return self._bulk('index', documents, chunk_size)
 
     def delete(self, ids):
         if not isinstance(ids, list):
             ids = [ids]
 
         documents = [{'id': _id, '_type': self.doc_type} for _id in ids]
-        self._bulk('delete', documents)
+        return self._bulk('delete', documents)
 
+    @metrics.instrument('get_by_ids')
     def get_by_ids(self, ids, **params):
         if not ids:
             return _ESDocs()
@@ -276,43 +750,57 @@ class ES(object):
         _start = params.pop('_start', None)
         _start, _limit = process_limit(_start, _page, _limit)
 
+        fields_key = tuple(fields) if isinstance(fields, list) else fields
+        keys = [(self.index_name, self.src2type(_id['_type']),
+                 _id_key(_id['_id']), fields_key) for _id in ids]
+        _track_doc_types(*set(key[1] for key in keys))
+
+        # Documents are cached per request, so repeated IDs are only
+        # fetched once. Outside of a request, cache is local to this call.
+        cache = _request_cache()
+        if cache is None:
+            cache = {}
+
+        missing = []
+        seen = set()
         docs = []
-        for _id in ids:
-            docs.append(
-                dict(
-                    _index=self.index_name,
-                    _type=self.src2type(_id['_type']),
-                    _id=_id['_id']
-                )
-            )
+        for _id, key in zip(ids, keys):
+            if key in cache or key in seen:
+                continue
+            seen.add(key)
+            missing.append(key)
+            docs.append(dict(_index=key[0], _type=key[1], _id=_id['_id']))
 
-        params = dict(
-            body=dict(docs=docs)
-        )
-        if fields:
-            params['fields'] = fields
         documents = _ESDocs()
         documents._nefertari_meta = dict(
             start=_start,
             fields=fields,
         )
 
-        try:
-            data = ES.api.mget(**params)
-        except IndexNotFoundException:
-            if __raise_on_empty:
-                raise JHTTPNotFound(
-                    '{}({}) resource not found (Index does not exist)'.format(
-                        self.doc_type, params))
-            documents._nefertari_meta.update(total=0)
-            return documents
+        if missing:
+            params = dict(
+                body=dict(docs=docs)
+            )
+            if fields:
+                params['fields'] = fields
 
-        for _d in data['docs']:
             try:
-                _d = _d['fields'] if fields else _d['_source']
-            except KeyError:
-                msg = "ES: '%s(%s)' resource not found" % (
-                    _d['_type'], _d['_id'])
+                data = ES.api.mget(**params)
+            except IndexNotFoundException:
+                if __raise_on_empty:
+                    raise JHTTPNotFound(
+                        '{}({}) resource not found (Index does not '
+                        'exist)'.format(self.doc_type, params))
+                documents._nefertari_meta.update(total=0)
+                return documents
+
+            for key, _d in zip(missing, data['docs']):
+                cache[key] = _d.get('fields' if fields else '_source')
+
+        for key in keys:
+            _d = cache[key]
+            if _d is None:
+                msg = "ES: '%s(%s)' resource not found" % (key[1], key[2])
                 if __raise_on_empty:
                     raise JHTTPNotFound(msg)
                 else:
@@ -336,19 +824,13 @@ class ES(object):
         )
 
         if 'body' not in params:
-            query_string = build_qs(
-                params.remove(RESERVED),
-                params.get('_raw_terms', ''))
-            if query_string:
-                _params['body'] = {
-                    'query': {
-                        'query_string': {
-                            'query': query_string
-                        }
-                    }
-                }
-            else:
-                _params['body'] = {"query": {"match_all": {}}}
+            _params['body'] = {
+                'query': build_query(
+                    params.remove(RESERVED),
+                    params.get('_raw_terms', ''),
+                    params.get('_search_fields'),
+                    use_filters=ES.use_filters)
+            }
 
         if '_limit' not in params:
             raise JHTTPBadRequest('Missing _limit')
@@ -358,34 +840,69 @@ class ES(object):
             params.get('_page', None),
             params['_limit'])
 
+        if '_scroll' in params:
+            # Scroll always starts at the first hit
+            _params['from_'] = 0
+            _params['scroll'] = self.get_scroll_keepalive(params['_scroll'])
+
         if '_sort' in params:
             _params['sort'] = apply_sort(params['_sort'])
 
         if '_fields' in params:
             _params['fields'] = params['_fields']
 
-        if '_search_fields' in params:
-            search_fields = params['_search_fields'].split(',')
-            search_fields.reverse()
-            search_fields = [s + '^' + str(i) for i, s in
-                             enumerate(search_fields, 1)]
-            _params['body']['query']['query_string']['fields'] = search_fields
+        # Hits' versions are used to compute ETag of the collection
+        _params['version'] = True
 
         return _params
 
+    @metrics.instrument('count')
     def do_count(self, params):
+        _track_doc_types(self.doc_type)
         # params['fields'] = []
         params.pop('size', None)
         params.pop('from_', None)
         params.pop('sort', None)
+        params.pop('version', None)
+
+        # Counts are cached for `elasticsearch.count_cache_ttl` seconds
+        # or until documents of `self.doc_type` change
+        cache_key = None
+        if ES.count_cache is not None:
+            cache_key = 'count:' + json.dumps(
+                params, sort_keys=True, default=str)
+            count = ES.count_cache.get(cache_key)
+            if count is not None:
+                return count
+            generations = ES.count_cache.generations(
+                [self.doc_type or '_all'])
+
         try:
-            return ES.api.count(**params)['count']
+            count = ES.api.count(**params)['count']
         except IndexNotFoundException:
             return 0
 
+        if cache_key is not None:
+            ES.count_cache.set(cache_key, count, generations)
+        return count
+
+    @metrics.instrument('get_collection')
     def get_collection(self, **params):
+        """ Search for documents.
+
+        Collection is paginated with `_start`/`_page` and `_limit` by
+        default. To walk big collections, pass `_scroll=<keepalive>` (e.g.
+        `_scroll=1m`) to start a scroll. The scroll ID is returned in
+        `_nefertari_meta['scroll_id']` and next pages are requested by
+        passing it back as `_scroll_id`. Scroll ID is None when there are
+        no more documents.
+        """
         __raise_on_empty = params.pop('__raise_on_empty', False)
 
+        _track_doc_types(self.doc_type)
+        if '_scroll_id' in params:
+            return self.get_scroll_page(**params)
+
         if 'body' in params:
             _params = params
         else:
@@ -403,7 +920,7 @@ class ES(object):
             fields=_fields)
 
         try:
-            data = ES.api.search(**_params)
+            data = self.search(_params)
         except IndexNotFoundException:
             if __raise_on_empty:
                 raise JHTTPNotFound(
@@ -413,15 +930,15 @@ class ES(object):
                 total=0, took=0)
             return documents
 
-        for da in data['hits']['hits']:
-            _d = da['fields'] if _fields else da['_source']
-            _d['_score'] = da['_score']
-            documents.append(dict2obj(_d))
-
+        self._add_hits(documents, data['hits']['hits'], _fields)
         documents._nefertari_meta.update(
             total=data['hits']['total'],
             took=data['took'],
         )
+        if 'scroll' in _params:
+            last_page = len(data['hits']['hits']) >= data['hits']['total']
+            documents._nefertari_meta['scroll_id'] = self._next_scroll_id(
+                data, last_page)
 
         if not documents:
             msg = "%s(%s) resource not found" % (self.doc_type, params)
@@ -432,6 +949,98 @@ class ES(object):
 
         return documents
 
+    def search(self, params):
+        """ Run search with `params`.
+
+        If `ES.coalesce_searches` is True, identical concurrent searches
+        share one request to ES and its response. Searches that start a
+        scroll are never shared.
+        """
+        if not ES.coalesce_searches or 'scroll' in params:
+            return ES.api.search(**params)
+        key = json.dumps(params, sort_keys=True, default=str)
+        return ES._searches.do(key, ES.api.search, **params)
+
+    def get_scroll_keepalive(self, scroll):
+        """ Validate time to keep scroll context alive requested with
+        `_scroll`.
+
+        Time may not exceed `elasticsearch.max_scroll` setting, so that
+        clients can't hold scroll contexts open for long.
+        """
+        scroll = scroll or DEFAULT_SCROLL
+        try:
+            seconds = parse_time_value(scroll)
+        except ValueError:
+            raise JHTTPBadRequest('Invalid _scroll: {}'.format(scroll))
+        if seconds > parse_time_value(ES.max_scroll):
+            raise JHTTPBadRequest(
+                '_scroll may not exceed {}'.format(ES.max_scroll))
+        return scroll
+
+    @metrics.instrument('get_scroll_page')
+    def get_scroll_page(self, **params):
+        """ Get next page of a scroll started by `get_collection`. """
+        _fields = params.get('_fields', '')
+        documents = _ESDocs()
+        documents._nefertari_meta = dict(
+            start=None,
+            fields=_fields)
+
+        try:
+            data = ES.api.scroll(
+                scroll_id=params['_scroll_id'],
+                scroll=self.get_scroll_keepalive(params.get('_scroll')))
+        except IndexNotFoundException:
+            raise JHTTPBadRequest('Invalid or expired _scroll_id')
+
+        self._add_hits(documents, data['hits']['hits'], _fields)
+        documents._nefertari_meta.update(
+            total=data['hits']['total'],
+            took=data['took'],
+            scroll_id=self._next_scroll_id(
+                data, last_page=not data['hits']['hits']),
+        )
+        return documents
+
+    @staticmethod
+    def _add_hits(documents, hits, _fields):
+        """ Append search `hits` to `documents`.
+
+        If all the hits have `_version`, ETag is computed from hits'
+        types, IDs and versions and is stored in `documents._etag`.
+        """
+        etag = md5()
+        versioned = bool(hits)
+        for da in hits:
+            _d = da['fields'] if _fields else da['_source']
+            _d['_score'] = da['_score']
+            documents.append(dict2obj(_d))
+            if versioned and '_version' in da:
+                etag.update(u'{}/{}/{};'.format(
+                    da.get('_type'), da.get('_id'),
+                    da['_version']).encode('utf-8'))
+            else:
+                versioned = False
+
+        if versioned:
+            documents._etag = etag.hexdigest()
+
+    def _next_scroll_id(self, data, last_page):
+        """ Return scroll ID to request the page after `data` with.
+
+        Scroll is cleared and None is returned after the last page.
+        """
+        scroll_id = data.get('_scroll_id')
+        if scroll_id and last_page:
+            try:
+                ES.api.clear_scroll(scroll_id=scroll_id)
+            except IndexNotFoundException:
+                pass
+            return None
+        return scroll_id
+
+    @metrics.instrument('get_resource')
     def get_resource(self, **kw):
         __raise = kw.pop('__raise_on_empty', True)
 
@@ -442,6 +1051,13 @@ class ES(object):
         params.setdefault('ignore', 404)
         params.update(kw)
 
+        _track_doc_types(self.doc_type)
+        # Only lookups by ID share documents with `get_by_ids`
+        cache = _request_cache() if kw.keys() == ['id'] else None
+        cache_key = (self.index_name, self.doc_type, _id_key(kw.get('id')), ())
+        if cache and cache.get(cache_key):
+            return dict2obj(cache[cache_key])
+
         try:
             data = ES.api.get_source(**params)
         except IndexNotFoundException:
@@ -451,6 +1067,9 @@ class ES(object):
                         self.doc_type, params))
             data = {}
 
+        if cache is not None and data:
+            cache[cache_key] = data
+
         if not data:
             msg = "'%s(%s)' resource not found" % (self.doc_type, params)
             if __raise:
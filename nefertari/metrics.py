@@ -0,0 +1,214 @@
+""" In-process metrics.
+
+Metrics are kept in memory of each process and are rendered in
+Prometheus text format by `nefertari.utility_views.MetricsView`.
+Histograms have fixed buckets, so memory used by a metric only depends
+on the number of distinct label values.
+"""
+import time
+import threading
+from functools import wraps
+
+# Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return unicode(value).replace('\\', r'\\').replace(
+        '\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            '# HELP %s %s' % (self.name, self.help),
+            '# TYPE %s %s' % (self.name, self.type),
+        ]
+        with self._lock:
+            values = sorted(
+                (key, value[:] if isinstance(value, list) else value)
+                for key, value in self._values.items())
+        for key, value in values:
+            lines.extend(self._render_value(key, value))
+        return lines
+
+
+class Counter(Metric):
+    """ Counter of events by labels. """
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def _render_value(self, key, value):
+        return ['%s%s %s' % (
+            self.name, _format_labels(self.labelnames, key),
+            _format_value(value))]
+
+
+class Histogram(Metric):
+    """ Histogram of observed values by labels with fixed buckets. """
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Counts of buckets followed by sum of observed values
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def _cumulative(self, counts):
+        cumulative = []
+        total = 0
+        for count in counts[:-1]:
+            total += count
+            cumulative.append(total)
+        return cumulative, counts[-1]
+
+    def get(self, **labels):
+        """ Get (cumulative bucket counts, sum) observed for labels. """
+        with self._lock:
+            counts = list(self._values.get(self._key(labels)) or [])
+        return self._cumulative(counts) if counts else None
+
+    def _render_value(self, key, value):
+        cumulative, total = self._cumulative(value)
+        lines = []
+        for bound, count in zip(self.buckets, cumulative):
+            lines.append('%s_bucket%s %s' % (
+                self.name,
+                _format_labels(
+                    self.labelnames, key, [('le', _format_value(bound))]),
+                count))
+        labels = _format_labels(self.labelnames, key)
+        lines.append('%s_sum%s %s' % (self.name, labels, repr(total)))
+        lines.append('%s_count%s %s' % (self.name, labels, cumulative[-1]))
+        return lines
+
+
+class Registry(object):
+    """ Collection of metrics rendered together. """
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        """ Render all the metrics in Prometheus text format as unicode. """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return u'\n'.join(lines) + u'\n'
+
+
+registry = Registry()
+
+REQUESTS = registry.counter(
+    'nefertari_requests_total', 'Number of requests.',
+    ['route', 'action', 'status'])
+REQUEST_DURATION = registry.histogram(
+    'nefertari_request_duration_seconds', 'Time requests take.',
+    ['route', 'action'])
+ES_OPERATIONS = registry.counter(
+    'nefertari_es_operations_total', 'Number of ES operations.',
+    ['operation', 'doc_type', 'result'])
+ES_OPERATION_DURATION = registry.histogram(
+    'nefertari_es_operation_duration_seconds', 'Time ES operations take.',
+    ['operation', 'doc_type'])
+ES_REQUESTS = registry.counter(
+    'nefertari_es_requests_total', 'Number of HTTP requests to ES.',
+    ['method', 'status'])
+ES_REQUEST_DURATION = registry.histogram(
+    'nefertari_es_request_duration_seconds',
+    'Time HTTP requests to ES take.', ['method'])
+
+
+def observe_request(request, response, seconds):
+    """ Record metrics of :request: which took :seconds:. """
+    route = getattr(request, 'matched_route', None)
+    route = route.name if route is not None else ''
+    action = getattr(request, 'action', '') or ''
+    status = response.status_int if response is not None else 500
+    REQUESTS.inc(route=route, action=action, status=status)
+    REQUEST_DURATION.observe(seconds, route=route, action=action)
+
+
+def instrument(operation):
+    """ Decorator of `ES` methods that records metrics of their calls. """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            result = 'ok'
+            start = time.time()
+            try:
+                return func(self, *args, **kwargs)
+            except Exception:
+                result = 'error'
+                raise
+            finally:
+                ES_OPERATIONS.inc(
+                    operation=operation, doc_type=self.doc_type,
+                    result=result)
+                ES_OPERATION_DURATION.observe(
+                    time.time() - start, operation=operation,
+                    doc_type=self.doc_type)
+        return wrapper
+    return decorator
@@ -2,7 +2,12 @@ import json
 import logging
 from datetime import date, datetime
 
+import simplejson
+from simplejson import encoder as simplejson_encoder
+from pyramid.settings import asbool
+
 from nefertari import wrappers
+from nefertari.tweens import timed
 
 log = logging.getLogger(__name__)
 
@@ -18,6 +23,45 @@ class _JSONEncoder(json.JSONEncoder):
             return str(obj)  # fallback to str
 
 
+def _json_dumps(value, enc_class):
+    return json.dumps(value, cls=enc_class)
+
+
+def _simplejson_dumps(value, enc_class):
+    # Only `default` of `enc_class` is used. Decimals are left to it
+    # to be encoded the same way as with `json`. Probing values for
+    # `_asdict`/`for_json` is disabled, as `dictset.__getattr__` raises
+    # KeyError for missing attributes.
+    return simplejson.dumps(
+        value, default=enc_class().default, use_decimal=False,
+        namedtuple_as_object=False, for_json=False)
+
+
+JSON_SERIALIZERS = {
+    'json': _json_dumps,
+    'simplejson': _simplejson_dumps,
+}
+
+
+def get_json_serializer(name=None):
+    """ Get JSON serializer function by `name`.
+
+    If `name` is None or 'auto', simplejson is used when its C speedups
+    are available and stdlib json otherwise.
+    """
+    if name in (None, 'auto'):
+        if simplejson_encoder.c_make_encoder is not None:
+            name = 'simplejson'
+        else:
+            name = 'json'
+    try:
+        return JSON_SERIALIZERS[name]
+    except KeyError:
+        raise ValueError(
+            'Unknown JSON serializer `{}`. Available serializers: '
+            'auto, {}'.format(name, ', '.join(sorted(JSON_SERIALIZERS))))
+
+
 class JsonRendererFactory(object):
 
     def __init__(self, info):
@@ -27,7 +71,10 @@ class JsonRendererFactory(object):
         renderer was registered), type (the renderer type
         name), registry (the current application registry) and
         settings (the deployment settings dictionary). """
-        pass
+        settings = getattr(info, 'settings', None) or {}
+        self.dumps = get_json_serializer(
+            settings.get('nefertari.json_serializer'))
+        self.streaming = asbool(settings.get('nefertari.json_streaming'))
 
     def __call__(self, value, system):
         """ Call the renderer implementation with the value
@@ -45,12 +92,54 @@ class JsonRendererFactory(object):
                 response.content_type = 'application/json'
 
         # run after_calls on the value before jsonifying
-        value = self.run_after_calls(value, system)
+        with timed(request, 'after_calls'):
+            value = self.run_after_calls(value, system)
+
+        # Body of 304 Not Modified response is empty
+        if request and wrappers.not_modified(request):
+            return ''
 
         view = system['view']
         enc_class = getattr(
             view, '_json_encoder', _JSONEncoder) or _JSONEncoder
-        return json.dumps(value, cls=enc_class)
+
+        if request and self.streaming and self._is_collection(value):
+            response = request.response
+            response.app_iter = self.iter_collection(value, enc_class)
+            response.content_length = None
+            return None
+
+        with timed(request, 'render'):
+            return self.dumps(value, enc_class)
+
+    @staticmethod
+    def _is_collection(value):
+        return isinstance(value, dict) and isinstance(value.get('data'), list)
+
+    def iter_collection(self, value, enc_class):
+        """ Encode collection `value` to JSON chunk by chunk.
+
+        Yields the envelope keys first and then each item of `value['data']`
+        as it is encoded, so the response can be sent before the whole
+        collection is encoded.
+        """
+        def encode(obj):
+            data = self.dumps(obj, enc_class)
+            if isinstance(data, unicode):
+                data = data.encode('utf-8')
+            return data
+
+        envelope = dict((k, v) for k, v in value.items() if k != 'data')
+        if envelope:
+            yield encode(envelope)[:-1] + ', "data": ['
+        else:
+            yield '{"data": ['
+
+        for index, item in enumerate(value['data']):
+            data = encode(item)
+            yield data if index == 0 else ', ' + data
+
+        yield ']}'
 
     def run_after_calls(self, value, system):
         request = system.get('request')
@@ -74,5 +163,7 @@ class NefertariJsonRendererFactory(JsonRendererFactory):
             after_calls = getattr(request, 'filters', {})
             for call in after_calls.get(request.action, []):
                 value = call(**dict(request=request, result=value))
+                if wrappers.not_modified(request):
+                    break
 
         return value
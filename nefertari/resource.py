@@ -5,7 +5,7 @@ log = logging.getLogger(__name__)
 
 
 ACTIONS = ['index', 'show', 'create', 'update',
-           'delete', 'update_many', 'delete_many']
+           'delete', 'update_many', 'delete_many', 'create_many']
 DEFAULT_ID_NAME = 'id'
 
 
@@ -80,7 +80,7 @@ def add_resource_routes(config, view, member_name, collection_name, **kwargs):
     added_routes = {}
 
     def add_route_and_view(config, action, route_name, path, request_method,
-                           **route_kwargs):
+                           view_kwargs=None, **route_kwargs):
         if route_name not in added_routes:
             config.add_route(
                 route_name, path, factory=_factory,
@@ -93,7 +93,7 @@ def add_resource_routes(config, view, member_name, collection_name, **kwargs):
         config.add_view(view=view, attr=action, route_name=route_name,
                         request_method=request_method,
                         permission=action if _auth else None,
-                        **kwargs)
+                        **dict(kwargs, **(view_kwargs or {})))
         config.commit()
 
     if collection_name:
@@ -137,6 +137,11 @@ def add_resource_routes(config, view, member_name, collection_name, **kwargs):
             name_prefix + (collection_name or member_name),
             path, 'DELETE', traverse=_traverse)
 
+        add_route_and_view(
+            config, 'create_many',
+            name_prefix + (collection_name or member_name),
+            path, 'POST', view_kwargs={'json_items': True})
+
     return action_route
 
 
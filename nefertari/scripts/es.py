@@ -11,6 +11,9 @@ from nefertari.utils import dictset, split_strip, to_dicts
 from nefertari import engine
 
 
+DEFAULT_CHUNK_SIZE = 1000
+
+
 def main(argv=sys.argv, quiet=False):
     log = logging.getLogger()
     log.setLevel(logging.WARNING)
@@ -45,13 +48,28 @@ class ESCommand(object):
         parser.add_argument(
             '--params', help='Url-encoded params for each model')
         parser.add_argument('--index', help='Index name', default=None)
-        parser.add_argument('--chunk', help='Index chunk size', type=int)
+        parser.add_argument(
+            '--chunk',
+            help=('Number of documents fetched from database and indexed '
+                  'at a time'),
+            type=int, default=DEFAULT_CHUNK_SIZE)
+        parser.add_argument(
+            '--workers',
+            help='Number of bulk requests sent to ElasticSearch concurrently',
+            type=int, default=None)
         parser.add_argument(
             '--force',
             help=('Force reindexing of all documents. By default, only '
                 'documents that are missing from index are indexed.'),
             action='store_true',
             default=False)
+        parser.add_argument(
+            '--rebuild',
+            help=('Index all documents into a new index and then point '
+                  'the index name (used as an alias) to it. --models must '
+                  'list all the indexed models.'),
+            action='store_true',
+            default=False)
 
         self.options = parser.parse_args()
         if not self.options.config:
@@ -76,6 +94,13 @@ class ESCommand(object):
         ES.setup(self.settings)
         model_names = split_strip(self.options.models)
 
+        index_name = self.options.index
+        if self.options.rebuild:
+            alias = index_name or ES.settings.index_name
+            index_name = ES.create_bulk_index(alias, models=[
+                engine.get_document_cls(name) for name in model_names])
+
+        failures = 0
         for model_name in model_names:
             model = engine.get_document_cls(model_name)
 
@@ -83,16 +108,69 @@ class ESCommand(object):
             params = dict([
                 [k, v[0]] for k, v in urlparse.parse_qs(params).items()
             ])
-            params.setdefault('_limit', params.get('_limit', 10000))
-            chunk_size = self.options.chunk or params['_limit']
+            chunk_size = self.options.chunk
+
+            es = ES(source=model_name, index_name=index_name,
+                    bulk_workers=self.options.workers)
+            for documents in iter_documents(model, params, chunk_size):
+                if self.options.force or self.options.rebuild:
+                    failed = es.index(documents, chunk_size=chunk_size)
+                else:
+                    failed = es.index_missing_documents(
+                        documents, chunk_size=chunk_size)
+                failures += len(failed or [])
+
+        if failures:
+            self.log.error('Failed to index %s documents' % failures)
+            if self.options.rebuild:
+                self.log.error(
+                    'Alias `%s` is not switched to index `%s`' % (
+                        alias, index_name))
+            return 1
+
+        if self.options.rebuild:
+            ES.swap_alias(alias, index_name)
 
-            es = ES(source=model_name, index_name=self.options.index)
-            query_set = model.get_collection(**params)
-            documents = to_dicts(query_set)
+        return 0
 
-            if self.options.force:
-                es.index(documents, chunk_size=chunk_size)
-            else:
-                es.index_missing_documents(documents, chunk_size=chunk_size)
 
-        return 0
+def iter_documents(model, params, chunk_size):
+    """ Yield documents of `model` as lists of at most `chunk_size` dicts.
+
+    Collection is paged through using `_start`/`_limit`, so only one page
+    of documents is held in memory at a time. Pages are sorted by primary
+    key unless `_sort` is present in `params`. If `params` contain `_limit`,
+    it limits the total number of documents yielded. `_page` of `_limit`
+    documents may be used instead of `_start`.
+    """
+    params = params.copy()
+    total = params.pop('_limit', None)
+    if total is not None:
+        total = int(total)
+    if '_page' in params:
+        if '_start' in params:
+            raise ValueError(
+                'Can not specify _start and _page at the same time')
+        if total is None:
+            raise ValueError('_page requires _limit')
+        params['_start'] = int(params.pop('_page')) * total
+    start = int(params.pop('_start', 0))
+    params.setdefault('_sort', model.pk_field())
+    yielded = 0
+
+    while total is None or yielded < total:
+        limit = chunk_size
+        if total is not None:
+            limit = min(limit, total - yielded)
+
+        query_set = model.get_collection(_start=start, _limit=limit, **params)
+        documents = to_dicts(query_set)
+        if not documents:
+            break
+
+        yield documents
+
+        if len(documents) < limit:
+            break
+        start += len(documents)
+        yielded += len(documents)
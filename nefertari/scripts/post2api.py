@@ -1,65 +1,298 @@
 #!/usr/bin/env python
 import json
+import time
+import threading
 import requests
 import sys
 import getopt
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+
+from requests.adapters import HTTPAdapter
+
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+_print_lock = threading.Lock()
 
 
 def _jdefault(obj):
     return obj.__dict__
 
 
-def load(inputfile, destination):
-    json_file = open(inputfile)
-    json_data = json.load(json_file)
+def _print(msg):
+    with _print_lock:
+        print(msg)
+
+
+def make_session(workers=1):
+    """ Create session which keeps a connection for each worker. """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Content-type'] = 'application/json'
+    return session
+
+
+class RateLimiter(object):
+    """ Spread requests so that at most `rate` are sent per second. """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class Stats(object):
+    """ Counts of posted objects used to print a summary. """
+    def __init__(self):
+        self.posted = 0
+        self.failed = 0
+        self.retried = 0
+        self.start = time.time()
+        self._lock = threading.Lock()
+
+    def add(self, ok, retries):
+        with self._lock:
+            if ok:
+                self.posted += 1
+            else:
+                self.failed += 1
+            self.retried += retries
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        total = self.posted + self.failed
+        return ('Posted {} of {} objects in {:.1f} seconds ({:.1f}/s). '
+                'Failed: {}. Retried requests: {}'.format(
+                    self.posted, total, elapsed,
+                    total / elapsed if elapsed else 0,
+                    self.failed, self.retried))
+
+
+class Poster(object):
+    """ POST objects to the API from a pool of workers.
+
+    Requests failed with a connection error or a 5xx status are retried
+    up to `retries` times, waiting `backoff` seconds before the first
+    retry and twice as long before each next one.
+    """
+    def __init__(self, workers=1, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, rate=None):
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.session = make_session(workers)
+        self.limiter = RateLimiter(rate)
+        self.stats = Stats()
+
+    def post(self, url, obj):
+        """ POST `obj` to `url` and record the result in `self.stats`. """
+        data = json.dumps(obj, default=_jdefault)
+        attempt = 0
+        while True:
+            self.limiter.wait()
+            try:
+                response = self.session.post(url, data=data)
+            except requests.RequestException as ex:
+                status = ex.__class__.__name__
+                retry = isinstance(ex, (
+                    requests.ConnectionError, requests.Timeout))
+            else:
+                status = response.status_code
+                retry = status >= 500
+
+            if not retry or attempt >= self.retries:
+                break
+            time.sleep(self.backoff * 2 ** attempt)
+            attempt += 1
 
-    for i in json_data:
-        data = json.dumps(i, default=_jdefault)
-        print('Posting: %s' % data)
-        r = requests.post(
-            destination,
-            data=data,
-            headers={'Content-type': 'application/json'})
-        print r.status_code
+        ok = isinstance(status, int) and status < 400
+        self.stats.add(ok, attempt)
+        _print('{} {}'.format(status, url) if ok else
+               'Failed to post {} to {}: {}'.format(data, url, status))
+        return ok
 
-    json_file.close()
+    def _post(self, url, obj):
+        """ POST `obj` to `url`, counting it as failed on any error. """
+        try:
+            return self.post(url, obj)
+        except Exception as ex:
+            self.stats.add(False, 0)
+            _print('Failed to post {!r} to {}: {!r}'.format(obj, url, ex))
+            return False
 
+    def post_all(self, jobs):
+        """ POST each (url, obj) pair of `jobs` iterable.
 
-def load_singular_objects(inputfile, destination):
+        At most `self.workers` requests are in flight at a time, so
+        only that many objects are held in memory.
+        """
+        if self.workers <= 1:
+            for url, obj in jobs:
+                self._post(url, obj)
+            return self.stats
+
+        in_flight = threading.BoundedSemaphore(self.workers)
+
+        def run(url, obj):
+            try:
+                self._post(url, obj)
+            finally:
+                in_flight.release()
+
+        pool = ThreadPool(self.workers)
+        try:
+            for url, obj in jobs:
+                in_flight.acquire()
+                pool.apply_async(run, (url, obj))
+        finally:
+            pool.close()
+            pool.join()
+        return self.stats
+
+
+def _iter_array(json_file, buf, chunk_size):
+    """ Yield items of JSON array from `json_file` which is read in
+    chunks. `buf` holds data read after the opening bracket.
+    """
+    decoder = json.JSONDecoder()
+    eof = False
+    expect_item = True
+    while True:
+        stripped = buf.lstrip()
+        if not stripped and not eof:
+            buf = json_file.read(chunk_size)
+            eof = not buf
+            continue
+        buf = stripped
+        if buf[:1] == ']':
+            return
+        if not expect_item:
+            if buf[:1] != ',':
+                raise ValueError('Expecting , delimiter: {!r}'.format(
+                    buf[:20]))
+            buf = buf[1:]
+            expect_item = True
+            continue
+        try:
+            obj, end = decoder.raw_decode(buf)
+        except ValueError:
+            if eof:
+                raise
+            end = None
+        # A value ending at the end of the buffer (e.g. a number) may
+        # continue in the next chunk. So may a number followed by the
+        # beginning of its fraction or exponent.
+        if end is None or not eof and (
+                end == len(buf) or
+                isinstance(obj, (int, long, float)) and buf[end] in '.eE+-'):
+            data = json_file.read(chunk_size)
+            eof = not data
+            buf += data
+            continue
+        yield obj
+        buf = buf[end:]
+        expect_item = False
+
+
+def iter_objects(json_file, chunk_size=64 * 1024):
+    """ Yield objects from `json_file` one by one.
+
+    The file may contain a JSON array of objects or one JSON object per
+    line (NDJSON). It is read in chunks of `chunk_size` bytes, so only
+    the object being parsed is held in memory.
+    """
+    buf = ''
+    while not buf.strip():
+        data = json_file.read(chunk_size)
+        if not data:
+            return
+        buf += data
+
+    buf = buf.lstrip()
+    if buf.startswith('['):
+        for obj in _iter_array(json_file, buf[1:], chunk_size):
+            yield obj
+        return
+
+    # NDJSON: first chunk may end in the middle of a line
+    lines = buf.split('\n')
+    tail = lines.pop()
+    for line in lines:
+        if line.strip():
+            yield json.loads(line)
+    for line in iter(json_file.readline, ''):
+        if tail:
+            line, tail = tail + line, ''
+        if line.strip():
+            yield json.loads(line)
+    if tail.strip():
+        yield json.loads(tail)
+
+
+def iter_parents(session, parent_route, page_size=100):
+    """ Yield objects of `parent_route` collection page by page. """
+    page = 0
+    while True:
+        parents = session.get(parent_route, params={
+            '_limit': page_size, '_page': page}).json()['data']
+        for parent in parents:
+            yield parent
+        if len(parents) < page_size:
+            return
+        page += 1
+
+
+def load(inputfile, destination, poster=None):
+    poster = poster or Poster()
+    with open(inputfile, 'rb') as json_file:
+        stats = poster.post_all(
+            (destination, obj) for obj in iter_objects(json_file))
+    print(stats.summary())
+
+
+def load_singular_objects(inputfile, destination, poster=None):
+    poster = poster or Poster()
     parent_route, dynamic_part = destination.split('{')
     parent_route = parent_route.strip('/')
     pk_field, singlular_field = dynamic_part.split('}')
     singlular_field = singlular_field.strip('/')
 
-    json_file = open(inputfile)
-    json_data = json.load(json_file)
-    objects_count = len(json_data)
-
-    query_string = '?_limit={}'.format(objects_count)
-    parent_objects = requests.get(parent_route + query_string).json()['data']
+    def jobs(json_file):
+        parents = iter_parents(poster.session, parent_route)
+        for parent, child in izip(parents, iter_objects(json_file)):
+            parent_url = parent['self'].split('?')[0]
+            yield parent_url + '/' + singlular_field, child
 
-    for parent in parent_objects:
-        print parent_route
-        parent_url = parent['self'].replace(query_string, '')
-        singular_url = parent_url + '/' + singlular_field
-        child = json_data.pop()
-        data = json.dumps(child, default=_jdefault)
-        print('Posting: {} to {}'.format(data, singular_url))
-        r = requests.post(
-            singular_url,
-            data=data,
-            headers={'Content-type': 'application/json'})
-        print r.status_code
+    with open(inputfile, 'rb') as json_file:
+        stats = poster.post_all(jobs(json_file))
+    print(stats.summary())
 
 
 def main():
     argv = sys.argv[1:]
     try:
-        opts, args = getopt.getopt(argv, 'hf:u:', ['help', 'file=', 'url='])
+        opts, args = getopt.getopt(
+            argv, 'hf:u:w:',
+            ['help', 'file=', 'url=', 'workers=', 'retries=', 'backoff=',
+             'rate='])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
 
+    poster_kwargs = {}
     for opt, arg in opts:
         if opt == '-h':
             usage()
@@ -68,6 +301,14 @@ def main():
             inputfile = arg
         elif opt in ('-u', '--url'):
             destination = arg
+        elif opt in ('-w', '--workers'):
+            poster_kwargs['workers'] = int(arg)
+        elif opt == '--retries':
+            poster_kwargs['retries'] = int(arg)
+        elif opt == '--backoff':
+            poster_kwargs['backoff'] = float(arg)
+        elif opt == '--rate':
+            poster_kwargs['rate'] = float(arg)
 
     try:
         inputfile
@@ -76,16 +317,19 @@ def main():
         usage()
         sys.exit()
 
+    poster = Poster(**poster_kwargs)
     if '{' in destination and not destination.endswith('}'):
         # E.g. /users/{username}/profile
-        load_singular_objects(inputfile, destination)
+        load_singular_objects(inputfile, destination, poster)
     else:
         # E.g. /users
-        load(inputfile, destination)
+        load(inputfile, destination, poster)
 
 
 def usage():
-    print 'Usage: nefertari.post2api -f <jsonFile> -u <urlToPost>'
+    print('Usage: nefertari.post2api -f <jsonFile> -u <urlToPost> '
+          '[-w <workers>] [--retries <n>] [--backoff <seconds>] '
+          '[--rate <requests per second>]')
 
 
 if __name__ == '__main__':
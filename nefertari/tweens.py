@@ -1,33 +1,108 @@
 import time
+import urllib
+from hashlib import md5
+from collections import OrderedDict
+from contextlib import contextmanager
 from pyramid.settings import asbool
+from pyramid.response import Response
 import logging
 import json
 
 log = logging.getLogger(__name__)
 
 
+def add_timing(request, stage, seconds):
+    """ Add :seconds: spent in :stage: to timings of :request:.
+
+    Timings are only collected when `request_timing` tween is enabled.
+    """
+    environ = getattr(request, 'environ', None)
+    timings = environ.get('nefertari.timings') if environ else None
+    if isinstance(timings, dict):
+        timings[stage] = timings.get(stage, 0) + seconds
+
+
+@contextmanager
+def timed(request, stage):
+    """ Add time spent in the block to :stage: timing of :request:. """
+    start = time.time()
+    try:
+        yield
+    finally:
+        add_timing(request, stage, time.time() - start)
+
+
+def format_server_timing(timings):
+    """ Format :timings: in seconds as a Server-Timing header value. """
+    return ', '.join(
+        '{};dur={:.1f}'.format(stage, seconds * 1000)
+        for stage, seconds in timings.items())
+
+
 def request_timing(handler, registry):
+    """ Log time requests take and report it per stage.
+
+    Time spent in each stage of the request (view init, before calls,
+    action, ES requests, after calls, rendering) is sent in the
+    Server-Timing header of the response and in `timings` field of the
+    log record, in milliseconds. Set
+    `request_timing.server_timing = false` to not send the header.
+    """
     threshold = float(registry.settings.get(
         'request_timing.slow_request_threshold', 2))
+    server_timing = asbool(registry.settings.get(
+        'request_timing.server_timing', True))
     log.info('request_timing enabled: slow_request_threshold = %s' % threshold)
 
     def timing(request):
+        timings = request.environ['nefertari.timings'] = OrderedDict()
+        response = None
 
         start = time.time()
         try:
-            return handler(request)
+            response = handler(request)
+            return response
         finally:
             delta = time.time() - start
+            timings['total'] = delta
+            if server_timing and response is not None:
+                response.headerlist.append(
+                    ('Server-Timing', format_server_timing(timings)))
+
             msg = '%s (%s) request took %s seconds' % (
                 request.method, request.url, delta)
+            extra = {'timings': dict(
+                (stage, round(seconds * 1000, 1))
+                for stage, seconds in timings.items())}
             if delta > threshold:
-                log.warning(msg)
+                log.warning(msg, extra=extra)
             else:
-                log.debug(msg)
+                log.debug(msg, extra=extra)
 
     return timing
 
 
+def request_metrics(handler, registry):
+    """ Record count, status and latency of requests by route and action
+    in the in-process metrics registry.
+
+    Metrics are exposed by `nefertari.utility_views.MetricsView`.
+    """
+    from nefertari import metrics
+    log.info('request_metrics enabled')
+
+    def request_metrics(request):
+        response = None
+        start = time.time()
+        try:
+            response = handler(request)
+            return response
+        finally:
+            metrics.observe_request(request, response, time.time() - start)
+
+    return request_metrics
+
+
 def get_tunneling(handler, registry):
     """
     This allows all methods to be tunneled via GET for dev/debuging purposes.
@@ -109,6 +184,89 @@ def cache_control(handler, registry):
     return cache_control
 
 
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def _response_cache_key(request):
+    principals = sorted(_utf8(p) for p in request.effective_principals)
+    params = sorted(
+        (_utf8(name), _utf8(value)) for name, value in request.GET.items())
+    key = '|'.join([
+        # Cached bodies contain URLs with host and scheme of the request
+        _utf8(request.path_url),
+        urllib.urlencode(params),
+        _utf8(request.headers.get('Accept', '')),
+        ','.join(principals),
+    ])
+    return 'response:' + md5(key).hexdigest()
+
+
+def response_cache(handler, registry):
+    """ Cache responses to GET requests which read documents from ES.
+
+    Responses are cached by URL, query params, Accept header and
+    principals of the user. Entries are invalidated when documents of
+    types they were built from are indexed or deleted, and expire after
+    `response_cache.ttl` seconds. Scroll pages are not cached.
+    Responses are not cached for
+    `response_cache.refresh_interval` seconds (1 by default) after
+    documents change, so set it to the refresh interval of the index.
+
+    In-process LRU cache of `response_cache.max_size` entries is used by
+    default. Set `response_cache.backend` to a dotted path of a class
+    with `MemoryCache` interface to share the cache between processes.
+    """
+    from nefertari.cache import MemoryCache, ResponseCache
+    from nefertari.elasticsearch import documents_changed
+    from nefertari.utils import dictset, maybe_dotted
+
+    settings = dictset(registry.settings).mget('response_cache')
+    backend_cls = maybe_dotted(settings.get('backend', MemoryCache))
+    cache = ResponseCache(
+        backend_cls.from_settings(settings),
+        ttl=settings.asfloat('ttl', 60),
+        refresh_interval=settings.asfloat('refresh_interval', 1))
+    log.info('response_cache enabled: backend = %s, ttl = %s' % (
+        backend_cls.__name__, cache.ttl))
+
+    def invalidate(doc_type):
+        cache.invalidate(doc_type)
+
+    documents_changed.connect(invalidate, weak=False)
+
+    def response_cache(request):
+        # Scroll pages are requested with the same scroll ID over and over
+        if request.method != 'GET' or any(
+                param in request.GET for param in ('_scroll', '_scroll_id')):
+            return handler(request)
+
+        key = _response_cache_key(request)
+        cached = cache.get(key)
+        if cached is not None:
+            status, headerlist, body = cached
+            response = Response(
+                status=status, headerlist=list(headerlist), body=body)
+            response.conditional_response = True
+            return response
+
+        # Generations of document types are taken by ES before documents
+        # are read
+        request.environ['nefertari.response_cache'] = cache
+        response = handler(request)
+        generations = request.environ.get('nefertari.es_generations')
+        if (generations and response.status_int == 200 and
+                'Set-Cookie' not in response.headers):
+            cache.set(
+                key, (response.status, response.headerlist, response.body),
+                generations)
+        return response
+
+    return response_cache
+
+
 def ssl(handler, registry):
     log.info('ssl enabled')
 
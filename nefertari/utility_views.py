@@ -1,5 +1,7 @@
 from pyramid.view import view_config
 
+from nefertari import metrics
+
 
 @view_config(name='options_view', request_method='OPTIONS',
              route_name='options')
@@ -24,3 +26,20 @@ class OptionsView(object):
                 'origin, x-requested-with, content-type'
 
         return request.response
+
+
+class MetricsView(object):
+    """ Render in-process metrics in Prometheus text format.
+
+    Registered at `nefertari.metrics_path` when that setting is set.
+    """
+    content_type = 'text/plain; version=0.0.4'
+
+    def __init__(self, request):
+        self.request = request
+
+    def __call__(self):
+        response = self.request.response
+        response.content_type = self.content_type
+        response.text = metrics.registry.render()
+        return response
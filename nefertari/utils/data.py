@@ -2,14 +2,58 @@ from nefertari.utils.dictset import dictset
 
 
 class DataProxy(object):
+    """ Object with attribute access to values of `data` dict.
+
+    Values are read from `self._data` on attribute access. Nested dicts and
+    lists of dicts are wrapped in proxies when they are first accessed and
+    are kept in `self._attrs`.
+    """
     def __init__(self, data={}):
-        self._data = dictset(data)
+        if not isinstance(data, dictset):
+            data = dictset(data)
+        self._data = data
+        self._attrs = {}
+
+    def __getattr__(self, key):
+        if key.startswith('__') or key in ('_data', '_attrs'):
+            raise AttributeError(key)
+        if key in self._attrs:
+            return self._attrs[key]
+        try:
+            val = self._data[key]
+        except KeyError:
+            raise AttributeError(key)
+
+        if isinstance(val, dict):
+            val = self._attrs[key] = dict2obj(val)
+        elif isinstance(val, list):
+            val = self._attrs[key] = [
+                dict2obj(sj) if isinstance(sj, dict) else sj for sj in val]
+        return val
+
+    def _has_objects(self):
+        """ Return True if any value of `self._data` (or an item of a list
+        value) has to be converted with `to_dict`.
+        """
+        for val in self._data.itervalues():
+            if hasattr(val, 'to_dict'):
+                return True
+            if isinstance(val, list):
+                for item in val:
+                    if hasattr(item, 'to_dict'):
+                        return True
+        return False
 
     def to_dict(self, **kwargs):
         _dict = dictset()
         _keys = kwargs.pop('_keys', [])
         __depth = kwargs.pop('__depth', 10)
 
+        # Nothing to project or convert: data is returned as is
+        if not _keys and not (__depth and self._has_objects()):
+            self._data['_type'] = self.__class__.__name__
+            return self._data
+
         data = dictset(self._data).subset(_keys) if _keys else self._data
 
         for attr, val in data.items():
@@ -28,24 +72,36 @@ class DataProxy(object):
         return _dict
 
 
+# DataProxy subclasses by `_type` name
+_proxy_classes = {}
+PROXY_CLASSES_LIMIT = 1000
+
+
+def get_proxy_class(name):
+    """ Get DataProxy subclass called `name`.
+
+    Classes are cached, so documents of the same type share one class.
+    The cache is reset when it grows over PROXY_CLASSES_LIMIT.
+    """
+    name = str(name)
+    try:
+        return _proxy_classes[name]
+    except KeyError:
+        if len(_proxy_classes) >= PROXY_CLASSES_LIMIT:
+            _proxy_classes.clear()
+        proxy_cls = _proxy_classes[name] = type(name, (DataProxy,), {})
+        return proxy_cls
+
+
 def dict2obj(data):
+    """ Wrap `data` dict in a DataProxy subclass named after `_type`.
+
+    Nested values are wrapped lazily, when they are accessed.
+    """
     if not data:
         return data
 
-    top = type(str(data.get('_type')), (DataProxy,), {})(data)
-
-    for key, val in top._data.items():
-        key = key.encode('ascii', 'ignore')
-        if isinstance(val, dict):
-            setattr(top, key, dict2obj(val))
-        elif isinstance(val, list):
-            setattr(
-                top, key,
-                [dict2obj(sj) if isinstance(sj, dict) else sj for sj in val])
-        else:
-            setattr(top, key, val)
-
-    return top
+    return get_proxy_class(data.get('_type'))(data)
 
 
 def to_objs(collection):
@@ -82,9 +138,14 @@ def obj2dict(obj, classkey=None):
     elif hasattr(obj, "__iter__"):
         return [obj2dict(v, classkey) for v in obj]
     elif hasattr(obj, "__dict__"):
+        attrs = obj.__dict__
+        if isinstance(obj, DataProxy):
+            attrs = dict(obj._data)
+            attrs.update(obj._attrs)
+            attrs.update(obj.__dict__)
         data = dictset([
             (key, obj2dict(value, classkey))
-            for key, value in obj.__dict__.iteritems()
+            for key, value in attrs.iteritems()
             if not callable(value) and not key.startswith('_')
         ])
         if classkey is not None and hasattr(obj, "__class__"):
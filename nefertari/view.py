@@ -3,6 +3,7 @@ import logging
 import urllib
 import simplejson
 from collections import defaultdict
+from contextlib import contextmanager
 from pyramid.settings import asbool
 from pyramid.request import Request
 
@@ -11,6 +12,8 @@ from nefertari.json_httpexceptions import (
 from nefertari.utils import dictset
 from nefertari import wrappers
 from nefertari.resource import ACTIONS
+from nefertari.elasticsearch import ES
+from nefertari.tweens import timed
 from nefertari import engine
 
 log = logging.getLogger(__name__)
@@ -32,7 +35,8 @@ class ViewMapper(object):
             matchdict.pop('traverse', None)
 
             # instance of BaseView (or child of)
-            view_obj = view(context, request)
+            with timed(request, 'view_init'):
+                view_obj = view(context, request)
             action = getattr(view_obj, action_name)
             request.action = action_name
 
@@ -42,8 +46,9 @@ class ViewMapper(object):
 
             try:
                 # run before_calls (validators) before running the action
-                for call in view_obj._before_calls.get(action_name, []):
-                    call(request=request)
+                with timed(request, 'before_calls'):
+                    for call in view_obj._before_calls.get(action_name, []):
+                        call(request=request)
 
             except wrappers.ValidationError, e:
                 log.error('validation error: %s', e)
@@ -53,7 +58,8 @@ class ViewMapper(object):
                 log.error('resource not found: %s', e)
                 raise JHTTPNotFound()
 
-            return action(**matchdict)
+            with timed(request, 'action'):
+                return action(**matchdict)
 
         return view_mapper_wrapper
 
@@ -97,6 +103,9 @@ class BaseView(object):
               PUT, PATCH, POST methods
           :_params: Join of _query_params and _json_params
 
+        Items of a JSON array or NDJSON request body are put into
+        `_json_items` list instead of `_json_params`.
+
         For method tunneling, _json_params contains the same data as
         _query_params.
         """
@@ -104,17 +113,30 @@ class BaseView(object):
         self.request = request
         self._query_params = dictset(_query_params or request.params.mixed())
         self._json_params = dictset(_json_params)
+        self._json_items = []
 
         ctype = request.content_type
         if request.method in ['POST', 'PUT', 'PATCH']:
-            if ctype == 'application/json':
+            if ctype == NDJSON_CONTENT_TYPE:
+                self._json_items = parse_ndjson(request.body)
+            elif ctype == 'application/json':
                 try:
-                    self._json_params.update(request.json)
+                    json_data = request.json
                 except simplejson.JSONDecodeError:
                     log.error(
                         "Expecting JSON. Received: '{}'. "
                         "Request: {} {}".format(
                             request.body, request.method, request.url))
+                else:
+                    if isinstance(json_data, list):
+                        self._json_items = json_data
+                    else:
+                        self._json_params.update(json_data)
+
+            self._json_items = [
+                BaseView.convert_dotted(item)
+                if isinstance(item, dict) else item
+                for item in self._json_items]
 
             self._json_params = BaseView.convert_dotted(self._json_params)
             self._query_params = BaseView.convert_dotted(self._query_params)
@@ -156,17 +178,46 @@ class BaseView(object):
         """ Convert object IDs from `self._json_params` to objects if needed.
 
         Only IDs tbat belong to relationship field of `self._model_class`
-        are converted.
+        are converted. IDs of fields related to the same model are
+        fetched with one query.
         """
         if not self._model_class:
             log.info("%s has no model defined" % self.__class__.__name__)
             return
 
+        fields = defaultdict(list)
         for field in self._json_params.keys():
-            if not engine.is_relationship_field(field, self._model_class):
-                continue
+            relationship = self.get_relationship(field)
+            if relationship is not None:
+                fields[relationship].append(field)
+
+        for (model_cls, pk_field), names in fields.items():
+            self.ids2objs(names, model_cls, pk_field=pk_field)
+
+    def get_relationship(self, field):
+        """ Get (related model, its pk field) of relationship :field: of
+        `self._model_class` or None if :field: is not a relationship.
+
+        Results for fields declared on the model are cached on the view
+        class, so the engine only introspects each model field once.
+        Other keys come from requests and are not cached.
+        """
+        view_cls = type(self)
+        cache = view_cls.__dict__.get('_relationships')
+        if cache is None:
+            cache = view_cls._relationships = {}
+
+        key = (self._model_class, field)
+        if key in cache:
+            return cache[key]
+
+        relationship = None
+        if engine.is_relationship_field(field, self._model_class):
             model_cls = engine.get_relationship_cls(field, self._model_class)
-            self.id2obj(field, model_cls)
+            relationship = (model_cls, model_cls.pk_field())
+        if hasattr(self._model_class, field):
+            cache[key] = relationship
+        return relationship
 
     def get_debug(self, package=None):
         if not package:
@@ -177,28 +228,16 @@ class BaseView(object):
 
     def setup_default_wrappers(self):
         root_resource = getattr(self, 'root_resource', None)
-        auth_enabled = root_resource and root_resource.auth
+        auth_enabled = bool(root_resource and root_resource.auth)
 
+        # Default wrappers of 'index' and 'show' are fused in a single
+        # after call which is shared by all the requests
         self._after_calls['index'] = [
-            wrappers.wrap_in_dict(self.request),
-            wrappers.add_meta(self.request),
-        ]
-        if auth_enabled:
-            self._after_calls['index'] += [
-                wrappers.apply_privacy(self.request),
-            ]
-        self._after_calls['index'] += [
-            wrappers.add_etag(self.request),
+            wrappers.get_fused_after_calls(privacy=auth_enabled, etag=True),
         ]
-
         self._after_calls['show'] = [
-            wrappers.wrap_in_dict(self.request),
-            wrappers.add_meta(self.request),
+            wrappers.get_fused_after_calls(privacy=auth_enabled),
         ]
-        if auth_enabled:
-            self._after_calls['show'] += [
-                wrappers.apply_privacy(self.request),
-            ]
 
         self._after_calls['delete'] = [
             wrappers.add_confirmation_url(self.request)
@@ -258,17 +297,54 @@ class BaseView(object):
         return '__confirmation' not in self._query_params
 
     def id2obj(self, name, model, pk_field=None, setdefault=None):
-        if name not in self._json_params:
+        self.ids2objs([name], model, pk_field=pk_field, setdefault=setdefault)
+
+    def ids2objs(self, names, model, pk_field=None, setdefault=None,
+                 params=None):
+        """ Convert IDs of fields :names: of `self._json_params` to
+        objects of :model:.
+
+        IDs of all the fields are fetched with a single `get_by_ids`
+        query. IDs that are not found are replaced with :setdefault:
+        if it is provided. Otherwise JHTTPBadRequest is raised.
+        Pass a list of dicts as :params: to convert their fields
+        instead of `self._json_params`.
+        """
+        if params is None:
+            params = [self._json_params]
+        fields = [(data, name) for data in params for name in names
+                  if name in data]
+        if not fields:
             return
 
         if pk_field is None:
             pk_field = model.pk_field()
 
+        ids, seen = [], set()
+        for data, name in fields:
+            value = data[name]
+            for id_ in (value if isinstance(value, list) else [value]):
+                if hasattr(id_, 'pk_field') or unicode(id_) in seen:
+                    continue
+                seen.add(unicode(id_))
+                ids.append(id_)
+
+        if len(ids) == 1:
+            objects = [model.get(**{pk_field: ids[0]})]
+        elif ids:
+            objects = model.get_by_ids(ids)
+        else:
+            objects = []
+        # IDs from request may be strings while primary keys are not
+        objects = dict(
+            (unicode(getattr(obj, pk_field)), obj)
+            for obj in objects if obj is not None)
+
         def _get_object(id_):
             if hasattr(id_, 'pk_field'):
                 return id_
 
-            obj = model.get(**{pk_field: id_})
+            obj = objects.get(unicode(id_))
             if setdefault:
                 return obj or setdefault
             else:
@@ -276,11 +352,179 @@ class BaseView(object):
                     raise JHTTPBadRequest('id2obj: Object %s not found' % id_)
                 return obj
 
-        ids = self._json_params[name]
-        if isinstance(ids, list):
-            self._json_params[name] = [_get_object(_id) for _id in ids]
-        else:
-            self._json_params[name] = _get_object(ids)
+        for data, name in fields:
+            value = data[name]
+            if isinstance(value, list):
+                data[name] = [_get_object(_id) for _id in value]
+            else:
+                data[name] = _get_object(value)
+
+
+class BulkCreateMixin(object):
+    """ Mixin for views of collections that adds `create_many` action.
+
+    `create_many` is called upon ``POST`` request to a collection with
+    a JSON array or NDJSON body. Items are created in batches of
+    `bulk_create.batch_size` (100 by default) and documents indexed
+    while a batch is saved are sent to ES in one bulk request.
+    """
+
+    def create_many(self, **kwargs):
+        """ Create objects of `self._model_class` from `self._json_items`.
+
+        Returns status of each item in order of items. Created items
+        get status 201 and their ID; failed ones get an error status
+        and message.
+        """
+        batch_size = int(self.request.registry.settings.get(
+            'bulk_create.batch_size', 100))
+        items = self._json_items
+        statuses = []
+        for start in xrange(0, len(items), batch_size):
+            statuses += self.create_batch(items[start:start + batch_size])
+        return {
+            'count': len(statuses),
+            'errors': any(item['status'] != 201 for item in statuses),
+            'items': statuses,
+        }
+
+    def create_batch(self, items):
+        """ Create objects from :items: and return their statuses. """
+        statuses = [None] * len(items)
+        valid = []
+        for index, item in enumerate(items):
+            if isinstance(item, dict):
+                valid.append(index)
+            else:
+                statuses[index] = _item_error(
+                    JHTTPBadRequest('Item must be an object'))
+
+        # Relationship IDs of all items are fetched with one query per model
+        relationships = defaultdict(set)
+        for index in valid:
+            for field in items[index]:
+                relationship = self.get_relationship(field)
+                if relationship is not None:
+                    relationships[relationship].add(field)
+        for (model_cls, pk_field), names in relationships.items():
+            self.ids2objs(
+                list(names), model_cls, pk_field=pk_field,
+                setdefault=_MISSING, params=[items[i] for i in valid])
+
+        objects = []
+        for index in valid:
+            item = items[index]
+            missing = sorted(
+                name for name, value in item.items()
+                if value is _MISSING or (
+                    isinstance(value, list) and
+                    any(val is _MISSING for val in value)))
+            if missing:
+                statuses[index] = _item_error(JHTTPBadRequest(
+                    'Related objects not found: %s' % ', '.join(missing)))
+                continue
+            try:
+                objects.append((index, self._model_class(**item)))
+            except Exception as ex:
+                statuses[index] = _item_error(ex)
+
+        with ES.defer_bulk():
+            errors = self.save_objects([obj for _, obj in objects])
+
+        for (index, obj), error in zip(objects, errors):
+            if error is None:
+                statuses[index] = {
+                    'status': 201,
+                    'id': getattr(obj, obj.pk_field()),
+                }
+            else:
+                statuses[index] = _item_error(error)
+        return statuses
+
+    def savepoint(self):
+        """ Get context manager in which changes are rolled back if it
+        fails, leaving the rest of the transaction intact.
+
+        SQLA session of the engine (`engine.Session`) is used to create
+        a savepoint when the engine has one. Otherwise objects are
+        expected to be saved on their own and nothing is done.
+        """
+        session = getattr(engine, 'Session', None)
+        if session is None:
+            return _no_savepoint()
+        return session().begin_nested()
+
+    def save_objects(self, objects):
+        """ Save new :objects: of a batch.
+
+        Each object is saved in a savepoint, so that one that fails to be
+        saved does not fail the others.
+        Returns a list with None for each saved object and an exception
+        for each object that failed to be saved. Override it to insert
+        the whole batch with one query when the engine supports that.
+        """
+        errors = []
+        for obj in objects:
+            try:
+                with self.savepoint():
+                    obj.save()
+            except Exception as ex:
+                log.error('Failed to create %s: %s', obj, ex)
+                errors.append(ex)
+            else:
+                errors.append(None)
+        return errors
+
+
+# Placeholder of related objects that were not found
+_MISSING = object()
+
+
+@contextmanager
+def _no_savepoint():
+    yield
+
+
+def _item_error(ex):
+    try:
+        error = unicode(ex)
+    except UnicodeDecodeError:
+        # Message is a non-ASCII byte string
+        error = str(ex).decode('utf-8', 'replace')
+    return {'status': getattr(ex, 'status_int', 400), 'error': error}
+
+
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+
+def is_json_items(request):
+    """ Check whether :request: body is a JSON array or NDJSON. """
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        return True
+    if request.content_type != 'application/json':
+        return False
+    return request.body.lstrip()[:1] == '['
+
+
+def parse_ndjson(body):
+    """ Parse items of NDJSON :body:, one JSON document per line. """
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+class JsonItemsPredicate(object):
+    """ View predicate that matches requests with a JSON array or NDJSON
+    body.
+    """
+    def __init__(self, val, config):
+        self.val = bool(val)
+
+    def text(self):
+        return 'json_items = %s' % self.val
+
+    phash = text
+
+    def __call__(self, context, request):
+        return is_json_items(request) == self.val
 
 
 def key_error_view(context, request):
@@ -122,34 +122,47 @@ class apply_privacy(object):
     def __init__(self, request):
         self.request = request
 
-    def _filter_fields(self, data):
-        if '_type' not in data:
-            return data
+    def _get_role(self, is_admin=None):
+        """ Get role of the request user: 'admin', 'auth' or 'public'.
+
+        None is returned if there is no request, in which case no filtering
+        is performed.
+        """
+        if not self.request:
+            return None
+        user = getattr(self.request, 'user', None)
+        if user is None:
+            return 'public'
+        if is_admin is None:
+            is_admin = type(user).is_admin(user)
+        return 'admin' if is_admin else 'auth'
+
+    def _get_fields(self, doc_type, role, plans):
+        """ Get set of fields visible to :role: for documents of
+        :doc_type:. None means all the fields are visible.
+
+        :plans: is a dict in which fields are cached per doc_type for
+        the duration of the call.
+        """
+        if doc_type in plans:
+            return plans[doc_type]
         try:
-            model_cls = engine.get_document_cls(data['_type'])
+            model_cls = engine.get_document_cls(doc_type)
         except ValueError as ex:
             log.error(str(ex))
-            return data
-
-        public_fields = set(getattr(model_cls, '_public_fields', None) or [])
-        auth_fields = set(getattr(model_cls, '_auth_fields', None) or [])
-        fields = set(data.keys())
-
-        user = getattr(self.request, 'user', None)
-        if self.request:
-            # User authenticated
-            if user:
-                # User not admin
-                if not self.is_admin:
-                    fields &= auth_fields
-
-            # User not authenticated
-            else:
-                fields &= public_fields
+            fields = None
+        else:
+            fields = get_privacy_fields(model_cls, role)
+        plans[doc_type] = fields
+        return fields
 
-        fields.add('_type')
-        fields.add('self')
-        return data.subset(fields)
+    def _filter_fields(self, data, role, plans):
+        if not isinstance(data, dict) or '_type' not in data:
+            return data
+        fields = self._get_fields(data['_type'], role, plans)
+        if fields is None:
+            return data
+        return type(data)([[k, v] for k, v in data.items() if k in fields])
 
     def __call__(self, **kwargs):
         result = kwargs['result']
@@ -158,16 +171,12 @@ class apply_privacy(object):
         data = result.get('data', result)
 
         if data:
-            self.is_admin = kwargs.get('is_admin')
-            if self.is_admin is None:
-                user = getattr(self.request, 'user', None)
-                self.is_admin = user is not None and type(user).is_admin(user)
+            role = self._get_role(kwargs.get('is_admin'))
+            plans = {}
             if issequence(data) and not isinstance(data, dict):
-                kwargs = {'is_admin': self.is_admin}
-                data = [apply_privacy(self.request)(result=d, **kwargs)
-                        for d in data]
+                data = [self._filter_fields(d, role, plans) for d in data]
             else:
-                data = self._filter_fields(data)
+                data = self._filter_fields(data, role, plans)
 
         if 'data' in result:
             result['data'] = data
@@ -176,12 +185,45 @@ class apply_privacy(object):
         return result
 
 
+# Fields visible to users of each role, by model class
+_privacy_fields = {}
+
+
+def get_privacy_fields(model_cls, role):
+    """ Get set of fields of :model_cls: visible to users of :role:.
+
+    Returns None if all the fields are visible, which is the case for
+    admins and when :role: is None (no request). Results are cached per
+    model class and role.
+    """
+    if role is None or role == 'admin':
+        return None
+    key = (model_cls, role)
+    try:
+        return _privacy_fields[key]
+    except KeyError:
+        pass
+    attr = '_auth_fields' if role == 'auth' else '_public_fields'
+    fields = frozenset(
+        list(getattr(model_cls, attr, None) or []) + ['_type', 'self'])
+    _privacy_fields[key] = fields
+    return fields
+
+
+def _get_es_etag(result):
+    """ Get ETag of :result: loaded from ES or None. """
+    # `hasattr` is used as dictset raises KeyError for missing attributes
+    return result._etag if hasattr(result, '_etag') else None
+
+
 class wrap_in_dict(object):
     """ Wraps 'result' kwarg value in dict.
 
     If object passed in 'result' kwarg has metadata in '_nefertari_meta'
     attribute, it's metadata is preserved and then applied if object
-    is converted to a sequence of dicts.
+    is converted to a sequence of dicts. ETag of a collection loaded from
+    ES is kept in `nefertari.es_etag` key of request environ for
+    `add_etag`.
 
     Conversion of object from 'result' kwargs is performed by calling
     `obj2dict` wrapper.
@@ -198,6 +240,11 @@ class wrap_in_dict(object):
         else:
             _meta = {}
 
+        es_etag = _get_es_etag(result)
+        environ = getattr(self.request, 'environ', None)
+        if es_etag and isinstance(environ, dict):
+            environ['nefertari.es_etag'] = es_etag
+
         result = obj2dict(self.request)(**kwargs)
 
         if isinstance(result, dict):
@@ -257,11 +304,45 @@ class add_confirmation_url(object):
                 q_or_a, self.request.method))
 
 
+def set_etag(request, etag):
+    """ Set ETag header of the response to :etag:.
+
+    If :etag: matches If-None-Match header of a GET or HEAD request,
+    response status is set to 304 Not Modified. Renderer then skips
+    remaining after calls and encoding of the body.
+    """
+    response = request.response
+    response.etag = etag
+    if request.method in ('GET', 'HEAD') and etag in request.if_none_match:
+        response.status_int = 304
+
+
+def not_modified(request):
+    """ Check whether response to :request: is 304 Not Modified. """
+    return request.response.status_int == 304
+
+
+def _etag_src(data):
+    return str(data.get('_version', '')) + str(data.get('id', ''))
+
+
+def _es_etag(request, es_etag, is_admin=None):
+    """ Get ETag of collection loaded from ES with :es_etag:.
+
+    Fields visible to user depend on user's role, so role is mixed in.
+    """
+    role = apply_privacy(request)._get_role(is_admin)
+    return md5('{}:{}'.format(es_etag, role)).hexdigest()
+
+
 class add_etag(object):
     """ Add ETAG header to response.
 
-    Etag is generated md5-encoding '_version' + 'id' of each object
-    in a sequence of objects returned.
+    If collection was loaded from ES, ETag computed from ES hits and role
+    of the user is used (see `ES.get_collection` and `wrap_in_dict`).
+    Otherwise ETag is generated md5-encoding '_version' + 'id' of each
+    object in a sequence of objects returned.
+    See `set_etag` for handling of conditional requests.
     """
     def __init__(self, request):
         self.request = request
@@ -269,25 +350,118 @@ class add_etag(object):
     def __call__(self, **kwargs):
         result = kwargs['result']
 
-        etag_src = ''
+        environ = getattr(self.request, 'environ', None)
+        if isinstance(environ, dict) and environ.get('nefertari.es_etag'):
+            set_etag(self.request, _es_etag(
+                self.request, environ['nefertari.es_etag'],
+                kwargs.get('is_admin')))
+            return result
+
+        etag = md5()
+        has_src = False
 
-        def etag(data):
-            return str(data.get('_version', '')) + str(data.get('id', ''))
+        def update(data):
+            src = _etag_src(data)
+            etag.update(src)
+            return bool(src)
 
         try:
-            etag_src += etag(result)
+            has_src = update(result)
 
             for each in result['data']:
-                etag_src += etag(each)
+                has_src = update(each) or has_src
 
         except (TypeError, KeyError):
             pass
 
         finally:
-            if etag_src:
-                self.request.response.etag = md5(etag_src).hexdigest()
+            if has_src:
+                set_etag(self.request, etag.hexdigest())
+            return result
+
+
+class fused_after_calls(object):
+    """ Default after calls of 'index' and 'show' actions fused in a
+    single pass over `result['data']`.
+
+    Equivalent of running `wrap_in_dict`, `add_meta`, `apply_privacy`
+    (if :privacy: is True) and `add_etag` (if :etag: is True) in this
+    order. Instances hold no per-request state and are shared by all
+    requests: request is taken from the 'request' kwarg.
+    Use `get_fused_after_calls` to get an instance.
+
+    When collection was loaded from ES, its ETag is known before the
+    data is processed, so 304 Not Modified is answered without
+    processing the data at all.
+    """
+    def __init__(self, privacy=False, etag=False):
+        self.privacy = privacy
+        self.etag = etag
+
+    def __call__(self, **kwargs):
+        request = kwargs['request']
+        result = kwargs['result']
+        role = None
+        if self.privacy:
+            privacy = apply_privacy(request)
+            role = privacy._get_role(kwargs.get('is_admin'))
+            plans = {}
+
+        es_etag = _get_es_etag(result) if self.etag else None
+        if es_etag:
+            set_etag(request, _es_etag(
+                request, es_etag, kwargs.get('is_admin')))
+            if not_modified(request):
+                return result
+
+        result = wrap_in_dict(request)(result=result)
+        if not isinstance(result, dict):
             return result
 
+        data = result.get('data')
+        if not isinstance(data, list):
+            if self.privacy and result:
+                result = privacy._filter_fields(result, role, plans)
+            if self.etag:
+                src = _etag_src(result)
+                if src:
+                    set_etag(request, md5(src).hexdigest())
+            return result
+
+        path_url = request.path_url
+        etag = md5() if self.etag and not es_etag else None
+        has_src = False
+        result['count'] = len(data)
+        for index, each in enumerate(data):
+            try:
+                each.setdefault('self', '%s/%s' % (
+                    path_url, urllib.quote(str(each['id']))))
+            except (TypeError, KeyError, AttributeError):
+                pass
+            if self.privacy:
+                each = data[index] = privacy._filter_fields(
+                    each, role, plans)
+            if etag is not None and isinstance(each, dict):
+                src = _etag_src(each)
+                etag.update(src)
+                has_src = has_src or bool(src)
+
+        if has_src:
+            set_etag(request, etag.hexdigest())
+        return result
+
+
+# Shared `fused_after_calls` instances by (privacy, etag)
+_fused_after_calls = {}
+
+
+def get_fused_after_calls(privacy=False, etag=False):
+    """ Get shared `fused_after_calls` instance for given flags. """
+    key = (bool(privacy), bool(etag))
+    if key not in _fused_after_calls:
+        _fused_after_calls[key] = fused_after_calls(*key)
+    return _fused_after_calls[key]
+
 
 class set_total(object):
     def __init__(self, request, total):
@@ -322,3 +496,7 @@ def set_public_limits(view):
     _start = _start or _page * _limit
     if _start + _limit > public_max:
         view._query_params['_limit'] = max((public_max - _start), 0)
+
+    # Scrolling would allow to page past `public_max`
+    view._query_params.pop('_scroll', None)
+    view._query_params.pop('_scroll_id', None)
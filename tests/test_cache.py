@@ -0,0 +1,105 @@
+from mock import Mock, patch
+
+from nefertari import cache
+
+
+class TestMemoryCache(object):
+
+    def test_get_set(self):
+        backend = cache.MemoryCache()
+        assert backend.get('foo') is None
+        backend.set('foo', 1)
+        assert backend.get('foo') == 1
+
+    def test_lru(self):
+        backend = cache.MemoryCache(max_size=2)
+        backend.set('foo', 1)
+        backend.set('bar', 2)
+        backend.get('foo')
+        backend.set('baz', 3)
+        assert backend.get('bar') is None
+        assert backend.get('foo') == 1
+        assert backend.get('baz') == 3
+
+    @patch('nefertari.cache.time')
+    def test_ttl(self, mock_time):
+        mock_time.time.return_value = 100
+        backend = cache.MemoryCache()
+        backend.set('foo', 1, ttl=10)
+        backend.set('bar', 2)
+        mock_time.time.return_value = 111
+        assert backend.get('foo') is None
+        assert backend.get('bar') == 2
+
+    def test_from_settings(self):
+        settings = Mock()
+        settings.asint.return_value = 5
+        backend = cache.MemoryCache.from_settings(settings)
+        settings.asint.assert_called_once_with('max_size', 1000)
+        assert backend.max_size == 5
+
+    def test_clear(self):
+        backend = cache.MemoryCache()
+        backend.set('foo', 1)
+        backend.clear()
+        assert backend.get('foo') is None
+
+
+class TestResponseCache(object):
+
+    def _set(self, responses, key, response, doc_types):
+        return responses.set(key, response, responses.generations(doc_types))
+
+    def test_get_set(self):
+        responses = cache.ResponseCache(
+            cache.MemoryCache(), ttl=10, refresh_interval=0)
+        assert responses.get('foo') is None
+        assert self._set(responses, 'foo', 'response', ['story'])
+        assert responses.get('foo') == 'response'
+
+    def test_set_ttl(self):
+        backend = Mock()
+        backend.get.return_value = 'gen:0.0'
+        responses = cache.ResponseCache(backend, ttl=10)
+        self._set(responses, 'foo', 'response', ['story'])
+        backend.set.assert_called_once_with(
+            'foo', ('response', {'story': 'gen:0.0'}), ttl=10)
+
+    def test_invalidate(self):
+        responses = cache.ResponseCache(
+            cache.MemoryCache(), refresh_interval=0)
+        self._set(responses, 'foo', 'response1', ['story'])
+        self._set(responses, 'bar', 'response2', ['user'])
+        self._set(responses, 'baz', 'response3', ['_all'])
+        responses.invalidate('story')
+        assert responses.get('foo') is None
+        assert responses.get('bar') == 'response2'
+        assert responses.get('baz') is None
+
+    def test_invalidate_while_building(self):
+        responses = cache.ResponseCache(
+            cache.MemoryCache(), refresh_interval=0)
+        generations = responses.generations(['story'])
+        responses.invalidate('story')
+        responses.set('foo', 'response', generations)
+        assert responses.get('foo') is None
+
+    @patch('nefertari.cache.time')
+    def test_set_before_refresh(self, mock_time):
+        mock_time.time.return_value = 100
+        responses = cache.ResponseCache(
+            cache.MemoryCache(), refresh_interval=1)
+        responses.invalidate('story')
+        mock_time.time.return_value = 100.5
+        assert not self._set(responses, 'foo', 'response', ['story'])
+        assert responses.get('foo') is None
+        mock_time.time.return_value = 101
+        assert self._set(responses, 'foo', 'response', ['story'])
+        assert responses.get('foo') == 'response'
+
+    def test_generation_evicted(self):
+        backend = cache.MemoryCache()
+        responses = cache.ResponseCache(backend, refresh_interval=0)
+        self._set(responses, 'foo', 'response', ['story'])
+        backend._data.pop('doc_type:story')
+        assert responses.get('foo') is None
@@ -1,10 +1,13 @@
+import json
 import logging
+import threading
+from hashlib import md5
 
 import pytest
 from mock import Mock, patch, call
 from elasticsearch.exceptions import TransportError
 
-from nefertari import elasticsearch as es
+from nefertari import elasticsearch as es, metrics
 from nefertari.json_httpexceptions import JHTTPBadRequest, JHTTPNotFound
 from nefertari.utils import dictset
 
@@ -30,6 +33,20 @@ class TestESHttpConnection(object):
         with pytest.raises(JHTTPBadRequest):
             conn.perform_request('POST', 'http://localhost:9200')
 
+    def test_perform_request_metrics(self):
+        metrics.registry.clear()
+        conn = es.ESHttpConnection()
+        conn.pool = Mock()
+        conn.pool.urlopen.return_value = Mock(data='foo', status=200)
+        conn.perform_request('GET', 'http://localhost:9200')
+        conn.pool.urlopen.side_effect = TransportError('N/A', '')
+        with pytest.raises(JHTTPBadRequest):
+            conn.perform_request('GET', 'http://localhost:9200')
+        assert metrics.ES_REQUESTS.get(method='GET', status=200) == 1
+        assert metrics.ES_REQUESTS.get(method='GET', status=400) == 1
+        counts, total = metrics.ES_REQUEST_DURATION.get(method='GET')
+        assert counts[-1] == 2
+
     @patch('nefertari.elasticsearch.log')
     def test_perform_request_no_index(self, mock_log):
         mock_log.level = logging.DEBUG
@@ -81,6 +98,68 @@ class TestHelperFunctions(object):
         qs = es.build_qs(dictset({'foo': 1, 'qoo': 2}), operator='OR')
         assert qs == 'qoo:2 OR foo:1'
 
+    def test_is_exact_value(self):
+        assert es.is_exact_value(1)
+        assert es.is_exact_value(1.5)
+        assert es.is_exact_value(True)
+        assert es.is_exact_value('foo')
+        assert es.is_exact_value(u'f\xf6o_1')
+        assert not es.is_exact_value('')
+        assert not es.is_exact_value(None)
+        assert not es.is_exact_value('foo bar')
+        assert not es.is_exact_value('foo*')
+        assert not es.is_exact_value('fuzzy~')
+        assert not es.is_exact_value('[2015-01-01 TO *]')
+
+    def test_build_query_no_filters(self):
+        query = es.build_query(
+            dictset({'foo': 1, 'bar': '_all'}), _raw_terms=' AND q:5')
+        assert query == {'query_string': {'query': 'foo:1 AND q:5'}}
+
+    def test_build_query_empty(self):
+        assert es.build_query(dictset()) == {'match_all': {}}
+
+    def test_build_query_search_fields(self):
+        query = es.build_query(dictset({'q': 'foo'}), _search_fields='a,b')
+        assert query == {'query_string': {
+            'query': 'q:foo', 'fields': ['b^1', 'a^2']}}
+
+    def test_build_query_filters(self):
+        query = es.build_query(
+            dictset({'foo': 1, 'bar': ['a', 'b'], 'zoo': 'x AND y',
+                     '__skip': 1}),
+            use_filters=True)
+        assert query['filtered']['query'] == {
+            'query_string': {'query': 'zoo:x AND y'}}
+        filters = query['filtered']['filter']['bool']['must']
+        assert sorted(filters) == sorted([
+            {'term': {'foo': 1}},
+            {'terms': {'bar': ['a', 'b']}},
+        ])
+
+    def test_build_query_filters_q(self):
+        query = es.build_query(dictset({'q': 'foo'}), use_filters=True)
+        assert query == {'query_string': {'query': 'q:foo'}}
+
+    def test_build_query_filters_only(self):
+        query = es.build_query(dictset({'foo': 1}), use_filters=True)
+        assert query == {'filtered': {
+            'query': {'match_all': {}},
+            'filter': {'bool': {'must': [{'term': {'foo': 1}}]}},
+        }}
+
+    def test_build_query_filters_raw_terms(self):
+        query = es.build_query(
+            dictset({'foo': 1}), _raw_terms=' AND q:5',
+            _search_fields='a', use_filters=True)
+        assert query['filtered']['query'] == {'query_string': {
+            'query': 'q:5', 'fields': ['a^1']}}
+
+    def test_build_query_filters_list_with_syntax(self):
+        query = es.build_query(
+            dictset({'foo': ['a', 'b*']}), use_filters=True)
+        assert query == {'query_string': {'query': 'foo:a OR foo:b*'}}
+
     def test_es_docs(self):
         assert issubclass(es._ESDocs, list)
         docs = es._ESDocs()
@@ -92,6 +171,80 @@ class TestHelperFunctions(object):
         es._bulk_body('foo')
         mock_es.api.bulk.assert_called_once_with(body='foo')
 
+    @patch('nefertari.elasticsearch._bulk_body')
+    def test_bulk_failures_no_errors(self, mock_body):
+        mock_body.return_value = {'errors': False, 'items': [
+            {'index': {'_id': 1, 'status': 201}}]}
+        assert es._bulk_failures('foo') == []
+        mock_body.assert_called_once_with('foo')
+
+    @patch('nefertari.elasticsearch._bulk_body')
+    def test_bulk_failures(self, mock_body):
+        mock_body.return_value = {'errors': True, 'items': [
+            {'index': {'_id': 1, 'status': 201}},
+            {'index': {'_id': 2, 'status': 400, 'error': 'Bad doc'}},
+        ]}
+        assert es._bulk_failures('foo') == [
+            {'_id': 2, 'status': 400, 'error': 'Bad doc'}]
+
+
+class TestSingleFlight(object):
+
+    def test_do(self):
+        flight = es.SingleFlight()
+        assert flight.do('foo', lambda x: x + 1, 1) == 2
+        assert flight._calls == {}
+
+    def test_do_concurrent(self):
+        flight = es.SingleFlight()
+        started = threading.Event()
+        waiting = threading.Event()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        class Done(threading._Event):
+            def wait(self, *args):
+                waiting.set()
+                return super(Done, self).wait(*args)
+
+        class Call(es.SingleFlight._Call):
+            def __init__(self):
+                super(Call, self).__init__()
+                self.done = Done()
+
+        def func():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        def run():
+            results.append(flight.do('foo', func))
+
+        with patch.object(es.SingleFlight, '_Call', Call):
+            leader = threading.Thread(target=run)
+            leader.start()
+            started.wait()
+            follower = threading.Thread(target=run)
+            follower.start()
+            waiting.wait()
+        release.set()
+        leader.join()
+        follower.join()
+        assert results == ['result', 'result']
+        assert calls == [1]
+
+    def test_do_error(self):
+        flight = es.SingleFlight()
+
+        def func():
+            raise ValueError('foo')
+
+        with pytest.raises(ValueError):
+            flight.do('foo', func)
+        assert flight._calls == {}
+
 
 class TestES(object):
 
@@ -101,10 +254,14 @@ class TestES(object):
         assert obj.index_name == mock_set.index_name
         assert obj.doc_type == 'foo'
         assert obj.chunk_size == 100
-        obj = es.ES(source='Foo', index_name='a', chunk_size=2)
+        assert obj.bulk_workers == 1
+        assert obj.chunk_bytes == 10 * 1024 * 1024
+        obj = es.ES(source='Foo', index_name='a', chunk_size=2,
+                    bulk_workers=4)
         assert obj.index_name == 'a'
         assert obj.doc_type == 'foo'
         assert obj.chunk_size == 2
+        assert obj.bulk_workers == 4
 
     def test_src2type(self):
         assert es.ES.src2type('FooO') == 'fooo'
@@ -126,6 +283,36 @@ class TestES(object):
             sniff_on_connection_fail=True
         )
         assert es.ES.api == mock_es.Elasticsearch()
+        assert es.ES.bulk_workers == 1
+        assert es.ES.chunk_bytes == 10 * 1024 * 1024
+        assert es.ES.use_filters is False
+        assert es.ES.count_cache is None
+
+    @patch('nefertari.elasticsearch.engine')
+    @patch('nefertari.elasticsearch.elasticsearch')
+    def test_setup_count_cache(self, mock_es, mock_engine):
+        settings = dictset({
+            'elasticsearch.hosts': '127.0.0.1:8080',
+            'elasticsearch.count_cache_ttl': '5',
+        })
+        es.ES.setup(settings)
+        assert es.ES.count_cache.ttl == 5
+        es.ES.count_cache = None
+
+    @patch('nefertari.elasticsearch.engine')
+    @patch('nefertari.elasticsearch.elasticsearch')
+    def test_setup_max_scroll(self, mock_es, mock_engine):
+        settings = dictset({
+            'elasticsearch.hosts': '127.0.0.1:8080',
+            'elasticsearch.max_scroll': '10m',
+        })
+        es.ES.setup(settings)
+        assert es.ES.max_scroll == '10m'
+        settings['elasticsearch.max_scroll'] = 'foo'
+        with pytest.raises(Exception) as ex:
+            es.ES.setup(settings)
+        assert 'Bad or missing settings' in str(ex.value)
+        es.ES.max_scroll = es.DEFAULT_MAX_SCROLL
 
     @patch('nefertari.elasticsearch.engine')
     @patch('nefertari.elasticsearch.elasticsearch')
@@ -136,6 +323,120 @@ class TestES(object):
         assert 'Bad or missing settings for elasticsearch' in str(ex.value)
         assert not mock_es.Elasticsearch.called
 
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_aliased_indices(self, mock_api):
+        mock_api.indices.get_alias.return_value = {'foo_1': {}}
+        assert es.ES.get_aliased_indices('foo') == ['foo_1']
+        mock_api.indices.get_alias.assert_called_once_with(name='foo')
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_aliased_indices_no_alias(self, mock_api):
+        mock_api.indices.get_alias.side_effect = es.IndexNotFoundException()
+        assert es.ES.get_aliased_indices('foo') == []
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_index_exists(self, mock_api):
+        mock_api.indices.exists.return_value = True
+        assert es.ES.index_exists('foo')
+        mock_api.indices.exists.side_effect = es.IndexNotFoundException()
+        assert not es.ES.index_exists('foo')
+
+    @patch('nefertari.elasticsearch.datetime')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_create_bulk_index(self, mock_api, mock_dt):
+        mock_dt.utcnow().strftime.return_value = '20150101000000'
+        mock_api.indices.get_alias.return_value = {'foo_1': {}}
+        mock_api.indices.get_mapping.return_value = {
+            'foo_1': {'mappings': {'story': {'properties': {}}}}}
+        index_name = es.ES.create_bulk_index('foo')
+        assert index_name == 'foo_20150101000000'
+        mock_api.indices.get_mapping.assert_called_once_with(index='foo_1')
+        mock_api.indices.create.assert_called_once_with(
+            index='foo_20150101000000',
+            body={
+                'settings': {'index': {
+                    'refresh_interval': '-1',
+                    'number_of_replicas': 0,
+                }},
+                'mappings': {'story': {'properties': {}}},
+            })
+
+    @patch('nefertari.elasticsearch.datetime')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_create_bulk_index_first_rebuild(self, mock_api, mock_dt):
+        mock_dt.utcnow().strftime.return_value = '20150101000000'
+        mock_api.indices.get_alias.side_effect = es.IndexNotFoundException()
+        mock_api.indices.exists.return_value = False
+
+        class Story(object):
+            @classmethod
+            def get_es_mapping(cls):
+                return {'Story': {'properties': {'name': {
+                    'type': 'string', 'index': 'not_analyzed'}}}}
+
+        class User(object):
+            pass
+
+        with patch.object(es, 'log') as mock_log:
+            es.ES.create_bulk_index('foo', models=[Story, User])
+        assert not mock_api.indices.get_mapping.called
+        body = mock_api.indices.create.call_args[1]['body']
+        assert body['mappings'] == {'story': {'properties': {'name': {
+            'type': 'string', 'index': 'not_analyzed'}}}}
+        assert mock_log.warning.call_count == 1
+        assert '`user`' in mock_log.warning.call_args[0][0]
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_create_bulk_index_model_mapping_overrides(self, mock_api):
+        mock_api.indices.get_alias.return_value = {'foo_1': {}}
+        mock_api.indices.get_mapping.return_value = {'foo_1': {'mappings': {
+            'story': {'properties': {}}, 'user': {'properties': {}}}}}
+        story = Mock(__name__='Story')
+        story.get_es_mapping.return_value = {
+            'story': {'properties': {'name': {}}}}
+        es.ES.create_bulk_index('foo', models=[story])
+        body = mock_api.indices.create.call_args[1]['body']
+        assert body['mappings'] == {
+            'story': {'properties': {'name': {}}},
+            'user': {'properties': {}}}
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_create_bulk_index_not_alias(self, mock_api):
+        mock_api.indices.get_alias.return_value = {}
+        mock_api.indices.exists.return_value = True
+        with pytest.raises(Exception) as ex:
+            es.ES.create_bulk_index('foo')
+        assert 'exists and is not an alias' in str(ex.value)
+        assert not mock_api.indices.create.called
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_swap_alias(self, mock_api):
+        mock_api.indices.get_alias.return_value = {'foo_1': {}, 'foo_2': {}}
+        mock_api.indices.get_settings.return_value = {
+            'foo_1': {'settings': {'index': {'number_of_replicas': '2'}}}}
+        old_indices = es.ES.swap_alias('foo', 'foo_2')
+        assert old_indices == ['foo_1']
+        mock_api.indices.put_settings.assert_called_once_with(
+            index='foo_2', body={'index': {
+                'refresh_interval': '1s', 'number_of_replicas': '2'}})
+        mock_api.indices.refresh.assert_called_once_with(index='foo_2')
+        mock_api.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'foo_1', 'alias': 'foo'}},
+                {'add': {'index': 'foo_2', 'alias': 'foo'}},
+            ]})
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_swap_alias_no_alias(self, mock_api):
+        mock_api.indices.get_alias.side_effect = es.IndexNotFoundException()
+        assert es.ES.swap_alias('foo', 'foo_2') == []
+        assert not mock_api.indices.get_settings.called
+        mock_api.indices.put_settings.assert_called_once_with(
+            index='foo_2', body={'index': {
+                'refresh_interval': '1s', 'number_of_replicas': 1}})
+        mock_api.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'add': {'index': 'foo_2', 'alias': 'foo'}}]})
+
     def test_process_chunks(self):
         obj = es.ES('Foo', 'foondex')
         operation = Mock()
@@ -156,6 +457,28 @@ class TestES(object):
         obj.process_chunks([], operation, chunk_size=3)
         assert not operation.called
 
+    def test_process_chunks_results(self):
+        obj = es.ES('Foo', 'foondex')
+        results = obj.process_chunks([1, 2, 3, 4, 5], sum, chunk_size=2)
+        assert results == [3, 7, 5]
+
+    def test_process_chunks_workers(self):
+        obj = es.ES('Foo', 'foondex')
+        documents = range(1, 11)
+        results = obj.process_chunks(documents, sum, chunk_size=3, workers=3)
+        assert results == [6, 15, 24, 10]
+
+    def test_process_chunks_workers_error(self):
+        obj = es.ES('Foo', 'foondex')
+
+        def operation(chunk):
+            if 4 in chunk:
+                raise ValueError('foo')
+            return chunk
+
+        with pytest.raises(ValueError):
+            obj.process_chunks(range(10), operation, chunk_size=3, workers=2)
+
     def test_prep_bulk_documents_not_dict(self):
         obj = es.ES('Foo', 'foondex')
         with pytest.raises(ValueError) as ex:
@@ -202,9 +525,11 @@ class TestES(object):
         assert obj._bulk('myaction', []) is None
 
     @patch('nefertari.elasticsearch.ES.prep_bulk_documents')
-    @patch('nefertari.elasticsearch.ES.process_chunks')
-    def test_bulk(self, mock_proc, mock_prep):
-        obj = es.ES('Foo', 'foondex', chunk_size=1)
+    @patch('nefertari.elasticsearch.ES.split_bulk_body')
+    @patch('nefertari.elasticsearch.ES.apply_to_chunks')
+    def test_bulk(self, mock_apply, mock_split, mock_prep):
+        obj = es.ES('Foo', 'foondex', chunk_size=1, bulk_workers=3,
+                    chunk_bytes=100)
         docs = [
             [{'delete': {'action': 'delete', '_id': 'story1'}},
              {'_type': 'Story', 'id': 'story1', 'timestamp': 1}],
@@ -212,19 +537,124 @@ class TestES(object):
              {'_type': 'Story', 'id': 'story2', 'timestamp': 2}],
         ]
         mock_prep.return_value = docs
-        obj._bulk('myaction', docs)
+        mock_apply.return_value = [[], []]
+        assert obj._bulk('myaction', docs) == []
         mock_prep.assert_called_once_with('myaction', docs)
-        mock_proc.assert_called_once_with(
-            documents=[
-                {'delete': {'action': 'delete', '_id': 'story1'}},
-                {'index': {'action': 'index', '_id': 'story2'},
-                 '_timestamp': 2},
-                {'_type': 'Story', 'id': 'story2', 'timestamp': 2},
+        mock_split.assert_called_once_with(
+            [
+                [{'delete': {'action': 'delete', '_id': 'story1'}}],
+                [{'index': {'action': 'index', '_id': 'story2'},
+                  '_timestamp': 2},
+                 {'_type': 'Story', 'id': 'story2', 'timestamp': 2}],
             ],
-            operation=es._bulk_body,
-            chunk_size=2
+            1, 100)
+        mock_apply.assert_called_once_with(
+            chunks=mock_split(),
+            operation=es._bulk_failures,
+            workers=3,
         )
 
+    @patch('nefertari.elasticsearch.ES.prep_bulk_documents')
+    @patch('nefertari.elasticsearch.ES.split_bulk_body')
+    @patch('nefertari.elasticsearch.ES.apply_to_chunks')
+    def test_bulk_failures_returned(self, mock_apply, mock_split, mock_prep):
+        obj = es.ES('Foo', 'foondex', chunk_size=1)
+        failed = {'_type': 'story', '_id': 'story2', 'error': 'Bad doc'}
+        mock_prep.return_value = [
+            [{'index': {'action': 'index', '_id': 'story2'}},
+             {'_type': 'Story', 'id': 'story2'}],
+        ]
+        mock_apply.return_value = [[], [failed]]
+        assert obj._bulk('index', ['a']) == [failed]
+
+    @patch('nefertari.elasticsearch.ES.settings')
+    @patch('nefertari.elasticsearch.ES._send_bulk')
+    def test_defer_bulk(self, mock_send, mock_settings):
+        story = es.ES('Story', 'foondex')
+        user = es.ES('User', 'foondex')
+        with es.ES.defer_bulk():
+            assert story._bulk('index', [{'id': 1}]) == []
+            with es.ES.defer_bulk():
+                user._bulk('delete', [{'id': 2}])
+            assert not mock_send.called
+        mock_send.assert_called_once_with([
+            [{'index': {'action': 'index', '_index': 'foondex',
+                        '_type': 'story', '_id': 1}}, {'id': 1}],
+            [{'delete': {'action': 'delete', '_index': 'foondex',
+                         '_type': 'user', '_id': 2}}],
+        ], chunk_size=2)
+        assert es.ES._deferred.body is None
+
+    @patch('nefertari.elasticsearch.ES._send_bulk')
+    def test_defer_bulk_error(self, mock_send):
+        with pytest.raises(ValueError):
+            with es.ES.defer_bulk():
+                es.ES('Story', 'foondex')._bulk('index', [{'id': 1}])
+                raise ValueError()
+        assert not mock_send.called
+        es.ES('Story', 'foondex')._bulk('index', [{'id': 1}])
+        assert mock_send.call_count == 1
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_split_bulk_body_by_count(self, mock_api):
+        mock_api.transport.serializer.dumps = json.dumps
+        obj = es.ES('Foo', 'foondex')
+        body = [[{'delete': {'_id': 1}}],
+                [{'index': {'_id': 2}}, {'id': 2}],
+                [{'delete': {'_id': 3}}]]
+        chunks = list(obj.split_bulk_body(body, 2, 1000))
+        assert chunks == [
+            '{"delete": {"_id": 1}}\n'
+            '{"index": {"_id": 2}}\n{"id": 2}\n',
+            '{"delete": {"_id": 3}}\n',
+        ]
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_split_bulk_body_by_bytes(self, mock_api):
+        mock_api.transport.serializer.dumps = json.dumps
+        obj = es.ES('Foo', 'foondex')
+        body = [[{'index': {'_id': 1}}, {'name': 'a' * 50}],
+                [{'delete': {'_id': 2}}],
+                [{'delete': {'_id': 3}}],
+                [{'index': {'_id': 4}}, {'name': 'b' * 100}]]
+        chunks = list(obj.split_bulk_body(body, 100, 100))
+        assert len(chunks) == 3
+        assert chunks[0].count('\n') == 2
+        assert chunks[1].count('\n') == 2
+        assert chunks[2].count('\n') == 2
+        assert 'b' * 100 in chunks[2]
+        assert all(len(chunk) <= 100 for chunk in chunks[:2])
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_split_bulk_body_unicode(self, mock_api):
+        mock_api.transport.serializer.dumps = lambda d: u'\u0444'
+        obj = es.ES('Foo', 'foondex')
+        chunks = list(obj.split_bulk_body([[{}], [{}]], 100, 6))
+        assert chunks == ['\xd1\x84\n\xd1\x84\n']
+        chunks = list(obj.split_bulk_body([[{}], [{}]], 100, 5))
+        assert chunks == ['\xd1\x84\n', '\xd1\x84\n']
+
+    def test_apply_to_chunks(self):
+        obj = es.ES('Foo', 'foondex')
+        chunks = iter([[1, 2], [3]])
+        assert obj.apply_to_chunks(chunks, sum) == [3, 3]
+
+    @patch('nefertari.elasticsearch.ES.get_pool')
+    def test_apply_to_chunks_single_chunk_inline(self, mock_pool):
+        obj = es.ES('Foo', 'foondex')
+        assert obj.apply_to_chunks(iter([[1, 2]]), sum, workers=4) == [3]
+        assert obj.apply_to_chunks(iter([]), sum, workers=4) == []
+        assert not mock_pool.called
+
+    def test_apply_to_chunks_workers(self):
+        obj = es.ES('Foo', 'foondex')
+        chunks = iter([[1, 2], [3], [4, 5], [6]])
+        assert obj.apply_to_chunks(chunks, sum, workers=2) == [3, 3, 9, 6]
+        pool = es.ES.get_pool(2)
+        assert obj.apply_to_chunks(
+            iter([[1], [2]]), sum, workers=2) == [1, 2]
+        assert es.ES.get_pool(2) is pool
+
     @patch('nefertari.elasticsearch.ES.prep_bulk_documents')
     @patch('nefertari.elasticsearch.ES.process_chunks')
     def test_bulk_no_prepared_docs(self, mock_proc, mock_prep):
@@ -417,12 +847,67 @@ class TestES(object):
             raise Exception('Unexpected error')
         assert len(docs) == 0
 
+    @patch('nefertari.elasticsearch.ES.api.mget')
+    def test_get_by_ids_duplicate_ids(self, mock_mget):
+        obj = es.ES('Foo', 'foondex')
+        documents = [{'_id': 1, '_type': 'Story'},
+                     {'_id': '1', '_type': 'Story'}]
+        mock_mget.return_value = {
+            'docs': [{'_type': 'story', '_id': '1',
+                      '_source': {'id': 1, 'name': 'bar'}}]
+        }
+        docs = obj.get_by_ids(documents)
+        mock_mget.assert_called_once_with(
+            body={'docs': [{'_index': 'foondex', '_type': 'story', '_id': 1}]}
+        )
+        assert len(docs) == 2
+        assert docs[0].name == docs[1].name == 'bar'
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api.mget')
+    def test_get_by_ids_request_cache(self, mock_mget, mock_req):
+        mock_req.return_value = Mock(environ={})
+        obj = es.ES('Foo', 'foondex')
+        mock_mget.return_value = {
+            'docs': [
+                {'_type': 'story', '_id': '1', '_source': {'id': 1}},
+                {'_type': 'story', '_id': '2'},
+            ]
+        }
+        docs = obj.get_by_ids([{'_id': 1, '_type': 'Story'},
+                               {'_id': 2, '_type': 'Story'}])
+        assert len(docs) == 1
+        mock_mget.return_value = {
+            'docs': [{'_type': 'story', '_id': '3', '_source': {'id': 3}}]
+        }
+        docs = obj.get_by_ids([{'_id': 3, '_type': 'Story'},
+                               {'_id': 2, '_type': 'Story'},
+                               {'_id': 1, '_type': 'Story'}])
+        mock_mget.assert_called_with(
+            body={'docs': [{'_index': 'foondex', '_type': 'story', '_id': 3}]}
+        )
+        assert [d.id for d in docs] == [3, 1]
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api.mget')
+    def test_get_by_ids_request_cache_fields(self, mock_mget, mock_req):
+        mock_req.return_value = Mock(environ={})
+        obj = es.ES('Foo', 'foondex')
+        mock_mget.return_value = {
+            'docs': [{'_type': 'story', '_id': '1', '_source': {'id': 1},
+                      'fields': {'name': 'foo'}}]
+        }
+        obj.get_by_ids([{'_id': 1, '_type': 'Story'}])
+        obj.get_by_ids([{'_id': 1, '_type': 'Story'}], _fields=['name'])
+        assert mock_mget.call_count == 2
+
     def test_build_search_params_no_body(self):
         obj = es.ES('Foo', 'foondex')
         params = obj.build_search_params(
             {'foo': 1, 'zoo': 2, '_raw_terms': ' AND q:5', '_limit': 10}
         )
-        assert params.keys() == ['body', 'doc_type', 'from_', 'size', 'index']
+        assert sorted(params.keys()) == [
+            'body', 'doc_type', 'from_', 'index', 'size', 'version']
         assert params['body'] == {
             'query': {'query_string': {'query': 'foo:1 AND zoo:2 AND q:5'}}}
         assert params['index'] == 'foondex'
@@ -431,7 +916,8 @@ class TestES(object):
     def test_build_search_params_no_body_no_qs(self):
         obj = es.ES('Foo', 'foondex')
         params = obj.build_search_params({'_limit': 10})
-        assert params.keys() == ['body', 'doc_type', 'from_', 'size', 'index']
+        assert sorted(params.keys()) == [
+            'body', 'doc_type', 'from_', 'index', 'size', 'version']
         assert params['body'] == {'query': {'match_all': {}}}
         assert params['index'] == 'foondex'
         assert params['doc_type'] == 'foo'
@@ -446,8 +932,8 @@ class TestES(object):
         obj = es.ES('Foo', 'foondex')
         params = obj.build_search_params({
             'foo': 1, '_sort': '+a,-b,c', '_limit': 10})
-        assert params.keys() == [
-            'body', 'doc_type', 'index', 'sort', 'from_', 'size']
+        assert sorted(params.keys()) == [
+            'body', 'doc_type', 'from_', 'index', 'size', 'sort', 'version']
         assert params['body'] == {
             'query': {'query_string': {'query': 'foo:1'}}}
         assert params['index'] == 'foondex'
@@ -458,8 +944,8 @@ class TestES(object):
         obj = es.ES('Foo', 'foondex')
         params = obj.build_search_params({
             'foo': 1, '_fields': ['a'], '_limit': 10})
-        assert params.keys() == [
-            'body', 'doc_type', 'index', 'fields', 'from_', 'size']
+        assert sorted(params.keys()) == [
+            'body', 'doc_type', 'fields', 'from_', 'index', 'size', 'version']
         assert params['body'] == {
             'query': {'query_string': {'query': 'foo:1'}}}
         assert params['index'] == 'foondex'
@@ -470,19 +956,76 @@ class TestES(object):
         obj = es.ES('Foo', 'foondex')
         params = obj.build_search_params({
             'foo': 1, '_search_fields': 'a,b', '_limit': 10})
-        assert params.keys() == ['body', 'doc_type', 'from_', 'size', 'index']
+        assert sorted(params.keys()) == [
+            'body', 'doc_type', 'from_', 'index', 'size', 'version']
         assert params['body'] == {'query': {'query_string': {
             'fields': ['b^1', 'a^2'],
             'query': 'foo:1'}}}
         assert params['index'] == 'foondex'
         assert params['doc_type'] == 'foo'
 
+    @patch('nefertari.elasticsearch.ES.use_filters', True)
+    def test_build_search_params_use_filters(self):
+        obj = es.ES('Foo', 'foondex')
+        params = obj.build_search_params({
+            'foo': 1, '_search_fields': 'a', '_limit': 10})
+        assert params['body'] == {'query': {'filtered': {
+            'query': {'match_all': {}},
+            'filter': {'bool': {'must': [{'term': {'foo': 1}}]}},
+        }}}
+
+    def test_build_search_params_scroll(self):
+        obj = es.ES('Foo', 'foondex')
+        params = obj.build_search_params({
+            '_limit': 10, '_start': 20, '_scroll': '5m'})
+        assert params['body'] == {'query': {'match_all': {}}}
+        assert params['from_'] == 0
+        assert params['size'] == 10
+        assert params['scroll'] == '5m'
+
+    def test_build_search_params_scroll_default(self):
+        obj = es.ES('Foo', 'foondex')
+        params = obj.build_search_params({'_limit': 10, '_scroll': ''})
+        assert params['scroll'] == '1m'
+
+    def test_build_search_params_scroll_too_long(self):
+        obj = es.ES('Foo', 'foondex')
+        with pytest.raises(JHTTPBadRequest) as ex:
+            obj.build_search_params({'_limit': 10, '_scroll': '24h'})
+        assert 'may not exceed 5m' in str(ex.value)
+        with patch.object(es.ES, 'max_scroll', '1d'):
+            params = obj.build_search_params(
+                {'_limit': 10, '_scroll': '24h'})
+        assert params['scroll'] == '24h'
+
+    def test_build_search_params_scroll_invalid(self):
+        obj = es.ES('Foo', 'foondex')
+        with pytest.raises(JHTTPBadRequest) as ex:
+            obj.build_search_params({'_limit': 10, '_scroll': '1 year'})
+        assert 'Invalid _scroll' in str(ex.value)
+
+    def test_parse_time_value(self):
+        assert es.parse_time_value('1m') == 60
+        assert es.parse_time_value('1.5h') == 5400
+        assert es.parse_time_value('2d') == 172800
+        assert es.parse_time_value('500ms') == 0.5
+        assert es.parse_time_value('1500') == 1.5
+        for value in ('', 'm', '1y', '-1m', '1 m'):
+            with pytest.raises(ValueError):
+                es.parse_time_value(value)
+
+    def test_build_search_params_version(self):
+        obj = es.ES('Foo', 'foondex')
+        params = obj.build_search_params({'_limit': 10})
+        assert params['version'] is True
+
     @patch('nefertari.elasticsearch.ES.api.count')
     def test_do_count(self, mock_count):
         obj = es.ES('Foo', 'foondex')
         mock_count.return_value = {'count': 123}
-        val = obj.do_count(
-            {'foo': 1, 'size': 2, 'from_': 0, 'sort': 'foo:asc'})
+        val = obj.do_count({
+            'foo': 1, 'size': 2, 'from_': 0, 'sort': 'foo:asc',
+            'version': True})
         assert val == 123
         mock_count.assert_called_once_with(foo=1)
 
@@ -495,6 +1038,53 @@ class TestES(object):
         assert val == 0
         mock_count.assert_called_once_with(foo=1)
 
+    @patch('nefertari.elasticsearch.ES.api.count')
+    def test_do_count_cached(self, mock_count):
+        count_cache = es.ResponseCache(
+            es.MemoryCache(), ttl=10, refresh_interval=0)
+        obj = es.ES('Foo', 'foondex')
+        mock_count.return_value = {'count': 123}
+        with patch.object(es.ES, 'count_cache', count_cache):
+            assert obj.do_count({'foo': 1, 'size': 2}) == 123
+            assert obj.do_count({'foo': 1, 'size': 3}) == 123
+            assert mock_count.call_count == 1
+            assert obj.do_count({'foo': 2}) == 123
+            assert mock_count.call_count == 2
+
+    @patch('nefertari.elasticsearch.ES.apply_to_chunks')
+    @patch('nefertari.elasticsearch.ES.split_bulk_body')
+    @patch('nefertari.elasticsearch.ES.api.count')
+    def test_do_count_cache_invalidated(self, mock_count, mock_split,
+                                        mock_apply):
+        count_cache = es.ResponseCache(
+            es.MemoryCache(), ttl=10, refresh_interval=0)
+        obj = es.ES('Foo', 'foondex')
+        mock_count.return_value = {'count': 123}
+        mock_apply.return_value = []
+        with patch.object(es.ES, 'count_cache', count_cache):
+            obj.do_count({'foo': 1})
+            es.ES('Bar', 'foondex').index([{'id': 1}])
+            obj.do_count({'foo': 1})
+            assert mock_count.call_count == 1
+            obj.index([{'id': 1}])
+            obj.do_count({'foo': 1})
+            assert mock_count.call_count == 2
+
+    @patch('nefertari.elasticsearch.ES.api.count')
+    def test_do_count_cache_changed_while_counting(self, mock_count):
+        count_cache = es.ResponseCache(
+            es.MemoryCache(), ttl=10, refresh_interval=0)
+        obj = es.ES('Foo', 'foondex')
+
+        def count(**params):
+            count_cache.invalidate('foo')
+            return {'count': 123}
+        mock_count.side_effect = count
+        with patch.object(es.ES, 'count_cache', count_cache):
+            obj.do_count({'foo': 1})
+            obj.do_count({'foo': 1})
+            assert mock_count.call_count == 2
+
     @patch('nefertari.elasticsearch.ES.build_search_params')
     @patch('nefertari.elasticsearch.ES.do_count')
     def test_get_collection_count_without_body(self, mock_count, mock_build):
@@ -513,6 +1103,31 @@ class TestES(object):
             {'body': {'foo': 'bar'}, '_count': True, 'foo': 1})
         assert not mock_build.called
 
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_search(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        obj.search({'from_': 0})
+        mock_api.search.assert_called_once_with(from_=0)
+
+    @patch('nefertari.elasticsearch.ES._searches')
+    @patch('nefertari.elasticsearch.ES.coalesce_searches', True)
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_search_coalesced(self, mock_api, mock_searches):
+        obj = es.ES('Foo', 'foondex')
+        obj.search({'from_': 0, 'body': {'a': 1}})
+        mock_searches.do.assert_called_once_with(
+            '{"body": {"a": 1}, "from_": 0}', mock_api.search,
+            from_=0, body={'a': 1})
+
+    @patch('nefertari.elasticsearch.ES._searches')
+    @patch('nefertari.elasticsearch.ES.coalesce_searches', True)
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_search_coalesced_scroll(self, mock_api, mock_searches):
+        obj = es.ES('Foo', 'foondex')
+        obj.search({'from_': 0, 'scroll': '1m'})
+        mock_api.search.assert_called_once_with(from_=0, scroll='1m')
+        assert not mock_searches.do.called
+
     @patch('nefertari.elasticsearch.ES.api.search')
     def test_get_collection_fields(self, mock_search):
         obj = es.ES('Foo', 'foondex')
@@ -556,6 +1171,39 @@ class TestES(object):
         assert docs._nefertari_meta['fields'] == ''
         assert docs._nefertari_meta['took'] == 2.8
 
+    @patch('nefertari.elasticsearch.ES.api.search')
+    def test_get_collection_etag(self, mock_search):
+        obj = es.ES('Foo', 'foondex')
+        hits = [
+            {'_source': {'id': 1}, '_score': 2, '_type': 'foo',
+             '_id': '1', '_version': 1},
+            {'_source': {'id': 2}, '_score': 2, '_type': 'foo',
+             '_id': '2', '_version': 3},
+        ]
+        mock_search.return_value = {
+            'hits': {'hits': hits, 'total': 2}, 'took': 1}
+        docs = obj.get_collection(body={'foo': 'bar'}, from_=0)
+        etag = docs._etag
+        assert etag == md5('foo/1/1;foo/2/3;').hexdigest()
+
+        hits[1]['_version'] = 4
+        docs = obj.get_collection(body={'foo': 'bar'}, from_=0)
+        assert docs._etag != etag
+
+    @patch('nefertari.elasticsearch.ES.api.search')
+    def test_get_collection_no_version_no_etag(self, mock_search):
+        obj = es.ES('Foo', 'foondex')
+        mock_search.return_value = {
+            'hits': {
+                'hits': [{'_source': {'id': 1}, '_score': 2, '_id': '1'}],
+                'total': 1,
+            },
+            'took': 1,
+        }
+        docs = obj.get_collection(body={'foo': 'bar'}, from_=0)
+        assert docs._etag is None
+        assert 'etag' not in docs._nefertari_meta
+
     @patch('nefertari.elasticsearch.ES.api.search')
     def test_get_collection_no_index_raise(self, mock_search):
         obj = es.ES('Foo', 'foondex')
@@ -611,6 +1259,87 @@ class TestES(object):
             raise Exception('Unexpected error')
         assert len(docs) == 0
 
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        mock_api.search.return_value = {
+            '_scroll_id': 'abc',
+            'hits': {
+                'hits': [{'_source': {'foo': 'bar', 'id': 1}, '_score': 2}],
+                'total': 4,
+            },
+            'took': 2.8,
+        }
+        docs = obj.get_collection(_limit=1, _scroll='1m')
+        assert mock_api.search.call_args[1]['scroll'] == '1m'
+        assert len(docs) == 1
+        assert docs._nefertari_meta['scroll_id'] == 'abc'
+        assert not mock_api.clear_scroll.called
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll_single_page(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        mock_api.search.return_value = {
+            '_scroll_id': 'abc',
+            'hits': {
+                'hits': [{'_source': {'foo': 'bar', 'id': 1}, '_score': 2}],
+                'total': 1,
+            },
+            'took': 2.8,
+        }
+        docs = obj.get_collection(_limit=10, _scroll='1m')
+        assert docs._nefertari_meta['scroll_id'] is None
+        mock_api.clear_scroll.assert_called_once_with(scroll_id='abc')
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll_id(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        mock_api.scroll.return_value = {
+            '_scroll_id': 'abcd',
+            'hits': {
+                'hits': [{'_source': {'foo': 'bar', 'id': 1}, '_score': 2}],
+                'total': 4,
+            },
+            'took': 2.8,
+        }
+        docs = obj.get_collection(_limit=1, _scroll_id='abc')
+        mock_api.scroll.assert_called_once_with(scroll_id='abc', scroll='1m')
+        assert not mock_api.search.called
+        assert len(docs) == 1
+        assert docs[0].foo == 'bar'
+        assert docs._nefertari_meta['scroll_id'] == 'abcd'
+        assert docs._nefertari_meta['total'] == 4
+        assert docs._nefertari_meta['start'] is None
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll_id_last_page(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        mock_api.scroll.return_value = {
+            '_scroll_id': 'abcd',
+            'hits': {'hits': [], 'total': 4},
+            'took': 2.8,
+        }
+        docs = obj.get_collection(_scroll_id='abc', _scroll='2m')
+        mock_api.scroll.assert_called_once_with(scroll_id='abc', scroll='2m')
+        assert len(docs) == 0
+        assert docs._nefertari_meta['scroll_id'] is None
+        mock_api.clear_scroll.assert_called_once_with(scroll_id='abcd')
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll_id_too_long(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        with pytest.raises(JHTTPBadRequest):
+            obj.get_collection(_scroll_id='abc', _scroll='24h')
+        assert not mock_api.scroll.called
+
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_collection_scroll_id_expired(self, mock_api):
+        obj = es.ES('Foo', 'foondex')
+        mock_api.scroll.side_effect = es.IndexNotFoundException()
+        with pytest.raises(JHTTPBadRequest) as ex:
+            obj.get_collection(_scroll_id='abc')
+        assert 'expired _scroll_id' in str(ex.value)
+
     @patch('nefertari.elasticsearch.ES.api.get_source')
     def test_get_resource(self, mock_get):
         obj = es.ES('Foo', 'foondex')
@@ -621,6 +1350,108 @@ class TestES(object):
         mock_get.assert_called_once_with(
             name='foo', index='foondex', doc_type='foo', ignore=404)
 
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_resource_request_cache(self, mock_api, mock_req):
+        mock_req.return_value = Mock(environ={})
+        obj = es.ES('Foo', 'foondex')
+        mock_api.get_source.return_value = {'id': 4, 'foo': 'bar'}
+        assert obj.get_resource(id=4).foo == 'bar'
+        assert obj.get_resource(id='4').foo == 'bar'
+        mock_api.get_source.assert_called_once_with(
+            id=4, index='foondex', doc_type='foo', ignore=404)
+        obj.get_by_ids([{'_id': 4, '_type': 'Foo'}])
+        assert not mock_api.mget.called
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_request_cache_non_ascii_id(self, mock_api, mock_req):
+        mock_req.return_value = Mock(environ={})
+        obj = es.ES('Foo', 'foondex')
+        mock_api.get_source.return_value = {'id': u'j\xfcrgen'}
+        assert obj.get_resource(id=u'j\xfcrgen').id == u'j\xfcrgen'
+        docs = obj.get_by_ids([
+            {'_id': u'j\xfcrgen', '_type': 'Foo'},
+            {'_id': 'j\xc3\xbcrgen', '_type': 'Foo'}])
+        assert [d.id for d in docs] == [u'j\xfcrgen', u'j\xfcrgen']
+        assert not mock_api.mget.called
+
+    @patch('nefertari.elasticsearch.ES.api.mget')
+    def test_get_by_ids_non_ascii_id(self, mock_mget):
+        obj = es.ES('Foo', 'foondex')
+        mock_mget.return_value = {'docs': [
+            {'_type': 'foo', '_id': u'j\xfcrgen',
+             '_source': {'id': u'j\xfcrgen'}}]}
+        docs = obj.get_by_ids([{'_id': u'j\xfcrgen', '_type': 'Foo'}])
+        assert docs[0].id == u'j\xfcrgen'
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_get_resource_request_cache_other_params(
+            self, mock_api, mock_req):
+        mock_req.return_value = Mock(environ={})
+        obj = es.ES('Foo', 'foondex')
+        mock_api.get_source.return_value = {'id': 4, 'foo': 'bar'}
+        obj.get_resource(id=4, routing=1)
+        obj.get_resource(id=4, routing=1)
+        assert mock_api.get_source.call_count == 2
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.apply_to_chunks')
+    @patch('nefertari.elasticsearch.ES.split_bulk_body')
+    def test_bulk_clears_request_cache(self, mock_split, mock_apply, mock_req):
+        cache = {('foondex', 'foo', '1', ()): {'id': 1}}
+        mock_req.return_value = Mock(
+            environ={'nefertari.es_documents': cache})
+        mock_apply.return_value = []
+        obj = es.ES('Foo', 'foondex')
+        obj._bulk('index', [{'id': 1}])
+        assert cache == {}
+
+    @patch('nefertari.elasticsearch.documents_changed')
+    @patch('nefertari.elasticsearch.ES.apply_to_chunks')
+    @patch('nefertari.elasticsearch.ES.split_bulk_body')
+    def test_bulk_sends_documents_changed(self, mock_split, mock_apply,
+                                          mock_signal):
+        mock_apply.return_value = []
+        obj = es.ES('Foo', 'foondex')
+        obj._bulk('index', [{'id': 1}, {'id': 2, '_type': 'Bar'}])
+        mock_signal.send.assert_has_calls(
+            [call('foo'), call('bar')], any_order=True)
+        assert mock_signal.send.call_count == 2
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_read_doc_types_tracked(self, mock_api, mock_req):
+        environ = {}
+        mock_req.return_value = Mock(environ=environ)
+        mock_api.get_source.return_value = {'id': 4}
+        mock_api.mget.return_value = {'docs': [{'_source': {'id': 1}}]}
+        mock_api.search.return_value = {
+            'hits': {'hits': [], 'total': 0}, 'took': 1}
+        es.ES('Foo', 'foondex').get_resource(id=4)
+        es.ES('Foo', 'foondex').get_by_ids([{'_id': 1, '_type': 'Bar'}])
+        es.ES('', 'foondex').get_collection(_limit=1)
+        assert environ['nefertari.es_doc_types'] == set(
+            ['foo', 'bar', '_all'])
+
+    @patch('nefertari.elasticsearch.get_current_request')
+    @patch('nefertari.elasticsearch.ES.api')
+    def test_read_generations_tracked(self, mock_api, mock_req):
+        cache = Mock()
+        cache.generations.side_effect = lambda types: dict(
+            (doc_type, 'gen1') for doc_type in types)
+        environ = {'nefertari.response_cache': cache}
+        mock_req.return_value = Mock(environ=environ)
+        mock_api.get_source.return_value = {'id': 4}
+        es.ES('Foo', 'foondex').get_resource(id=4)
+        cache.generations.side_effect = lambda types: dict(
+            (doc_type, 'gen2') for doc_type in types)
+        es.ES('Foo', 'foondex').get_resource(id=4)
+        es.ES('Bar', 'foondex').get_resource(id=4)
+        assert environ['nefertari.es_generations'] == {
+            'foo': 'gen1', 'bar': 'gen2'}
+
     @patch('nefertari.elasticsearch.ES.api.get_source')
     def test_get_resource_no_index_raise(self, mock_get):
         obj = es.ES('Foo', 'foondex')
@@ -0,0 +1,124 @@
+import pytest
+from mock import Mock
+
+from nefertari import metrics
+
+
+class TestCounter(object):
+
+    def test_inc(self):
+        counter = metrics.Counter('requests', 'Requests.', ['route'])
+        counter.inc(route='stories')
+        counter.inc(2, route='stories')
+        counter.inc(route='users')
+        assert counter.get(route='stories') == 3
+        assert counter.get(route='users') == 1
+        assert counter.get(route='foo') == 0
+
+    def test_render(self):
+        counter = metrics.Counter('requests', 'Requests.', ['route'])
+        counter.inc(route='sto"ries')
+        assert counter.render() == [
+            '# HELP requests Requests.',
+            '# TYPE requests counter',
+            'requests{route="sto\\"ries"} 1',
+        ]
+
+    def test_render_no_labels(self):
+        counter = metrics.Counter('requests', 'Requests.')
+        counter.inc()
+        assert counter.render()[-1] == 'requests 1'
+
+
+class TestHistogram(object):
+
+    def test_observe(self):
+        hist = metrics.Histogram('time', 'Time.', ['route'], buckets=[1, 0.1])
+        assert hist.buckets == (0.1, 1, float('inf'))
+        hist.observe(0.05, route='stories')
+        hist.observe(0.5, route='stories')
+        hist.observe(1, route='stories')
+        hist.observe(5, route='stories')
+        assert hist.get(route='stories') == ([1, 3, 4], 6.55)
+        assert hist.get(route='users') is None
+
+    def test_render(self):
+        hist = metrics.Histogram('time', 'Time.', ['route'], buckets=[0.1])
+        hist.observe(0.5, route='stories')
+        assert hist.render() == [
+            '# HELP time Time.',
+            '# TYPE time histogram',
+            'time_bucket{route="stories",le="0.1"} 0',
+            'time_bucket{route="stories",le="+Inf"} 1',
+            'time_sum{route="stories"} 0.5',
+            'time_count{route="stories"} 1',
+        ]
+
+
+class TestRegistry(object):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        counter = registry.counter('requests', 'Requests.')
+        registry.histogram('time', 'Time.')
+        counter.inc()
+        assert registry.render() == (
+            '# HELP requests Requests.\n'
+            '# TYPE requests counter\n'
+            'requests 1\n'
+            '# HELP time Time.\n'
+            '# TYPE time histogram\n')
+
+    def test_clear(self):
+        registry = metrics.Registry()
+        counter = registry.counter('requests', 'Requests.')
+        counter.inc()
+        registry.clear()
+        assert counter.get() == 0
+
+
+class TestHelpers(object):
+
+    def setup_method(self, method):
+        metrics.registry.clear()
+
+    def test_observe_request(self):
+        request = Mock(action='index')
+        request.matched_route.name = 'stories'
+        metrics.observe_request(request, Mock(status_int=200), 0.2)
+        metrics.observe_request(request, None, 0.3)
+        assert metrics.REQUESTS.get(
+            route='stories', action='index', status=200) == 1
+        assert metrics.REQUESTS.get(
+            route='stories', action='index', status=500) == 1
+        counts, total = metrics.REQUEST_DURATION.get(
+            route='stories', action='index')
+        assert counts[-1] == 2
+        assert total == 0.5
+
+    def test_observe_request_no_route(self):
+        request = Mock(matched_route=None, action=None)
+        metrics.observe_request(request, Mock(status_int=404), 0.2)
+        assert metrics.REQUESTS.get(route='', action='', status=404) == 1
+
+    def test_instrument(self):
+        class Dummy(object):
+            doc_type = 'Story'
+
+            @metrics.instrument('get_collection')
+            def get_collection(self, fail=False):
+                if fail:
+                    raise ValueError()
+                return 1
+
+        assert Dummy().get_collection() == 1
+        with pytest.raises(ValueError):
+            Dummy().get_collection(fail=True)
+        assert metrics.ES_OPERATIONS.get(
+            operation='get_collection', doc_type='Story', result='ok') == 1
+        assert metrics.ES_OPERATIONS.get(
+            operation='get_collection', doc_type='Story',
+            result='error') == 1
+        counts, total = metrics.ES_OPERATION_DURATION.get(
+            operation='get_collection', doc_type='Story')
+        assert counts[-1] == 2
@@ -12,4 +12,25 @@ class TestPyramidIntegration(unittest.TestCase):
 
         self.assertEqual(1, config.add_directive.call_count)
         self.assertEqual(2, config.add_renderer.call_count)
+        config.add_view_predicate.assert_called_once_with(
+            'json_items', 'nefertari.view.JsonItemsPredicate')
         # config.add_renderer.assert_called_with('json', JsonRendererFactory)
+
+    def test_includeme_metrics_path(self):
+        from nefertari import includeme
+
+        config = mock.Mock()
+        config.registry.settings = {'nefertari.metrics_path': '/_metrics'}
+        includeme(config)
+        config.add_route.assert_any_call(
+            'metrics', '/_metrics', request_method='GET')
+        config.add_view.assert_any_call(
+            view='nefertari.utility_views.MetricsView', route_name='metrics')
+
+    def test_includeme_no_metrics_path(self):
+        from nefertari import includeme
+
+        config = mock.Mock()
+        config.registry.settings = {}
+        includeme(config)
+        self.assertEqual(1, config.add_route.call_count)
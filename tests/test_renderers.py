@@ -85,6 +85,93 @@ class TestRenderers(unittest.TestCase):
         self.assertDictContainsSubset(self._get_dummy_expected(), result)
         self.assertEqual('application/json', request.response.content_type)
 
+    def test_JsonRendererFactory_serializers(self):
+        from nefertari.renderers import JsonRendererFactory
+
+        request = mock.MagicMock()
+        request.response.default_content_type = 'text/html'
+        request.response.content_type = 'text/html'
+        view = mock.Mock()
+        view._json_encoder = None
+        value = self._get_dummy_result()
+        value['datetime'] = self.now
+        value['date'] = self.today
+        value['obj'] = object()
+
+        outputs = []
+        for name in ('json', 'simplejson', 'auto'):
+            info = mock.Mock(
+                settings={'nefertari.json_serializer': name})
+            factory = JsonRendererFactory(info)
+            outputs.append(json.loads(factory(
+                value, {'request': request, 'view': view})))
+
+        expected = self._get_dummy_expected()
+        expected['obj'] = str(value['obj'])
+        for output in outputs:
+            self.assertDictEqual(expected, output)
+
+    def test_serializers_dictset(self):
+        from nefertari import renderers
+        from nefertari.utils import dictset
+        value = {'data': [dictset(a=1), dictset(_type='Story', b=2)]}
+        for name in ('json', 'simplejson', 'auto'):
+            dumps = renderers.get_json_serializer(name)
+            self.assertEqual(json.loads(dumps(
+                value, renderers._JSONEncoder)), {
+                'data': [{'a': 1}, {'_type': 'Story', 'b': 2}]})
+
+    def test_JsonRendererFactory_streaming(self):
+        from nefertari.renderers import JsonRendererFactory
+        request = mock.MagicMock()
+        view = mock.Mock()
+        view._json_encoder = None
+        info = mock.Mock(settings={'nefertari.json_streaming': 'true'})
+        factory = JsonRendererFactory(info)
+        value = {
+            'data': [{'id': 1, 'name': u'y\xe9'}, {'date': self.now}],
+            'count': 2,
+            'total': 10,
+        }
+        assert factory(value, {'request': request, 'view': view}) is None
+        assert request.response.content_length is None
+        chunks = list(request.response.app_iter)
+        assert len(chunks) == 4
+        assert all(isinstance(chunk, str) for chunk in chunks)
+        self.assertDictEqual(json.loads(''.join(chunks)), {
+            'data': [{'id': 1, 'name': u'y\xe9'},
+                     {'date': self.now.strftime('%Y-%m-%dT%H:%M:%SZ')}],
+            'count': 2,
+            'total': 10,
+        })
+
+    def test_JsonRendererFactory_streaming_no_envelope(self):
+        from nefertari.renderers import JsonRendererFactory, _JSONEncoder
+        factory = JsonRendererFactory(None)
+        chunks = factory.iter_collection({'data': []}, _JSONEncoder)
+        assert ''.join(chunks) == '{"data": []}'
+
+    def test_JsonRendererFactory_streaming_not_collection(self):
+        from nefertari.renderers import JsonRendererFactory
+        request = mock.MagicMock()
+        view = mock.Mock()
+        view._json_encoder = None
+        info = mock.Mock(settings={'nefertari.json_streaming': 'true'})
+        factory = JsonRendererFactory(info)
+        result = factory({'id': 1}, {'request': request, 'view': view})
+        assert json.loads(result) == {'id': 1}
+
+    def test_get_json_serializer(self):
+        from nefertari import renderers
+        assert renderers.get_json_serializer('json') is (
+            renderers._json_dumps)
+        assert renderers.get_json_serializer('simplejson') is (
+            renderers._simplejson_dumps)
+        with mock.patch.object(
+                renderers.simplejson_encoder, 'c_make_encoder', None):
+            assert renderers.get_json_serializer() is renderers._json_dumps
+        self.assertRaises(ValueError, renderers.get_json_serializer, 'foo')
+
     @mock.patch('nefertari.renderers.wrappers')
     def test_JsonRendererFactory_run_after_calls(self, mock_wrap):
         from nefertari.renderers import JsonRendererFactory
@@ -112,6 +199,32 @@ class TestRenderers(unittest.TestCase):
         processed = factory.run_after_calls('foo', {'request': request})
         assert processed == 'foo processed'
 
+    def test_NefertariJsonRendererFactory_run_after_calls_not_modified(self):
+        from nefertari.renderers import NefertariJsonRendererFactory
+        factory = NefertariJsonRendererFactory(None)
+
+        def not_modified(request, result):
+            request.response.status_int = 304
+            return result
+
+        filters = {
+            'index': [not_modified, mock.Mock()],
+        }
+        request = mock.Mock(action='index', filters=filters)
+        processed = factory.run_after_calls('foo', {'request': request})
+        assert processed == 'foo'
+        assert not filters['index'][1].called
+
+    def test_JsonRendererFactory_not_modified(self):
+        from nefertari.renderers import JsonRendererFactory
+        request = mock.MagicMock()
+        request.response.status_int = 304
+        view = mock.Mock()
+        view._json_encoder = None
+        factory = JsonRendererFactory(None)
+        value = {'data': [{'id': 1}]}
+        assert factory(value, {'request': request, 'view': view}) == ''
+
     def test_NefertariJsonRendererFactory_run_after_calls_no_filters(self):
         from nefertari.renderers import NefertariJsonRendererFactory
         factory = NefertariJsonRendererFactory(None)
@@ -212,6 +212,24 @@ class TestResourceRecognition(Test):
         result = self.app.post('/messages').body
         self.assertEqual(result, 'create')
 
+    def test_post_collection_json_object(self):
+        result = self.app.post(
+            '/messages', '{"foo": "bar"}',
+            content_type='application/json').body
+        self.assertEqual(result, 'create')
+
+    def test_post_collection_json_array(self):
+        result = self.app.post(
+            '/messages', ' [{"foo": "bar"}]',
+            content_type='application/json').body
+        self.assertEqual(result, 'create_many')
+
+    def test_post_collection_ndjson(self):
+        result = self.app.post(
+            '/messages', '{"foo": "bar"}\n{"foo": "baz"}\n',
+            content_type='application/x-ndjson').body
+        self.assertEqual(result, 'create_many')
+
     def test_get_member(self):
         result = self.app.get('/messages/1').body
         self.assertEqual(result, 'show')
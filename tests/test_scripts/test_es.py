@@ -0,0 +1,125 @@
+from argparse import Namespace
+
+import pytest
+from mock import Mock, patch
+
+from nefertari.scripts import es as es_script
+
+
+class TestESCommand(object):
+
+    def _command(self, **options):
+        command = es_script.ESCommand.__new__(es_script.ESCommand)
+        defaults = dict(
+            models='Story', params=None, index=None, chunk=10,
+            workers=None, force=False, rebuild=False)
+        defaults.update(options)
+        command.options = Namespace(**defaults)
+        command.log = Mock()
+        command.settings = {}
+        return command
+
+    @patch('nefertari.scripts.es.iter_documents')
+    @patch('nefertari.scripts.es.engine')
+    @patch('nefertari.elasticsearch.ES')
+    def test_run_rebuild(self, mock_es, mock_engine, mock_iter):
+        mock_es.create_bulk_index.return_value = 'foondex_1'
+        mock_es.return_value.index.return_value = []
+        mock_iter.return_value = [[{'id': 1}], [{'id': 2}]]
+        command = self._command(rebuild=True, index='foondex')
+        assert command.run() == 0
+        mock_es.create_bulk_index.assert_called_once_with(
+            'foondex', models=[mock_engine.get_document_cls.return_value])
+        assert mock_es.return_value.index.call_count == 2
+        mock_es.swap_alias.assert_called_once_with('foondex', 'foondex_1')
+
+    @patch('nefertari.scripts.es.iter_documents')
+    @patch('nefertari.scripts.es.engine')
+    @patch('nefertari.elasticsearch.ES')
+    def test_run_rebuild_failures(self, mock_es, mock_engine, mock_iter):
+        mock_es.create_bulk_index.return_value = 'foondex_1'
+        mock_es.return_value.index.side_effect = [
+            [{'_id': 1, 'status': 400}], []]
+        mock_iter.return_value = [[{'id': 1}], [{'id': 2}]]
+        command = self._command(rebuild=True, index='foondex')
+        assert command.run() == 1
+        assert mock_es.return_value.index.call_count == 2
+        assert not mock_es.swap_alias.called
+        assert command.log.error.call_count == 2
+
+    @patch('nefertari.scripts.es.iter_documents')
+    @patch('nefertari.scripts.es.engine')
+    @patch('nefertari.elasticsearch.ES')
+    def test_run_missing_failures(self, mock_es, mock_engine, mock_iter):
+        mock_es.return_value.index_missing_documents.return_value = [
+            {'_id': 1, 'status': 400}]
+        mock_iter.return_value = [[{'id': 1}]]
+        assert self._command().run() == 1
+
+
+@patch('nefertari.scripts.es.to_dicts', lambda documents: documents)
+class TestIterDocuments(object):
+
+    def _model(self, count):
+        model = Mock()
+        model.pk_field.return_value = 'id'
+
+        def get_collection(_start, _limit, **params):
+            return [{'id': i} for i in range(count)][_start:_start + _limit]
+        model.get_collection.side_effect = get_collection
+        return model
+
+    def _pages(self, model, params, chunk_size):
+        pages = es_script.iter_documents(model, params, chunk_size)
+        return [[doc['id'] for doc in page] for page in pages]
+
+    def test_short_last_page(self):
+        model = self._model(5)
+        assert self._pages(model, {}, 2) == [[0, 1], [2, 3], [4]]
+        assert model.get_collection.call_count == 3
+
+    def test_full_last_page(self):
+        model = self._model(4)
+        assert self._pages(model, {}, 2) == [[0, 1], [2, 3]]
+        assert model.get_collection.call_count == 3
+
+    def test_limit(self):
+        model = self._model(10)
+        assert self._pages(model, {'_limit': '5'}, 2) == [
+            [0, 1], [2, 3], [4]]
+        assert model.get_collection.call_args_list[-1][1]['_limit'] == 1
+
+    def test_start(self):
+        model = self._model(10)
+        assert self._pages(model, {'_start': '7'}, 2) == [[7, 8], [9]]
+        assert self._pages(model, {'_start': '3', '_limit': '3'}, 2) == [
+            [3, 4], [5]]
+
+    def test_default_sort(self):
+        model = self._model(1)
+        self._pages(model, {'foo': 'bar'}, 2)
+        model.get_collection.assert_called_once_with(
+            _start=0, _limit=2, _sort='id', foo='bar')
+
+    def test_sort(self):
+        model = self._model(1)
+        params = {'_sort': '-name'}
+        self._pages(model, params, 2)
+        model.get_collection.assert_called_once_with(
+            _start=0, _limit=2, _sort='-name')
+        assert params == {'_sort': '-name'}
+
+    def test_page(self):
+        model = self._model(10)
+        assert self._pages(model, {'_page': '1', '_limit': '3'}, 2) == [
+            [3, 4], [5]]
+        for call_ in model.get_collection.call_args_list:
+            assert '_page' not in call_[1]
+
+    def test_page_invalid(self):
+        model = self._model(10)
+        with pytest.raises(ValueError):
+            self._pages(model, {'_page': '1'}, 2)
+        with pytest.raises(ValueError):
+            self._pages(model, {'_page': '1', '_start': '2', '_limit': '3'}, 2)
+        assert not model.get_collection.called
@@ -0,0 +1,212 @@
+from StringIO import StringIO
+
+import pytest
+import requests
+from mock import Mock, patch, call
+
+from nefertari.scripts import post2api
+
+
+def _response(status_code):
+    return Mock(status_code=status_code)
+
+
+@patch('nefertari.scripts.post2api._print')
+class TestPoster(object):
+
+    def _poster(self, *responses, **kwargs):
+        poster = post2api.Poster(**kwargs)
+        poster.session = Mock()
+        poster.session.post.side_effect = list(responses)
+        return poster
+
+    def test_post(self, mock_print):
+        poster = self._poster(_response(201))
+        assert poster.post('http://example.com/api', {'id': 1})
+        poster.session.post.assert_called_once_with(
+            'http://example.com/api', data='{"id": 1}')
+        assert poster.stats.posted == 1
+        assert poster.stats.failed == 0
+
+    @patch('nefertari.scripts.post2api.time.sleep')
+    def test_post_retry_backoff(self, mock_sleep, mock_print):
+        poster = self._poster(
+            _response(503), requests.ConnectionError(), _response(201),
+            backoff=0.5)
+        assert poster.post('http://example.com/api', {'id': 1})
+        assert poster.session.post.call_count == 3
+        assert mock_sleep.call_args_list == [call(0.5), call(1.0)]
+        assert poster.stats.posted == 1
+        assert poster.stats.retried == 2
+
+    @patch('nefertari.scripts.post2api.time.sleep')
+    def test_post_retries_exhausted(self, mock_sleep, mock_print):
+        poster = self._poster(
+            _response(500), _response(500), _response(502), retries=2)
+        assert not poster.post('http://example.com/api', {'id': 1})
+        assert poster.session.post.call_count == 3
+        assert poster.stats.failed == 1
+        assert poster.stats.retried == 2
+
+    @patch('nefertari.scripts.post2api.time.sleep')
+    def test_post_client_error_not_retried(self, mock_sleep, mock_print):
+        poster = self._poster(_response(400))
+        assert not poster.post('http://example.com/api', {'id': 1})
+        assert poster.session.post.call_count == 1
+        assert not mock_sleep.called
+        assert poster.stats.failed == 1
+
+    @patch('nefertari.scripts.post2api.time.sleep')
+    def test_post_request_error_not_retried(self, mock_sleep, mock_print):
+        poster = self._poster(requests.exceptions.InvalidURL())
+        assert not poster.post('http://example.com/api', {'id': 1})
+        assert poster.session.post.call_count == 1
+        assert poster.stats.failed == 1
+
+    def test_post_all(self, mock_print):
+        poster = self._poster(*[_response(201)] * 5, workers=3)
+        jobs = (('http://example.com/api', {'id': i}) for i in range(5))
+        stats = poster.post_all(jobs)
+        assert stats.posted == 5
+        assert poster.session.post.call_count == 5
+
+    def test_post_all_unexpected_errors(self, mock_print):
+        for workers in (1, 3):
+            poster = self._poster(
+                _response(201), ValueError('foo'), workers=workers)
+            jobs = [
+                ('http://example.com/api', {'id': 1}),
+                ('http://example.com/api', {'id': 2}),
+                ('http://example.com/api', {'id': object()}),
+            ]
+            stats = poster.post_all(iter(jobs))
+            assert stats.posted == 1
+            assert stats.failed == 2
+
+
+class TestRateLimiter(object):
+
+    @patch('nefertari.scripts.post2api.time')
+    def test_wait(self, mock_time):
+        mock_time.time.return_value = 100
+        limiter = post2api.RateLimiter(rate=4)
+        limiter.wait()
+        assert not mock_time.sleep.called
+        limiter.wait()
+        limiter.wait()
+        assert mock_time.sleep.call_args_list == [call(0.25), call(0.5)]
+
+    @patch('nefertari.scripts.post2api.time')
+    def test_wait_after_pause(self, mock_time):
+        mock_time.time.return_value = 100
+        limiter = post2api.RateLimiter(rate=4)
+        limiter.wait()
+        mock_time.time.return_value = 101
+        limiter.wait()
+        assert not mock_time.sleep.called
+
+    @patch('nefertari.scripts.post2api.time')
+    def test_no_rate(self, mock_time):
+        limiter = post2api.RateLimiter()
+        limiter.wait()
+        limiter.wait()
+        assert not mock_time.sleep.called
+
+
+class TestStats(object):
+
+    @patch('nefertari.scripts.post2api.time')
+    def test_summary(self, mock_time):
+        mock_time.time.return_value = 100
+        stats = post2api.Stats()
+        stats.add(True, 0)
+        stats.add(True, 2)
+        stats.add(False, 3)
+        mock_time.time.return_value = 102.0
+        assert stats.summary() == (
+            'Posted 2 of 3 objects in 2.0 seconds (1.5/s). '
+            'Failed: 1. Retried requests: 5')
+
+    @patch('nefertari.scripts.post2api.time')
+    def test_summary_no_time(self, mock_time):
+        mock_time.time.return_value = 100
+        stats = post2api.Stats()
+        assert stats.summary() == (
+            'Posted 0 of 0 objects in 0.0 seconds (0.0/s). '
+            'Failed: 0. Retried requests: 0')
+
+
+class TestIterObjects(object):
+
+    def _objects(self, data, chunk_size):
+        return list(post2api.iter_objects(StringIO(data), chunk_size))
+
+    def test_array(self):
+        data = ' [{"a": 1}, {"b": [1, 2]} ,{"c": {"d": "e"}}]\n'
+        expected = [{'a': 1}, {'b': [1, 2]}, {'c': {'d': 'e'}}]
+        for chunk_size in range(1, len(data) + 1):
+            assert self._objects(data, chunk_size) == expected
+
+    def test_array_values_split(self):
+        data = '[123456, "long string", 1.5e3, -2.25E-1, true, null, 7]'
+        expected = [123456, 'long string', 1500.0, -0.225, True, None, 7]
+        for chunk_size in range(1, len(data) + 1):
+            assert self._objects(data, chunk_size) == expected
+
+    def test_ndjson(self):
+        data = '{"a": 1}\n\n{"b": "long string"}\n{"c": 123456}'
+        expected = [{'a': 1}, {'b': 'long string'}, {'c': 123456}]
+        for chunk_size in range(1, len(data) + 1):
+            assert self._objects(data, chunk_size) == expected
+            assert self._objects(data + '\n', chunk_size) == expected
+
+    def test_empty(self):
+        for data in ('', '  \n', '[]', ' [ ]\n'):
+            for chunk_size in (1, 64):
+                assert self._objects(data, chunk_size) == []
+
+    def test_malformed(self):
+        for data in ('[{"a": 1} {"b": 2}]', '[{"a": 1},', '[1, 2',
+                     '[{"a": 1', '{"a": 1}\n{"b"\n'):
+            for chunk_size in (1, 4, 64):
+                with pytest.raises(ValueError):
+                    self._objects(data, chunk_size)
+
+
+class TestLoadSingularObjects(object):
+
+    @patch('nefertari.scripts.post2api.iter_parents')
+    def test_jobs(self, mock_parents, tmpdir):
+        mock_parents.return_value = iter([
+            {'self': 'http://example.com/api/users/1?_limit=1'},
+            {'self': 'http://example.com/api/users/2'},
+            {'self': 'http://example.com/api/users/3'},
+        ])
+        inputfile = tmpdir.join('profiles.json')
+        inputfile.write('[{"bio": "foo"}, {"bio": "bar"}]')
+        poster = Mock()
+        jobs = []
+
+        def post_all(it):
+            jobs.extend(it)
+            return post2api.Stats()
+        poster.post_all.side_effect = post_all
+
+        post2api.load_singular_objects(
+            str(inputfile), '/api/users/{username}/profile', poster)
+        mock_parents.assert_called_once_with(poster.session, 'api/users')
+        assert jobs == [
+            ('http://example.com/api/users/1/profile', {'bio': 'foo'}),
+            ('http://example.com/api/users/2/profile', {'bio': 'bar'}),
+        ]
+
+    def test_iter_parents_pages(self):
+        session = Mock()
+        session.get.return_value.json.side_effect = [
+            {'data': [1, 2]}, {'data': [3]}]
+        parents = post2api.iter_parents(session, 'api/users', page_size=2)
+        assert list(parents) == [1, 2, 3]
+        assert session.get.call_args_list == [
+            call('api/users', params={'_limit': 2, '_page': 0}),
+            call('api/users', params={'_limit': 2, '_page': 1}),
+        ]
@@ -1,4 +1,7 @@
-from mock import Mock, patch
+from collections import OrderedDict
+
+import pytest
+from mock import ANY, Mock, patch
 
 from nefertari import tweens
 
@@ -26,30 +29,85 @@ class TestTweens(object):
     @patch('nefertari.tweens.log')
     def test_request_timing(self, mock_log, mock_time):
         mock_time.time = mock_timer()
-        request = Mock(method='GET', url='http://example.com')
+        request = Mock(method='GET', url='http://example.com', environ={})
         registry = Mock()
         registry.settings = {'request_timing.slow_request_threshold': 1000}
-        handler = lambda request: request
+        handler = lambda request: Mock(headerlist=[])
         timing = tweens.request_timing(handler, registry)
-        timing(request)
+        response = timing(request)
         mock_log.debug.assert_called_once_with(
-            'GET (http://example.com) request took 1 seconds')
+            'GET (http://example.com) request took 1 seconds',
+            extra={'timings': {'total': 1000.0}})
         assert not mock_log.warning.called
+        assert response.headerlist == [('Server-Timing', 'total;dur=1000.0')]
 
     @patch('nefertari.tweens.time')
     @patch('nefertari.tweens.log')
     def test_request_timing_slow_request(self, mock_log, mock_time):
         mock_time.time = mock_timer()
-        request = Mock(method='GET', url='http://example.com')
+        request = Mock(method='GET', url='http://example.com', environ={})
         registry = Mock()
         registry.settings = {'request_timing.slow_request_threshold': 0}
-        handler = lambda request: request
+        handler = lambda request: Mock(headerlist=[])
         timing = tweens.request_timing(handler, registry)
         timing(request)
         mock_log.warning.assert_called_once_with(
-            'GET (http://example.com) request took 1 seconds')
+            'GET (http://example.com) request took 1 seconds',
+            extra={'timings': {'total': 1000.0}})
         assert not mock_log.debug.called
 
+    @patch('nefertari.tweens.time')
+    @patch('nefertari.tweens.log')
+    def test_request_timing_stages(self, mock_log, mock_time):
+        mock_time.time = mock_timer()
+        request = Mock(method='GET', url='http://example.com', environ={})
+        registry = Mock()
+        registry.settings = {'request_timing.server_timing': 'false'}
+
+        def handler(request):
+            with tweens.timed(request, 'action'):
+                tweens.add_timing(request, 'es', 0.5)
+            tweens.add_timing(request, 'es', 0.25)
+            return Mock(headerlist=[])
+
+        timing = tweens.request_timing(handler, registry)
+        response = timing(request)
+        assert request.environ['nefertari.timings'].items() == [
+            ('es', 0.75), ('action', 1), ('total', 3)]
+        assert response.headerlist == []
+
+    @patch('nefertari.metrics.observe_request')
+    def test_request_metrics(self, mock_observe):
+        request = Mock()
+        response = Mock()
+        metrics = tweens.request_metrics(lambda request: response, Mock())
+        assert metrics(request) is response
+        mock_observe.assert_called_once_with(request, response, ANY)
+
+    @patch('nefertari.metrics.observe_request')
+    def test_request_metrics_error(self, mock_observe):
+        request = Mock()
+
+        def handler(request):
+            raise ValueError()
+
+        metrics = tweens.request_metrics(handler, Mock())
+        with pytest.raises(ValueError):
+            metrics(request)
+        mock_observe.assert_called_once_with(request, None, ANY)
+
+    def test_add_timing_not_enabled(self):
+        request = Mock(environ={})
+        tweens.add_timing(request, 'es', 1)
+        assert request.environ == {}
+        tweens.add_timing(None, 'es', 1)
+        tweens.add_timing(Mock(), 'es', 1)
+
+    def test_format_server_timing(self):
+        timings = OrderedDict([('es', 0.0123), ('total', 0.5)])
+        assert tweens.format_server_timing(timings) == (
+            'es;dur=12.3, total;dur=500.0')
+
     def test_get_tunneling(self):
         class GET(dict):
             def mixed(self):
@@ -250,3 +308,131 @@ class TestTweens(object):
             matchdict={'qoo': 'self'})
         context_found_subscriber(Mock(request=request))
         assert request.matchdict['qoo'] == 'self'
+
+    def _response_cache(self, handler, **settings):
+        settings.setdefault('response_cache.refresh_interval', '0')
+        registry = Mock(settings=settings)
+        with patch('nefertari.elasticsearch.documents_changed') as signal:
+            cache = tweens.response_cache(handler, registry)
+        invalidate = signal.connect.call_args[0][0]
+        return cache, invalidate
+
+    def _cache_request(self, method='GET', doc_types=('story',)):
+        return Mock(
+            method=method, path_url='http://example.com/stories',
+            GET={'_limit': '1'},
+            headers={}, effective_principals=['system.Everyone'],
+            environ={}, doc_types=doc_types)
+
+    def _cache_handler(self):
+        from pyramid.response import Response
+
+        def handler(request):
+            # Read documents the way ES does
+            cache = request.environ.get('nefertari.response_cache')
+            if cache is not None:
+                request.environ['nefertari.es_generations'] = \
+                    cache.generations(request.doc_types)
+            if handler.on_read is not None:
+                handler.on_read()
+            handler.calls += 1
+            return Response(body='{"count": %s}' % handler.calls)
+        handler.calls = 0
+        handler.on_read = None
+        return handler
+
+    def test_response_cache_hit(self):
+        handler = self._cache_handler()
+        cache, _ = self._response_cache(handler)
+        assert cache(self._cache_request()).body == '{"count": 1}'
+        response = cache(self._cache_request())
+        assert response.body == '{"count": 1}'
+        assert response.status_int == 200
+        assert handler.calls == 1
+
+    def test_response_cache_principals(self):
+        handler = self._cache_handler()
+        cache, _ = self._response_cache(handler)
+        cache(self._cache_request())
+        request = self._cache_request()
+        request.effective_principals = ['system.Everyone', 'g:admin']
+        assert cache(request).body == '{"count": 2}'
+
+    def test_response_cache_key_unicode(self):
+        request = self._cache_request()
+        request.path_url = u'http://example.com/stories/caf\xe9'
+        request.GET = {u'q': u'caf\xe9'}
+        request.effective_principals = ['system.Everyone', u'g:\xe9quipe']
+        key = tweens._response_cache_key(request)
+        assert key.startswith('response:')
+        request.GET = {u'q': u'cafe'}
+        assert tweens._response_cache_key(request) != key
+
+    def test_response_cache_host(self):
+        handler = self._cache_handler()
+        cache, _ = self._response_cache(handler)
+        cache(self._cache_request())
+        request = self._cache_request()
+        request.path_url = 'https://example.com/stories'
+        assert cache(request).body == '{"count": 2}'
+        request = self._cache_request()
+        request.path_url = 'http://internal/stories'
+        assert cache(request).body == '{"count": 3}'
+
+    def test_response_cache_invalidate(self):
+        handler = self._cache_handler()
+        cache, invalidate = self._response_cache(handler)
+        cache(self._cache_request())
+        invalidate('user')
+        assert cache(self._cache_request()).body == '{"count": 1}'
+        invalidate('story')
+        assert cache(self._cache_request()).body == '{"count": 2}'
+
+    def test_response_cache_invalidated_while_handled(self):
+        handler = self._cache_handler()
+        cache, invalidate = self._response_cache(handler)
+        handler.on_read = lambda: invalidate('story')
+        cache(self._cache_request())
+        handler.on_read = None
+        assert cache(self._cache_request()).body == '{"count": 2}'
+        assert cache(self._cache_request()).body == '{"count": 2}'
+
+    def test_response_cache_before_refresh(self):
+        handler = self._cache_handler()
+        cache, invalidate = self._response_cache(
+            handler, **{'response_cache.refresh_interval': '60'})
+        invalidate('story')
+        cache(self._cache_request())
+        assert cache(self._cache_request()).body == '{"count": 2}'
+
+    def test_response_cache_not_cached(self):
+        handler = self._cache_handler()
+        cache, _ = self._response_cache(handler)
+        cache(self._cache_request(method='POST'))
+        cache(self._cache_request(method='POST'))
+        assert handler.calls == 2
+        cache(self._cache_request(doc_types=()))
+        cache(self._cache_request(doc_types=()))
+        assert handler.calls == 4
+
+    def test_response_cache_scroll_not_cached(self):
+        handler = self._cache_handler()
+        cache, _ = self._response_cache(handler)
+        for params in ({'_scroll_id': 'abc'}, {'_scroll': '1m'}):
+            request = self._cache_request()
+            request.GET = params
+            cache(request)
+            request = self._cache_request()
+            request.GET = params
+            cache(request)
+        assert handler.calls == 4
+
+    def test_response_cache_backend(self):
+        backend_cls = Mock(__name__='Backend')
+        with patch('nefertari.utils.maybe_dotted') as mock_dotted:
+            mock_dotted.return_value = backend_cls
+            self._response_cache(
+                lambda r: r, **{'response_cache.backend': 'foo.Backend',
+                                'response_cache.ttl': '5'})
+        mock_dotted.assert_called_once_with('foo.Backend')
+        assert backend_cls.from_settings.call_count == 1
@@ -1,4 +1,5 @@
-from mock import Mock
+from mock import Mock, patch
+from pyramid.response import Response
 
 from nefertari import utility_views as uviews
 
@@ -41,3 +42,15 @@ class TestOptionsView(object):
         assert response.headers == {
             'Allow': self.header_str,
         }
+
+
+class TestMetricsView(object):
+
+    @patch('nefertari.utility_views.metrics')
+    def test_call(self, mock_metrics):
+        mock_metrics.registry.render.return_value = u'requests 1\n'
+        request = Mock(response=Response())
+        resp = uviews.MetricsView(request=request)()
+        assert resp is request.response
+        assert resp.text == u'requests 1\n'
+        assert resp.content_type == 'text/plain'
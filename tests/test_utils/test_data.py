@@ -1,3 +1,5 @@
+from mock import patch
+
 from nefertari.utils import data as dutils
 
 
@@ -62,6 +64,52 @@ class TestDataUtils(object):
         assert isinstance(obj.foo[0], dutils.DataProxy)
         assert obj.foo[0].baz == 1
 
+    def test_dict2obj_missing_attr(self):
+        obj = dutils.dict2obj({'foo': 'bar'})
+        assert not hasattr(obj, 'baz')
+        assert not hasattr(obj, '__foo__')
+
+    def test_dict2obj_set_attr(self):
+        obj = dutils.dict2obj({'foo': 'bar'})
+        obj.foo = 'baz'
+        assert obj.foo == 'baz'
+
+    def test_dict2obj_lazy_nested(self):
+        obj = dutils.dict2obj({'foo': {'baz': 1}, 'bar': [{'baz': 2}]})
+        assert obj._attrs == {}
+        nested = obj.foo
+        assert obj._attrs.keys() == ['foo']
+        assert obj.foo is nested
+        assert obj.bar[0].baz == 2
+
+    def test_data_proxy_to_dict_returns_data(self):
+        obj = dutils.dict2obj({'_type': 'Story', 'foo': {'bar': 1}})
+        data = obj.to_dict()
+        assert data is obj._data
+        assert data == {'_type': 'Story', 'foo': {'bar': 1}}
+
+    def test_data_proxy_to_dict_keys_copies_data(self):
+        obj = dutils.dict2obj({'_type': 'Story', 'foo': 1, 'bar': 2})
+        data = obj.to_dict(_keys=['foo'])
+        assert data is not obj._data
+        assert data == {'_type': 'Story', 'foo': 1}
+
+    def test_dict2obj_class_cached(self):
+        obj1 = dutils.dict2obj({'_type': 'Story', 'id': 1})
+        obj2 = dutils.dict2obj({'_type': 'Story', 'id': 2})
+        assert type(obj1) is type(obj2)
+        assert type(obj1).__name__ == 'Story'
+        assert obj1.to_dict()['_type'] == 'Story'
+
+    @patch.object(dutils, 'PROXY_CLASSES_LIMIT', 1)
+    def test_get_proxy_class_limit(self):
+        dutils._proxy_classes.clear()
+        story_cls = dutils.get_proxy_class('Story')
+        assert dutils.get_proxy_class('Story') is story_cls
+        dutils.get_proxy_class('User')
+        assert dutils._proxy_classes.keys() == ['User']
+        assert dutils.get_proxy_class('Story') is not story_cls
+
     def test_dict2obj_no_data(self):
         assert dutils.dict2obj({}) == {}
 
@@ -114,6 +162,10 @@ class TestDataUtils(object):
         assert dutils.obj2dict(obj, classkey='kls') == {
             'foo': 'bar', 'kls': 'A'}
 
+    def test_obj2dict_data_proxy(self):
+        obj = dutils.dict2obj({'_type': 'Story', 'foo': {'bar': 1}})
+        assert dutils.obj2dict(obj) == {'foo': {'bar': 1}}
+
     def test_obj2dict_simple_types(self):
         assert dutils.obj2dict(1) == 1
         assert dutils.obj2dict('foo') == 'foo'
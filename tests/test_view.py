@@ -4,7 +4,8 @@ import pytest
 from mock import Mock, MagicMock, patch, call, PropertyMock
 
 from nefertari.view import (
-    BaseView, error_view, key_error_view, value_error_view)
+    BaseView, BulkCreateMixin, JsonItemsPredicate, is_json_items,
+    error_view, key_error_view, value_error_view)
 from nefertari.json_httpexceptions import (
     JHTTPBadRequest, JHTTPNotFound, JHTTPMethodNotAllowed)
 from nefertari.wrappers import wrap_me, ValidationError, ResourceNotFound
@@ -42,6 +43,23 @@ class TestViewMapper(object):
         assert not bc2.called
         assert not bc3.called
 
+    def test_viewmapper_timings(self):
+        from nefertari.view import ViewMapper
+
+        class MyView(object):
+            def __init__(self, ctx, req):
+                self._before_calls = {}
+                self._after_calls = {}
+
+            def index(self):
+                return ['thing']
+
+        request = MagicMock(environ={'nefertari.timings': {}})
+        wrapper = ViewMapper(**{'attr': 'index'})(MyView)
+        wrapper(MagicMock(), request)
+        assert sorted(request.environ['nefertari.timings'].keys()) == [
+            'action', 'before_calls', 'view_init']
+
     def test_viewmapper_bad_request(self):
         from nefertari.view import ViewMapper
 
@@ -175,6 +193,32 @@ class TestBaseView(object):
         assert request.override_renderer == 'string'
         assert view._params.keys() == ['param2']
 
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_init_json_array(self, run):
+        request = Mock(
+            content_type='application/json',
+            json=[{'param1.foo': 'val1'}, 'foo'],
+            method='POST',
+            accept=['application/json'],
+        )
+        request.params.mixed.return_value = {'param2': 'val2'}
+        view = BaseView(context={'foo': 'bar'}, request=request)
+        assert view._json_items == [{'param1': {'foo': 'val1'}}, 'foo']
+        assert view._params.keys() == ['param2']
+
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_init_ndjson(self, run):
+        request = Mock(
+            content_type='application/x-ndjson',
+            body='{"param1": 1}\n\n{"param1": 2}\n',
+            method='POST',
+            accept=['application/json'],
+        )
+        request.params.mixed.return_value = {'param2': 'val2'}
+        view = BaseView(context={'foo': 'bar'}, request=request)
+        assert view._json_items == [{'param1': 1}, {'param1': 2}]
+        assert view._params.keys() == ['param2']
+
     @patch('nefertari.view.BaseView._run_init_actions')
     def test_init_json_error(self, run):
         import simplejson
@@ -262,9 +306,9 @@ class TestBaseView(object):
         assert not id2obj.called
 
     @patch('nefertari.view.engine')
-    @patch('nefertari.view.BaseView.id2obj')
+    @patch('nefertari.view.BaseView.ids2objs')
     @patch('nefertari.view.BaseView._run_init_actions')
-    def test_convert_ids2objects_relational(self, run, id2obj, eng):
+    def test_convert_ids2objects_relational(self, run, ids2objs, eng):
         request = Mock(content_type='', method='', accept=[''], user=None)
         view = BaseView(
             context={}, request=request, _query_params={'foo1': 'bar'},
@@ -273,7 +317,58 @@ class TestBaseView(object):
         eng.is_relationship_field.return_value = True
         view.convert_ids2objects()
         eng.get_relationship_cls.assert_called_once_with('foo', 'Model1')
-        id2obj.assert_called_once_with('foo', eng.get_relationship_cls())
+        model_cls = eng.get_relationship_cls()
+        ids2objs.assert_called_once_with(
+            ['foo'], model_cls, pk_field=model_cls.pk_field())
+
+    @patch('nefertari.view.engine')
+    @patch('nefertari.view.BaseView.ids2objs')
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_convert_ids2objects_groups_by_model(self, run, ids2objs, eng):
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        view = BaseView(
+            context={}, request=request, _query_params={'foo1': 'bar'},
+            _json_params={'author': '1', 'editors': ['2'], 'tags': ['3']})
+        view._model_class = 'Model1'
+        eng.is_relationship_field.return_value = True
+        tag_cls, user_cls = Mock(), Mock()
+        eng.get_relationship_cls.side_effect = lambda field, model: (
+            tag_cls if field == 'tags' else user_cls)
+        view.convert_ids2objects()
+        calls = dict(
+            (args[1], (sorted(args[0]), kwargs))
+            for args, kwargs in ids2objs.call_args_list)
+        assert calls == {
+            tag_cls: (['tags'], {'pk_field': tag_cls.pk_field()}),
+            user_cls: (['author', 'editors'],
+                       {'pk_field': user_cls.pk_field()}),
+        }
+
+    @patch('nefertari.view.engine')
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_get_relationship_cached(self, run, eng):
+        class Model(object):
+            author = None
+            title = None
+
+        class MyView(BaseView):
+            _model_class = Model
+
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        eng.is_relationship_field.side_effect = lambda f, m: f == 'author'
+        user_cls = eng.get_relationship_cls.return_value
+        user_cls.pk_field.return_value = 'username'
+        for _ in range(2):
+            view = MyView(context={}, request=request, _query_params={'a': 1})
+            assert view.get_relationship('author') == (user_cls, 'username')
+            assert view.get_relationship('title') is None
+            assert view.get_relationship('foo') is None
+        assert eng.is_relationship_field.call_count == 4
+        eng.get_relationship_cls.assert_called_once_with('author', Model)
+        assert MyView._relationships == {
+            (Model, 'author'): (user_cls, 'username'),
+            (Model, 'title'): None,
+        }
 
     @patch('nefertari.view.BaseView._run_init_actions')
     def test_get_debug(self, run):
@@ -299,12 +394,13 @@ class TestBaseView(object):
             context={}, request=request, _query_params={'foo': 'bar'})
         view.root_resource = Mock(auth=True)
         view.setup_default_wrappers()
-        assert len(view._after_calls['index']) == 4
-        assert len(view._after_calls['show']) == 3
+        assert len(view._after_calls['index']) == 1
+        assert len(view._after_calls['show']) == 1
         assert len(view._after_calls['delete']) == 1
         assert len(view._after_calls['delete_many']) == 1
         assert len(view._after_calls['update_many']) == 1
-        assert wrap.apply_privacy.call_count == 2
+        wrap.get_fused_after_calls.assert_has_calls([
+            call(privacy=True, etag=True), call(privacy=True)])
 
     @patch('nefertari.view.wrappers')
     @patch('nefertari.view.BaseView._run_init_actions')
@@ -314,12 +410,13 @@ class TestBaseView(object):
             context={}, request=request, _query_params={'foo': 'bar'})
         view.root_resource = Mock(auth=None)
         view.setup_default_wrappers()
-        assert len(view._after_calls['index']) == 3
-        assert len(view._after_calls['show']) == 2
+        assert len(view._after_calls['index']) == 1
+        assert len(view._after_calls['show']) == 1
         assert len(view._after_calls['delete']) == 1
         assert len(view._after_calls['delete_many']) == 1
         assert len(view._after_calls['update_many']) == 1
-        assert not wrap.apply_privacy.called
+        wrap.get_fused_after_calls.assert_has_calls([
+            call(privacy=False, etag=True), call(privacy=False)])
 
     def test_defalt_wrappers_and_wrap_me(self):
         from nefertari import wrappers
@@ -345,8 +442,8 @@ class TestBaseView(object):
         resource = MagicMock(actions=['index'])
         view = MyView(resource, request)
 
-        assert len(view._after_calls['index']) == 3
-        assert len(view._after_calls['show']) == 2
+        assert len(view._after_calls['index']) == 1
+        assert len(view._after_calls['show']) == 1
         assert len(view._after_calls['delete']) == 1
         assert len(view._after_calls['delete_many']) == 1
         assert len(view._after_calls['update_many']) == 1
@@ -456,14 +553,14 @@ class TestBaseView(object):
     def test_id2obj(self, run):
         model = Mock()
         model.pk_field.return_value = 'idname'
-        model.get.return_value = 'foo'
+        model.get.return_value = obj = Mock(idname=1)
         request = Mock(content_type='', method='', accept=[''], user=None)
         view = BaseView(
             context={}, request=request, _json_params={'foo': 'bar'},
             _query_params={'foo1': 'bar1'})
         view._json_params['user'] = '1'
         view.id2obj(name='user', model=model)
-        assert view._json_params['user'] == 'foo'
+        assert view._json_params['user'] is obj
         model.pk_field.assert_called_once_with()
         model.get.assert_called_once_with(idname='1')
 
@@ -471,17 +568,77 @@ class TestBaseView(object):
     def test_id2obj_list(self, run):
         model = Mock()
         model.pk_field.return_value = 'idname'
-        model.get.return_value = 'foo'
+        model.get.return_value = obj = Mock(idname=1)
         request = Mock(content_type='', method='', accept=[''], user=None)
         view = BaseView(
             context={}, request=request, _json_params={'foo': 'bar'},
             _query_params={'foo1': 'bar1'})
         view._json_params['user'] = ['1']
         view.id2obj(name='user', model=model)
-        assert view._json_params['user'] == ['foo']
+        assert view._json_params['user'] == [obj]
         model.pk_field.assert_called_once_with()
         model.get.assert_called_once_with(idname='1')
 
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_id2obj_list_bulk(self, run):
+        obj1, obj2 = Mock(idname=1), Mock(idname=2)
+        model = Mock()
+        model.pk_field.return_value = 'idname'
+        model.get_by_ids.return_value = [obj2, obj1]
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        view = BaseView(
+            context={}, request=request, _json_params={'foo': 'bar'},
+            _query_params={'foo1': 'bar1'})
+        view._json_params['user'] = ['1', 2, '1']
+        view.id2obj(name='user', model=model)
+        assert view._json_params['user'] == [obj1, obj2, obj1]
+        model.get_by_ids.assert_called_once_with(['1', 2])
+        assert not model.get.called
+
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_ids2objs_multiple_fields(self, run):
+        obj1, obj2 = Mock(idname=1), Mock(idname=2)
+        model = Mock()
+        model.pk_field.return_value = 'idname'
+        model.get_by_ids.return_value = [obj1, obj2]
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        view = BaseView(
+            context={}, request=request,
+            _json_params={'author': '1', 'editors': ['2', obj1]},
+            _query_params={'foo1': 'bar1'})
+        view.ids2objs(['author', 'editors', 'missing'], model=model)
+        assert view._json_params['author'] is obj1
+        assert view._json_params['editors'] == [obj2, obj1]
+        model.get_by_ids.assert_called_once_with(['1', '2'])
+
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_id2obj_list_not_found(self, run):
+        model = Mock()
+        model.pk_field.return_value = 'idname'
+        model.get_by_ids.return_value = [Mock(idname=1)]
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        view = BaseView(
+            context={}, request=request, _json_params={'foo': 'bar'},
+            _query_params={'foo1': 'bar1'})
+        view._json_params['user'] = ['1', '2']
+        with pytest.raises(JHTTPBadRequest) as ex:
+            view.id2obj(name='user', model=model)
+        assert str(ex.value) == 'id2obj: Object 2 not found'
+
+    @patch('nefertari.view.BaseView._run_init_actions')
+    def test_id2obj_list_setdefault(self, run):
+        obj1 = Mock(idname=1)
+        model = Mock()
+        model.pk_field.return_value = 'idname'
+        model.get_by_ids.return_value = [obj1]
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        view = BaseView(
+            context={}, request=request, _json_params={'foo': 'bar'},
+            _query_params={'foo1': 'bar1'})
+        view._json_params['user'] = ['1', '2']
+        view.id2obj(name='user', model=model, setdefault=123)
+        assert view._json_params['user'] == [obj1, 123]
+
     @patch('nefertari.view.BaseView._run_init_actions')
     def test_id2obj_not_in_params(self, run):
         model = Mock()
@@ -539,7 +696,136 @@ class TestBaseView(object):
         assert str(ex.value) == 'id2obj: Object 1 not found'
 
 
+class TestBulkCreateMixin(object):
+
+    def _view(self, items, model=None, settings=None):
+        class MyView(BulkCreateMixin, BaseView):
+            _model_class = model or Mock()
+
+        request = Mock(content_type='', method='', accept=[''], user=None)
+        request.registry.settings = settings or {}
+        with patch.object(MyView, '_run_init_actions'):
+            view = MyView(context={}, request=request, _query_params={'a': 1})
+        view._json_items = items
+        return view
+
+    @patch('nefertari.view.ES')
+    @patch('nefertari.view.engine')
+    def test_create_many(self, eng, mock_es):
+        eng.is_relationship_field.return_value = False
+
+        class Model(object):
+            def __init__(self, **kwargs):
+                if 'bad' in kwargs:
+                    raise ValueError('Bad field')
+                self.__dict__.update(kwargs)
+
+            def pk_field(self):
+                return 'id'
+
+            def save(self):
+                if self.id == 3:
+                    raise JHTTPNotFound('Missing')
+
+        view = self._view(
+            [{'id': 1}, 'foo', {'bad': 1}, {'id': 3}, {'id': 4}],
+            model=Model, settings={'bulk_create.batch_size': '2'})
+        assert view.create_many() == {
+            'count': 5,
+            'errors': True,
+            'items': [
+                {'status': 201, 'id': 1},
+                {'status': 400, 'error': 'Item must be an object'},
+                {'status': 400, 'error': 'Bad field'},
+                {'status': 404, 'error': 'Missing'},
+                {'status': 201, 'id': 4},
+            ],
+        }
+        assert mock_es.defer_bulk.call_count == 3
+
+    @patch('nefertari.view.ES')
+    @patch('nefertari.view.engine')
+    def test_create_many_non_ascii_errors(self, eng, mock_es):
+        eng.is_relationship_field.return_value = False
+        model = Mock()
+        model.return_value.save.side_effect = [
+            ValueError(u'Duplicate name: j\xfcrgen'),
+            ValueError('Duplicate name: j\xc3\xbcrgen'),
+        ]
+        view = self._view([{'name': 'a'}, {'name': 'b'}], model=model)
+        assert view.create_many()['items'] == [
+            {'status': 400, 'error': u'Duplicate name: j\xfcrgen'},
+            {'status': 400, 'error': u'Duplicate name: j\xfcrgen'},
+        ]
+
+    @patch('nefertari.view.ES')
+    @patch('nefertari.view.engine')
+    def test_create_batch_relationships(self, eng, mock_es):
+        user1 = Mock(username='user1')
+        user_cls = Mock()
+        user_cls.pk_field.return_value = 'username'
+        user_cls.get_by_ids.return_value = [user1]
+        eng.is_relationship_field.side_effect = lambda f, m: f == 'author'
+        eng.get_relationship_cls.return_value = user_cls
+        model = Mock()
+        model.return_value.pk_field.return_value = 'title'
+        view = self._view([], model=model)
+        view.save_objects = Mock(return_value=[None])
+        statuses = view.create_batch([
+            {'title': 'a', 'author': 'user1'},
+            {'title': 'b', 'author': 'user2'},
+        ])
+        user_cls.get_by_ids.assert_called_once_with(['user1', 'user2'])
+        model.assert_called_once_with(title='a', author=user1)
+        view.save_objects.assert_called_once_with([model.return_value])
+        assert statuses == [
+            {'status': 201, 'id': model.return_value.title},
+            {'status': 400, 'error': 'Related objects not found: author'},
+        ]
+
+    def test_save_objects(self):
+        obj1, obj2 = Mock(), Mock()
+        error = ValueError()
+        obj2.save.side_effect = error
+        view = self._view([])
+        assert view.save_objects([obj1, obj2]) == [None, error]
+        obj1.save.assert_called_once_with()
+
+    def test_save_objects_savepoint(self):
+        from nefertari import engine
+        obj1, obj2 = Mock(), Mock()
+        error = ValueError()
+        obj1.save.side_effect = error
+        session = Mock()
+        savepoint = session.return_value.begin_nested.return_value
+        savepoint.__exit__ = Mock(return_value=False)
+        savepoint.__enter__ = Mock()
+        view = self._view([])
+        with patch.object(engine, 'Session', session, create=True):
+            assert view.save_objects([obj1, obj2]) == [error, None]
+        assert session.return_value.begin_nested.call_count == 2
+        assert savepoint.__exit__.call_args_list[0][0][1] is error
+        assert savepoint.__exit__.call_args_list[1][0] == (
+            None, None, None)
+        obj2.save.assert_called_once_with()
+
+
 class TestViewHelpers(object):
+    def test_is_json_items(self):
+        assert is_json_items(Mock(content_type='application/x-ndjson'))
+        assert is_json_items(Mock(
+            content_type='application/json', body=' \n[{"a": 1}]'))
+        assert not is_json_items(Mock(
+            content_type='application/json', body='{"a": 1}'))
+        assert not is_json_items(Mock(content_type='text/plain', body='[]'))
+
+    def test_json_items_predicate(self):
+        request = Mock(content_type='application/x-ndjson')
+        predicate = JsonItemsPredicate(True, None)
+        assert predicate.text() == 'json_items = True'
+        assert predicate(None, request)
+        assert not JsonItemsPredicate(False, None)(None, request)
+
     def test_key_error_view(self):
         resp = key_error_view(Mock(message='foo'), None)
         assert str(resp.message) == "Bad or missing param 'foo'"
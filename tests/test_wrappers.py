@@ -1,15 +1,24 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import unittest
+from hashlib import md5
 
 import pytest
 from mock import Mock, patch
+from pyramid.request import Request
+from pyramid.response import Response
 from pyramid.testing import DummyRequest
 
 from nefertari import wrappers
 from nefertari.utils import dictset
 
 
+def blank_request(*args, **kwargs):
+    request = Request.blank(*args, **kwargs)
+    request.response = Response()
+    return request
+
+
 class TestWrappers(unittest.TestCase):
     model_test_data = dictset({
         '_type': 'foo',
@@ -279,6 +288,29 @@ class TestWrappers(unittest.TestCase):
         data = filtered['data'][0]
         assert list(sorted(data.keys())) == ['_type', 'id', 'self']
 
+    @patch('nefertari.wrappers.engine')
+    def test_apply_privacy_collection_single_lookup(self, mock_eng):
+        document_cls = Mock(
+            _public_fields=['name'],
+            _auth_fields=['id'])
+        mock_eng.get_document_cls.return_value = document_cls
+        request = Mock(user=None)
+        result = {'data': [self.model_test_data, self.model_test_data]}
+        filtered = wrappers.apply_privacy(request)(result=result)
+        mock_eng.get_document_cls.assert_called_once_with('foo')
+        for data in filtered['data']:
+            assert list(sorted(data.keys())) == ['_type', 'name', 'self']
+
+    def test_get_privacy_fields(self):
+        model_cls = Mock(_public_fields=['name'], _auth_fields=['id'])
+        fields = wrappers.get_privacy_fields(model_cls, 'auth')
+        assert fields == set(['id', '_type', 'self'])
+        assert wrappers.get_privacy_fields(model_cls, 'auth') is fields
+        assert wrappers.get_privacy_fields(model_cls, 'public') == set(
+            ['name', '_type', 'self'])
+        assert wrappers.get_privacy_fields(model_cls, 'admin') is None
+        assert wrappers.get_privacy_fields(model_cls, None) is None
+
     @patch('nefertari.wrappers.obj2dict')
     def test_wrap_in_dict_no_meta_dict(self, mock_obj):
         result = Mock(spec=[])
@@ -383,6 +415,150 @@ class TestWrappers(unittest.TestCase):
         assert isinstance(wrapper.request.response.etag, basestring)
         assert wrapper.request.response.etag != expected1
 
+    def test_set_etag_not_modified(self):
+        request = blank_request('/', headers={'If-None-Match': '"foo"'})
+        wrappers.set_etag(request, 'foo')
+        assert request.response.etag == 'foo'
+        assert request.response.status_int == 304
+        assert wrappers.not_modified(request)
+
+    def test_set_etag_modified(self):
+        request = blank_request('/', headers={'If-None-Match': '"bar"'})
+        wrappers.set_etag(request, 'foo')
+        assert request.response.etag == 'foo'
+        assert request.response.status_int == 200
+        assert not wrappers.not_modified(request)
+
+    def test_set_etag_not_modified_post(self):
+        request = blank_request(
+            '/', method='POST', headers={'If-None-Match': '"foo"'})
+        wrappers.set_etag(request, 'foo')
+        assert request.response.status_int == 200
+
+    def test_add_etag_not_modified_collection(self):
+        request = blank_request('/', headers={
+            'If-None-Match': '"20d135f0f28185b84a4cf7aa51f29500"'})
+        wrappers.add_etag(request)(result={'data': [
+            {'id': 1, '_version': 1},
+            {'id': 2, '_version': 1},
+        ]})
+        assert request.response.status_int == 304
+
+    @patch('nefertari.wrappers.obj2dict')
+    def test_wrap_in_dict_es_etag(self, mock_obj):
+        mock_obj.return_value = lambda **kw: [{'foo': 'bar'}]
+        result = Mock(_nefertari_meta={'total': 1}, _etag='foo')
+        request = blank_request('/')
+        processed = wrappers.wrap_in_dict(request)(result=result)
+        assert processed == {'data': [{'foo': 'bar'}], 'total': 1}
+        assert request.environ['nefertari.es_etag'] == 'foo'
+
+    def test_add_etag_from_es(self):
+        request = blank_request('/')
+        request.environ['nefertari.es_etag'] = 'foo'
+        result = wrappers.add_etag(request)(result={
+            'data': [{'id': 1, '_version': 1}]})
+        assert request.response.etag == md5('foo:public').hexdigest()
+        assert result == {'data': [{'id': 1, '_version': 1}]}
+
+    def test_add_etag_from_es_role(self):
+        request = blank_request('/')
+        request.environ['nefertari.es_etag'] = 'foo'
+        request.user = Mock()
+        wrappers.add_etag(request)(result={'data': []}, is_admin=True)
+        assert request.response.etag == md5('foo:admin').hexdigest()
+
+    def test_fused_after_calls_etag_from_es(self):
+        class Docs(list):
+            _nefertari_meta = {'total': 1}
+            _etag = 'foo'
+
+        request = blank_request('/stories')
+        wrapper = wrappers.fused_after_calls(etag=True)
+        result = wrapper(request=request, result=Docs([dictset({'id': 1})]))
+        assert request.response.etag == md5('foo:public').hexdigest()
+        assert 'etag' not in result
+        assert result['total'] == 1
+        assert result['data'][0]['self'] == 'http://localhost/stories/1'
+
+    def test_es_etag_same_in_fused_and_add_etag(self):
+        class Docs(list):
+            _nefertari_meta = {}
+            _etag = 'foo'
+
+        request = blank_request('/stories')
+        wrapper = wrappers.fused_after_calls(privacy=True, etag=True)
+        wrapper(request=request, result=Docs())
+        fused_etag = request.response.etag
+
+        request = blank_request('/stories')
+        result = wrappers.wrap_in_dict(request)(result=Docs())
+        wrappers.add_etag(request)(result=result)
+        assert request.response.etag == fused_etag
+        assert 'etag' not in result
+
+    @patch('nefertari.wrappers.wrap_in_dict')
+    def test_fused_after_calls_etag_from_es_not_modified(self, mock_wrap):
+        class Docs(list):
+            _nefertari_meta = {}
+            _etag = 'foo'
+
+        etag = md5('foo:public').hexdigest()
+        request = blank_request('/', headers={
+            'If-None-Match': '"{}"'.format(etag)})
+        docs = Docs([dictset({'id': 1})])
+        wrapper = wrappers.fused_after_calls(etag=True)
+        assert wrapper(request=request, result=docs) is docs
+        assert request.response.status_int == 304
+        assert not mock_wrap.called
+
+    def test_get_fused_after_calls_shared(self):
+        wrapper = wrappers.get_fused_after_calls(privacy=True, etag=True)
+        assert wrapper.privacy
+        assert wrapper.etag
+        assert wrappers.get_fused_after_calls(
+            privacy=True, etag=True) is wrapper
+        assert wrappers.get_fused_after_calls() is not wrapper
+
+    def test_fused_after_calls_collection(self):
+        request = Mock(path_url='http://example.com')
+        request.response.etag = None
+        result = [
+            dictset({'id': 1, '_version': 1}),
+            dictset({'id': 2, '_version': 1}),
+        ]
+        wrapper = wrappers.fused_after_calls(etag=True)
+        result = wrapper(request=request, result=result)
+        assert result['count'] == 2
+        assert result['data'][0]['self'] == 'http://example.com/1'
+        assert result['data'][1]['self'] == 'http://example.com/2'
+        assert request.response.etag == '20d135f0f28185b84a4cf7aa51f29500'
+
+    def test_fused_after_calls_no_etag(self):
+        request = Mock(path_url='http://example.com')
+        request.response.etag = None
+        wrapper = wrappers.fused_after_calls()
+        wrapper(request=request, result=[dictset({'id': 1, '_version': 1})])
+        assert request.response.etag is None
+
+    @patch('nefertari.wrappers.engine')
+    def test_fused_after_calls_privacy(self, mock_eng):
+        document_cls = Mock(
+            _public_fields=['name', 'desc'],
+            _auth_fields=['id'])
+        mock_eng.get_document_cls.return_value = document_cls
+        request = Mock(user=None, path_url='http://example.com')
+        wrapper = wrappers.fused_after_calls(privacy=True)
+        result = wrapper(
+            request=request, result=[self.model_test_data.copy()])
+        assert result['count'] == 1
+        assert list(sorted(result['data'][0].keys())) == [
+            '_type', 'desc', 'name', 'self']
+
+        result = wrapper(request=request, result=self.model_test_data.copy())
+        assert list(sorted(result.keys())) == [
+            '_type', 'desc', 'name', 'self']
+
     def test_set_total(self):
         result = Mock(_nefertari_meta={'total': 5})
         processed = wrappers.set_total(None, 2)(result=result)
@@ -421,6 +597,16 @@ class TestWrappers(unittest.TestCase):
             'index', mock_set(), pos=0)
         assert '_limit' not in view._query_params
 
+    @patch('nefertari.wrappers.set_total')
+    def test_set_public_limits_no_scroll(self, mock_set):
+        request = Mock()
+        request.registry.settings = {}
+        view = Mock(
+            request=request,
+            _query_params={'_limit': 10, '_scroll': '1m', '_scroll_id': 'a'})
+        wrappers.set_public_limits(view)
+        assert view._query_params == {'_limit': 10}
+
     @patch('nefertari.wrappers.set_total')
     def test_set_public_limits_value_err(self, mock_set):
         from nefertari.json_httpexceptions import JHTTPBadRequest